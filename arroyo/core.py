@@ -19,17 +19,23 @@
 
 
 import asyncio
+import collections
+import hashlib
+import json
+import os
 import warnings
+from urllib import parse
 
 
+import aiohttp
 import bs4
 import yaml
 from appkit import (
-    cache,
     keyvaluestore,
     network,
     loggertools,
     store,
+    uritools,
     utils
 )
 from appkit.application import services
@@ -38,6 +44,7 @@ import arroyo.exc
 from arroyo import (
     db,
     downloads,
+    fetchcache,
     importer,
     kit,
     mediainfo,
@@ -58,16 +65,37 @@ _defaults = {
     'db-uri': 'sqlite:///' +
               utils.user_path(utils.UserPathType.DATA, 'arroyo.db',
                               create=True),
+    'db.sqlite.busy-timeout': 10,
+    'db.sqlite.cache-size': 64 * 1024,
+    'db.sqlite.mmap-size': 256 * 1024 * 1024,
+    'db.sqlite.pool-size': 5,
+    'db.sqlite.synchronous': 'normal',
+    'db.sqlite.wal': True,
     'downloader': 'mock',
     'fetcher.cache-delta': 60 * 20,
+    'fetcher.cache-max-bytes': 64 * 1024 * 1024,
+    'fetcher.dns-cache': True,
+    'fetcher.keepalive': 30,
+    'fetcher.pool-size': 20,
     'fetcher.enable-cache': True,
     'fetcher.headers': {
         'User-Agent':
             'Mozilla/5.0 (X11; Linux x86) Home software (KHTML, like Gecko)',
         },
+    'importer.bulk-upsert': False,
+    'importer.circuit-breaker': True,
+    'importer.default-interval': '3H',
+    'importer.memo-ttl': 120,
+    'importer.parse-workers': 0,
     'importer.parser': 'auto',
+    'importer.stats-history': 100,
+    'importer.streaming': False,
+    'importer.streaming-window': 10,
     'log-format': '[%(levelname)s] [%(name)s] %(message)s',
     'log-level': 'WARNING',
+    'mediainfo.parse-cache': True,
+    'mediainfo.parse-cache-size': 10000,
+    'mediainfo.parse-workers': 0,
     'selector.query-defaults.age-min': '2H',
     'selector.sorter': 'basic'
 }
@@ -77,16 +105,42 @@ _defaults_types = {
     'async-timeout': float,
     'auto-cron': bool,
     'auto-import': lambda x: None if x is None else bool(x),
+    'db': dict,
     'db-uri': str,
+    'db.sqlite.busy-timeout': float,
+    'db.sqlite.cache-size': int,
+    'db.sqlite.mmap-size': int,
+    'db.sqlite.pool-size': int,
+    'db.sqlite.synchronous': str,
+    'db.sqlite.wal': bool,
     'downloader': str,
     'fetcher': dict,
     'fetcher.cache-delta': int,
+    'fetcher.cache-max-bytes': int,
+    'fetcher.dns-cache': bool,
+    'fetcher.keepalive': int,
+    'fetcher.pool-size': int,
     'fetcher.enable-cache': bool,
     'fetcher.headers': dict,
+    'fetcher.hosts': dict,
+    'fetcher.replay-path': str,
+    'fetcher.replay-record': bool,
     'importer': dict,
+    'importer.bulk-upsert': bool,
+    'importer.circuit-breaker': bool,
+    'importer.default-interval': str,
+    'importer.memo-ttl': int,
+    'importer.parse-workers': int,
     'importer.parser': str,
+    'importer.stats-history': int,
+    'importer.streaming': bool,
+    'importer.streaming-window': int,
     'log-format': str,
     'log-level': str,
+    'mediainfo': dict,
+    'mediainfo.parse-cache': bool,
+    'mediainfo.parse-cache-size': int,
+    'mediainfo.parse-workers': int,
     'selector': dict,
     'selector.sorter': str,
     'selector.query-defaults': str
@@ -97,12 +151,14 @@ _defaults_types = {
 #
 _plugins = [
     # Commands
+    'commands.cache',
     'commands.config',
     'commands.cron',
     'commands.db',
     'commands.download',
     'commands.mediainfo',
     'commands.scan',
+    'commands.stats',
 
     # Downloaders
     'downloaders.mock',
@@ -235,11 +291,33 @@ class Arroyo(services.ApplicationMixin, kit.Application):
         logger = self.logger.getChild('fetcher')
         enable_cache = fetcher_opts.pop('enable_cache')
         cache_delta = fetcher_opts.pop('cache_delta')
+        cache_max_bytes = fetcher_opts.pop('cache_max_bytes', 0)
+        host_limits = fetcher_opts.pop('hosts', {})
+
+        # Connection pool shared by every HTTP client in the app
+        self.connection_pool = ConnectionPool(
+            limit=fetcher_opts.pop('pool_size', 0),
+            keepalive_timeout=fetcher_opts.pop('keepalive', 30),
+            use_dns_cache=fetcher_opts.pop('dns_cache', True),
+            logger=logger)
+
+        # Serve recorded responses instead of network ones, see ReplayFetcher
+        replay_path = fetcher_opts.pop('replay_path', None)
+        replay_record = fetcher_opts.pop('replay_record', False)
+        if replay_path:
+            fetcher_cls = ReplayFetcher
+            fetcher_opts['replay_path'] = replay_path
+            fetcher_opts['record'] = replay_record
+        else:
+            fetcher_cls = ArroyoAsyncFetcher
 
-        self.fetcher = ArroyoAsyncFetcher(
+        self.fetcher = fetcher_cls(
             logger=logger,
             enable_cache=enable_cache,
             cache_delta=cache_delta,
+            cache_max_bytes=cache_max_bytes,
+            host_limits=host_limits,
+            connection_pool=self.connection_pool,
             max_requests=self.settings.get('async-max-concurrency'),
             timeout=self.settings.get('async-timeout'),
             **fetcher_opts
@@ -281,6 +359,13 @@ class Arroyo(services.ApplicationMixin, kit.Application):
         except arroyo.exc.FatalError as e:
             self.logger.critical(e)
 
+        finally:
+            # Entries used from the HTTP cache are stored in batches
+            if self.fetcher.http_cache is not None:
+                self.fetcher.http_cache.flush()
+
+            self.connection_pool.close()
+
 
 class ArroyoStore(store.Store):
     def __init__(self, items={}):
@@ -320,7 +405,8 @@ class ArroyoStore(store.Store):
 
                 dummy, name, origin_key = parts
                 if origin_key not in ['provider', 'uri', 'type', 'language',
-                                      'iterations']:
+                                      'iterations', 'incremental',
+                                      'interval', 'priority', 'jitter']:
                     msg = "Invalid key '{key}' for origin '{name}'"
                     msg = msg.format(key=origin_key, name=name)
                     raise ValueError(msg)
@@ -358,33 +444,539 @@ class ArroyoStore(store.Store):
             self.set(k, v)
 
 
+class ConnectionPool:
+    """HTTP connection pool.
+
+    Holds one aiohttp session, connections are kept alive and reused
+    between requests to the same host and DNS queries are cached.
+    Per-host limits are handled by RequestScheduler.
+
+    Arguments:
+      limit - Max number of simultaneous connections, 0 for no limit.
+      keepalive_timeout - Seconds idle connections are kept open.
+      use_dns_cache - Cache DNS lookups.
+    """
+
+    DEFAULT_HEADERS = {
+        'Accept-Encoding': 'gzip, deflate'
+    }
+
+    def __init__(self, limit=0, keepalive_timeout=30, use_dns_cache=True,
+                 logger=None):
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.use_dns_cache = use_dns_cache
+        self.logger = logger or loggertools.getLogger('connection-pool')
+
+        self._session = None
+        self._loop = None
+
+    @property
+    def session(self):
+        """aiohttp.ClientSession to use for requests.
+
+        Sessions are bound to an event loop, a new one is created if the
+        current event loop changes.
+        """
+        loop = asyncio.get_event_loop()
+
+        if self._session is not None and self._loop is not loop:
+            self.close()
+
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit or None,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=self.use_dns_cache,
+                loop=loop)
+
+            # Cookies are shared between requests, some providers (ex.
+            # elitetorrent) need them
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                cookie_jar=aiohttp.CookieJar(loop=loop),
+                headers=self.DEFAULT_HEADERS,
+                loop=loop)
+            self._loop = loop
+
+            msg = "Connection pool ready (limit: {limit}, keepalive: {ka}s)"
+            msg = msg.format(limit=self.limit or '∞',
+                             ka=self.keepalive_timeout)
+            self.logger.debug(msg)
+
+        return self._session
+
+    def close(self):
+        if self._session is None:
+            return
+
+        session, loop = self._session, self._loop
+        self._session = None
+        self._loop = None
+
+        # Depending on aiohttp version close() returns an awaitable. It can't
+        # be run from another running loop (the session is closed from
+        # ConnectionPool.session once the event loop changes)
+        ret = session.close()
+        if (asyncio.iscoroutine(ret) or isinstance(ret, asyncio.Future)) \
+           and not loop.is_closed() and not loop.is_running() \
+           and not asyncio.get_event_loop().is_running():
+            loop.run_until_complete(ret)
+
+
+class RequestScheduler:
+    """Per-host request scheduler.
+
+    Each host has its own token bucket: requests are allowed at 'rate'
+    requests per second with bursts of up to 'burst' requests. Additionally
+    the number of concurrent connections to a host can be limited with
+    'max-connections'.
+
+    Limits for a host apply to its subdomains too. Hosts without limits are
+    only limited by the global concurrency of the fetcher.
+    """
+
+    LIMIT_KEYS = ('rate', 'burst', 'max-connections')
+
+    def __init__(self, limits=None, logger=None):
+        self.logger = logger
+        self._defaults = {}
+        self._limits = {}
+        self._slots = {}
+
+        for (host, host_limits) in (limits or {}).items():
+            self.set_limits(host, **host_limits)
+
+    @classmethod
+    def limits_from_settings(cls, specs, prefix=''):
+        """Build a host->limits dict from 'fetcher.hosts' settings.
+
+        Dots in hostnames are interpreted as nested keys by the settings
+        store, they are joined back here.
+        """
+        ret = {}
+
+        for (key, value) in specs.items():
+            if not isinstance(value, dict):
+                continue
+
+            host = prefix + '.' + key if prefix else key
+            limits = {k: v for (k, v) in value.items()
+                      if k in cls.LIMIT_KEYS}
+            if limits:
+                ret[host] = limits
+
+            subspecs = {k: v for (k, v) in value.items()
+                        if k not in cls.LIMIT_KEYS}
+            ret.update(cls.limits_from_settings(subspecs, prefix=host))
+
+        return ret
+
+    def set_limits(self, host, default=False, **limits):
+        """Set limits for host.
+
+        Arguments:
+          host - Hostname
+          default - If True limits are only used for the keys not configured
+                    by the user. Providers use this to declare its defaults.
+          limits - Any of 'rate', 'burst' or 'max-connections' (or
+                   'max_connections')
+        """
+        limits = {k.replace('_', '-'): v for (k, v) in limits.items()}
+
+        unknown = set(limits) - set(self.LIMIT_KEYS)
+        if unknown:
+            msg = "Unknow limits for host '{host}': {keys}"
+            msg = msg.format(host=host, keys=', '.join(sorted(unknown)))
+            raise ValueError(msg)
+
+        table = self._defaults if default else self._limits
+        table.setdefault(host.lower(), {}).update(limits)
+
+        # Drop slot affected by the new limits
+        self._slots.pop(host.lower(), None)
+
+    def limits_for(self, host):
+        """Get effective limits for host.
+
+        Return:
+          A tuple (key, limits) where key is the configured host (or parent
+          domain) matching host.
+        """
+        parts = (host or '').lower().split('.')
+
+        for idx in range(len(parts)):
+            candidate = '.'.join(parts[idx:])
+            if candidate in self._limits or candidate in self._defaults:
+                limits = {}
+                limits.update(self._defaults.get(candidate, {}))
+                limits.update(self._limits.get(candidate, {}))
+                return candidate, limits
+
+        return None, {}
+
+    def _get_slot(self, uri):
+        host = parse.urlparse(uri).hostname
+        key, limits = self.limits_for(host)
+
+        if key is None:
+            return None
+
+        if key not in self._slots:
+            self._slots[key] = _HostSlot(
+                rate=limits.get('rate'),
+                burst=limits.get('burst'),
+                max_connections=limits.get('max-connections'))
+
+            if self.logger:
+                msg = "Limits for '{host}': {limits}"
+                msg = msg.format(host=key, limits=limits)
+                self.logger.debug(msg)
+
+        return self._slots[key]
+
+    @asyncio.coroutine
+    def acquire(self, uri):
+        """Wait until a request to uri is allowed.
+
+        Each successful call to acquire must be followed by a call to release
+        """
+        slot = self._get_slot(uri)
+        if slot is not None:
+            yield from slot.acquire()
+
+    def release(self, uri):
+        slot = self._get_slot(uri)
+        if slot is not None:
+            slot.release()
+
+
+class _HostSlot:
+    def __init__(self, rate=None, burst=None, max_connections=None):
+        self.rate = float(rate) if rate else None
+        self.burst = max(1, int(burst or 1))
+        self.tokens = self.burst
+        self.last = None
+
+        if max_connections:
+            self.semaphore = asyncio.Semaphore(int(max_connections))
+        else:
+            self.semaphore = None
+
+        # Waiters for tokens are served in order
+        self.lock = asyncio.Lock()
+
+    @asyncio.coroutine
+    def acquire(self):
+        if self.semaphore:
+            yield from self.semaphore.acquire()
+
+        try:
+            yield from self.take()
+        except:
+            self.release()
+            raise
+
+    def release(self):
+        if self.semaphore:
+            self.semaphore.release()
+
+    @asyncio.coroutine
+    def take(self):
+        if not self.rate:
+            return
+
+        loop = asyncio.get_event_loop()
+
+        with (yield from self.lock):
+            while True:
+                now = loop.time()
+                if self.last is not None:
+                    self.tokens = min(
+                        self.burst,
+                        self.tokens + (now - self.last) * self.rate)
+                self.last = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                yield from asyncio.sleep((1 - self.tokens) / self.rate)
+
+
 class ArroyoAsyncFetcher(network.AsyncFetcher):
-    def __init__(self, *args, enable_cache=False, cache_delta=-1, timeout=-1,
-                 **kwargs):
+    """Fetcher used by arroyo.
+
+    On top of network.AsyncFetcher:
+    - Requests are paced by a per-host scheduler, see RequestScheduler.
+    - Responses are cached (see fetchcache.HTTPCache) with its validators
+      (ETag / Last-Modified) up to cache_max_bytes. Once an entry is older
+      than cache_delta it is revalidated with a conditional request. If
+      the server answers '304 Not Modified' the cached content is returned
+      as a fetchcache.NotModified object.
+    - Timeout can be overridden per host, see ArroyoAsyncFetcher.set_timeout.
+    - Callables in latency_observers are called with the URI and the time
+      (in seconds) spent on each network request.
+    - Requests, bytes and cache hits are counted in counters.
+    """
+    def __init__(self, *args, enable_cache=False, cache_delta=-1,
+                 cache_max_bytes=0, timeout=-1, host_limits=None, headers=None,
+                 max_requests=1, connection_pool=None, **kwargs):
 
         logger = kwargs.get('logger', None)
 
+        self.headers = headers or {}
         self._timeout = timeout
+        self._host_timeouts = {}
+        self.latency_observers = []
+        self.counters = collections.Counter()
+        self._semaphore = asyncio.Semaphore(max(1, max_requests))
+        self._inflight = {}
+        self._inflight_waiters = collections.Counter()
+        self.connection_pool = connection_pool or ConnectionPool(
+            logger=logger)
+        self.scheduler = RequestScheduler(
+            limits=RequestScheduler.limits_from_settings(host_limits or {}),
+            logger=logger)
 
         if enable_cache:
-            fetcher_cache = cache.DiskCache(
+            self.http_cache = fetchcache.HTTPCache(
                 basedir=utils.user_path(utils.UserPathType.CACHE, 'network',
                                         create=True, is_folder=True),
-                delta=cache_delta)
+                delta=cache_delta,
+                max_bytes=cache_max_bytes)
 
             if logger:
                 msg = "{clsname} using cachepath '{path}'"
                 msg = msg.format(clsname=self.__class__.__name__,
-                                 path=fetcher_cache.basedir)
+                                 path=self.http_cache.basedir)
                 logger.debug(msg)
         else:
-            fetcher_cache = None
+            self.http_cache = None
 
-        kwargs['cache'] = fetcher_cache
-        super().__init__(*args, **kwargs)
+        kwargs['cache'] = None
+        super().__init__(*args, headers=headers, max_requests=max_requests,
+                         **kwargs)
+        self.logger = logger or loggertools.getLogger('fetcher')
 
     @asyncio.coroutine
-    def fetch_full(self, *args, **kwargs):
-        kwargs['timeout'] = self._timeout
-        resp, content = yield from super().fetch_full(*args, **kwargs)
+    def fetch(self, uri, **kwargs):
+        resp, content = yield from self.fetch_full(uri, **kwargs)
+        return content
+
+    @asyncio.coroutine
+    def fetch_full(self, uri, skip_cache=False, headers=None, **kwargs):
+        # Concurrent requests for the same URI share the same request and
+        # result (single-flight). Requests with custom parameters are not
+        # shared.
+        if headers or kwargs:
+            return (yield from self._fetch_full(
+                uri, skip_cache=skip_cache, headers=headers, **kwargs))
+
+        key = (uritools.normalize(uri), skip_cache)
+
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(
+                self._fetch_full(uri, skip_cache=skip_cache))
+            fut.add_done_callback(lambda x: self._inflight.pop(key, None))
+            self._inflight[key] = fut
+
+        else:
+            msg = "Joining in-flight request for «{uri}»"
+            msg = msg.format(uri=uri)
+            self.logger.debug(msg)
+
+        # Cancelling one of the callers must not cancel the others, the
+        # request is only cancelled along with its last caller (ex. the
+        # loser of a hedged request, see Importer._fetch_from_mirrors)
+        self._inflight_waiters[fut] += 1
+        try:
+            return (yield from asyncio.shield(fut))
+
+        except asyncio.CancelledError:
+            if self._inflight_waiters[fut] == 1:
+                fut.cancel()
+            raise
+
+        finally:
+            self._inflight_waiters[fut] -= 1
+            if self._inflight_waiters[fut] <= 0:
+                del self._inflight_waiters[fut]
+
+    @asyncio.coroutine
+    def _fetch_full(self, uri, skip_cache=False, headers=None, **kwargs):
+        entry = None
+        req_headers = {}
+        req_headers.update(self.headers)
+        req_headers.update(headers or {})
+
+        if self.http_cache is not None and not skip_cache:
+            entry = self.http_cache.get(uri)
+
+            if entry is not None:
+                if entry.is_fresh(self.http_cache.delta):
+                    msg = "Cache hit for «{uri}»"
+                    msg = msg.format(uri=uri)
+                    self.logger.debug(msg)
+                    self.counters['cache-hits'] += 1
+                    return None, entry.body
+
+                req_headers.update(entry.conditional_headers())
+
+        yield from self.scheduler.acquire(uri)
+        try:
+            with (yield from self._semaphore):
+                resp, content = yield from self._request(
+                    uri, headers=req_headers, **kwargs)
+        finally:
+            self.scheduler.release(uri)
+
+        if resp.status == 304 and entry is not None:
+            msg = "«{uri}» not modified"
+            msg = msg.format(uri=uri)
+            self.logger.debug(msg)
+            self.counters['not-modified'] += 1
+
+            self.http_cache.set(
+                uri, entry.body,
+                etag=resp.headers.get('ETag') or entry.etag,
+                last_modified=(resp.headers.get('Last-Modified') or
+                               entry.last_modified))
+            return resp, fetchcache.NotModified(entry.body)
+
+        # Error responses are raised instead of returned so error pages are
+        # not cached nor parsed, Importer.get_buffer_from_uri handles them
+        if resp.status >= 400:
+            msg = "{status} {reason}"
+            msg = msg.format(status=resp.status, reason=resp.reason)
+            exc = aiohttp.errors.ClientResponseError(msg)
+            exc.status = resp.status
+            raise exc
+
+        if self.http_cache is not None:
+            self.http_cache.set(
+                uri, content,
+                etag=resp.headers.get('ETag'),
+                last_modified=resp.headers.get('Last-Modified'))
+
         return resp, content
+
+    def set_timeout(self, host, timeout):
+        """Override timeout for requests to host.
+
+        Arguments:
+          host - Hostname
+          timeout - Seconds or None to use the default timeout.
+        """
+        if timeout is None:
+            self._host_timeouts.pop(host, None)
+        else:
+            self._host_timeouts[host] = timeout
+
+    def timeout_for(self, uri):
+        timeout = self._host_timeouts.get(parse.urlparse(uri).hostname,
+                                          self._timeout)
+        return timeout if timeout and timeout > 0 else None
+
+    @asyncio.coroutine
+    def _request(self, uri, headers=None, **kwargs):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+
+        session = self.connection_pool.session
+
+        @asyncio.coroutine
+        def _get():
+            resp = yield from session.get(uri, headers=headers, **kwargs)
+
+            # Releasing the response returns the connection to the pool
+            try:
+                content = yield from resp.read()
+            finally:
+                yield from resp.release()
+
+            return resp, content
+
+        # Timeout applies to the whole request (headers and body)
+        resp, content = yield from asyncio.wait_for(_get(),
+                                                    self.timeout_for(uri))
+
+        self.counters['requests'] += 1
+        self.counters['bytes'] += len(content)
+
+        latency = loop.time() - start
+        for observer in self.latency_observers:
+            observer(uri, latency)
+
+        return resp, content
+
+
+class ReplayFetcher(ArroyoAsyncFetcher):
+    """Fetcher serving recorded responses.
+
+    Responses are read from files in replay_path, an index file
+    ('index.json') maps URIs to those files. Useful to run the importer
+    without network access, ex. tests/www-samples.
+
+    In record mode URIs missing in the index are fetched from network and
+    stored as new fixtures.
+    """
+
+    INDEX_FILENAME = 'index.json'
+
+    def __init__(self, *args, replay_path, record=False, **kwargs):
+        kwargs['enable_cache'] = False
+        super().__init__(*args, **kwargs)
+
+        self.replay_path = replay_path
+        self.record = record
+
+        try:
+            with open(self.index_path, encoding='utf-8') as fh:
+                self.index = json.load(fh)
+        except FileNotFoundError:
+            self.index = {}
+
+        # URIs are compared in its normalized form
+        self._lookup = {uritools.normalize(k): v
+                        for (k, v) in self.index.items()}
+
+    @property
+    def index_path(self):
+        return os.path.join(self.replay_path, self.INDEX_FILENAME)
+
+    @asyncio.coroutine
+    def _fetch_full(self, uri, skip_cache=False, **kwargs):
+        try:
+            filename = self._lookup[uritools.normalize(uri)]
+
+        except KeyError:
+            if not self.record:
+                msg = "No recorded response for «{uri}»"
+                msg = msg.format(uri=uri)
+                raise aiohttp.errors.ClientResponseError(msg)
+
+            resp, content = yield from super()._fetch_full(uri, **kwargs)
+            self.save(uri, content)
+            return resp, content
+
+        with open(os.path.join(self.replay_path, filename), 'rb') as fh:
+            return None, fh.read()
+
+    def save(self, uri, content):
+        os.makedirs(self.replay_path, exist_ok=True)
+
+        filename = 'replay-' + hashlib.sha1(uri.encode('utf-8')).hexdigest()
+        with open(os.path.join(self.replay_path, filename), 'wb') as fh:
+            fh.write(content)
+
+        self.index[uri] = filename
+        self._lookup[uritools.normalize(uri)] = filename
+
+        with open(self.index_path, 'w', encoding='utf-8') as fh:
+            json.dump(self.index, fh, indent=4, sort_keys=True)
+
+        msg = "Recorded «{uri}» as {filename}"
+        msg = msg.format(uri=uri, filename=filename)
+        self.logger.debug(msg)
@@ -21,39 +21,184 @@
 from arroyo import models
 
 
+import re
+import time
+
+
+import sqlalchemy
 from appkit.db import sqlalchemyutils as sautils
-from sqlalchemy import orm
+from sqlalchemy import (
+    event,
+    orm,
+    pool
+)
 from sqlalchemy.engine import reflection
 from sqlalchemy.orm import util
 
 
-class Db:
-    def __init__(self, app, db_uri='sqlite:////:memory:'):
-
-        # sqlalchemy scoped session mode
-
-        # engine = sqlalchemy.create_engine(db_uri)
-        # session_factory = sqlalchemy.orm.sessionmaker(bind=engine)
-        # self._sess = sqlalchemy.orm.scoped_session(session_factory)()
-        # models.Base.metadata.create_all(engine)
+def _is_sqlite_memory(url):
+    return url.database in (None, '', ':memory:')
+
+
+def create_engine(db_uri, sqlite_options=None):
+    """Create an engine for db_uri.
+
+    SQLite databases get a connection pool shared between threads (and a
+    single connection for in-memory databases, each connection would be a
+    different database otherwise) and PRAGMAs from sqlite_options applied
+    on each new connection.
+
+    Arguments:
+      db_uri - sqlalchemy URI
+      sqlite_options - dict with keys: wal (bool), synchronous (str),
+        cache-size (KiB), mmap-size (bytes), busy-timeout (seconds) and
+        pool-size. Missing keys (or None values) are left to SQLite
+        defaults.
+    Return:
+      A sqlalchemy engine
+    """
+    url = sqlalchemy.engine.url.make_url(db_uri)
+    if url.get_backend_name() != 'sqlite':
+        return sqlalchemy.create_engine(url)
+
+    opts = sqlite_options or {}
+    memory = _is_sqlite_memory(url)
+
+    # Connections are shared between threads (ex. webui), access is
+    # serialized by the pool
+    connect_args = {'check_same_thread': False}
+    if opts.get('busy-timeout') is not None:
+        connect_args['timeout'] = opts['busy-timeout']
+
+    if memory:
+        engine = sqlalchemy.create_engine(
+            url, connect_args=connect_args, poolclass=pool.StaticPool)
+    else:
+        engine = sqlalchemy.create_engine(
+            url, connect_args=connect_args, poolclass=pool.QueuePool,
+            pool_size=opts.get('pool-size') or 5)
+
+    pragmas = []
+    if opts.get('wal') and not memory:
+        pragmas.append('PRAGMA journal_mode=WAL')
+    if opts.get('synchronous'):
+        synchronous = opts['synchronous'].upper()
+        if synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            msg = "Invalid value for synchronous: {value}"
+            msg = msg.format(value=opts['synchronous'])
+            raise ValueError(msg)
+
+        pragmas.append('PRAGMA synchronous={}'.format(synchronous))
+    if opts.get('cache-size'):
+        # Negative values are KiB instead of pages
+        pragmas.append('PRAGMA cache_size=-{}'.format(
+            int(opts['cache-size'])))
+    if opts.get('mmap-size') is not None and not memory:
+        pragmas.append('PRAGMA mmap_size={}'.format(int(opts['mmap-size'])))
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+
+class QueryRecorder:
+    """Record statements executed by an engine.
+
+    Use it as a context manager, recorded statements are available as a
+    list of (statement, parameters, seconds) tuples in
+    QueryRecorder.statements.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info.setdefault('_recorder_start', []).append(
+            time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        elapsed = time.perf_counter() - conn.info['_recorder_start'].pop()
+        if not executemany:
+            self.statements.append((statement, parameters, elapsed))
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._before)
+        event.listen(self.engine, 'after_cursor_execute', self._after)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._before)
+        event.remove(self.engine, 'after_cursor_execute', self._after)
 
-        # sqlalchemy session maker mode
-
-        # engine = sqlalchemy.create_engine(db_uri)
-        # sessmaker = orm.sessionmaker()
-        # sessmaker.configure(bind=engine)
-        # models.Base.metadata.create_all(engine)
-        # self._sess = sessmaker()
-
-        # Add check_same_thread=False to db_uri.
-        # FIXME: This is a _hack_ required by the webui plugin.
-        if '?' in db_uri:
-            db_uri += '&check_same_thread=False'
-        else:
-            db_uri += '?check_same_thread=False'
 
+class Db:
+    def __init__(self, app, db_uri='sqlite:////:memory:'):
         self.app = app
-        self.session = sautils.create_session(db_uri)
+
+        sqlite_options = {
+            key: app.settings.get('db.sqlite.' + key, default=None)
+            for key in ['wal', 'synchronous', 'cache-size', 'mmap-size',
+                        'busy-timeout', 'pool-size']
+        }
+        self.engine = create_engine(db_uri, sqlite_options=sqlite_options)
+        sautils.Base.metadata.create_all(self.engine)
+
+        # Each thread (ex. webui requests) gets its own session, all of
+        # them are accessed through self.session. Threads must call
+        # self.session.remove() once done to return its connection to the
+        # pool
+        self.session_factory = orm.sessionmaker(bind=self.engine)
+        self.session = orm.scoped_session(self.session_factory)
+
+        # In-memory SQLite databases have a single connection, sessions from
+        # different threads can't be used at the same time
+        self.single_connection = isinstance(self.engine.pool,
+                                            pool.StaticPool)
+
+    def record_queries(self):
+        """Record statements executed from now, see QueryRecorder"""
+        return QueryRecorder(self.engine)
+
+    def explain(self, statement, parameters=()):
+        """Query plan for statement (SQLite only).
+
+        Arguments:
+          statement - SQL statement as executed by the DBAPI
+          parameters - Its parameters
+        Return:
+          A tuple with the list of plan details and the list of indexes
+          used by them.
+        """
+        if self.engine.dialect.name != 'sqlite':
+            msg = "Query plans are only supported for SQLite"
+            raise NotImplementedError(msg)
+
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            details = [row[-1] for row in cursor.fetchall()]
+            cursor.close()
+        finally:
+            conn.close()
+
+        indexes = []
+        for detail in details:
+            m = re.search(r'USING (?:COVERING )?INDEX (\S+)', detail)
+            if m:
+                indexes.append(m.group(1))
+            elif 'USING INTEGER PRIMARY KEY' in detail:
+                indexes.append('PRIMARY KEY')
+
+        return details, indexes
 
     def install_model(self, model):
         model.metadata.create_all(self.session.connection())
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import collections
+import contextlib
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class NotModified(bytes):
+    """Content returned by the fetcher when the server replies with a
+    '304 Not Modified'.
+
+    It's the same content as the previous fetch, consumers can skip
+    processing it again.
+    """
+    pass
+
+
+class CacheEntry:
+    def __init__(self, body, etag=None, last_modified=None, timestamp=None):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.timestamp = timestamp or time.time()
+
+    @property
+    def has_validators(self):
+        return bool(self.etag or self.last_modified)
+
+    def is_fresh(self, delta):
+        """Check if entry can be used without revalidation.
+
+        Arguments:
+          delta - Max age in seconds. A negative value means entries never
+                  expire.
+        """
+        if delta < 0:
+            return True
+
+        return time.time() - self.timestamp < delta
+
+    def conditional_headers(self):
+        """Headers for revalidating this entry"""
+        headers = {}
+
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        return headers
+
+
+class HTTPCache:
+    """Disk cache for HTTP responses.
+
+    Along with the body, validators (ETag and Last-Modified headers) are
+    stored so expired entries can be revalidated with conditional requests
+    instead of being downloaded again.
+
+    Bodies are stored zlib-compressed and addressed by the hash of its
+    content, so identical bodies from different URIs are stored once. A
+    SQLite index maps keys to bodies and keeps the order in which entries
+    were used. Once the size of the stored bodies exceeds max_bytes the least
+    recently used entries are evicted.
+
+    Reads don't write the index: the entries used by get() are kept in
+    memory and their order is stored along with the next write to the index
+    (any set(), delete() or prune()) or once LRU_BATCH_SIZE of them are
+    pending, see flush().
+
+    Several processes (ex. cron and the webui) can share the same basedir:
+    changes to the index and to the stored bodies are done inside a write
+    transaction of the index, which SQLite serializes with a file lock.
+    """
+
+    INDEX_FILENAME = 'index.sqlite'
+    BLOBS_DIRNAME = 'blobs'
+
+    # Seconds to wait for other processes holding the index lock
+    LOCK_TIMEOUT = 30
+
+    # Number of used entries kept in memory before storing their order
+    LRU_BATCH_SIZE = 100
+
+    def __init__(self, basedir, delta=-1, max_bytes=0):
+        self.basedir = basedir
+        self.delta = delta
+        self.max_bytes = max_bytes
+
+        self._conn = None
+        self._lock = threading.RLock()
+
+        # Keys used by get() not stored in the index yet, in the order they
+        # were used
+        self._used = collections.OrderedDict()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.basedir, self.INDEX_FILENAME)
+
+    @property
+    def size(self):
+        """Bytes used by stored bodies"""
+        return self._query_size(self._connect())
+
+    def _blob_path(self, digest):
+        return os.path.join(self.basedir, self.BLOBS_DIRNAME,
+                            digest[0:2], digest)
+
+    def _connect(self):
+        if self._conn is not None:
+            return self._conn
+
+        os.makedirs(self.basedir, exist_ok=True)
+
+        # Transactions are handled by _transaction
+        self._conn = sqlite3.connect(self.index_path,
+                                     timeout=self.LOCK_TIMEOUT,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+
+        with self._transaction() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, '
+                'digest TEXT NOT NULL, '
+                'size INTEGER NOT NULL, '
+                'raw_size INTEGER NOT NULL, '
+                'etag TEXT, '
+                'last_modified TEXT, '
+                'timestamp REAL NOT NULL, '
+                'used INTEGER NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_entries_digest '
+                         'ON entries (digest)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_entries_used '
+                         'ON entries (used)')
+
+        return self._conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # 'BEGIN IMMEDIATE' takes the write lock of the index at once
+        with self._lock:
+            conn = self._conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Order of used entries goes along with any write
+                self._store_used(conn)
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+
+    # Value for entries.used, higher values are more recently used
+    _NEXT_USED = '(SELECT COALESCE(MAX(used), 0) + 1 FROM entries)'
+
+    def _store_used(self, conn):
+        # Store order of entries used since the last write, must be called
+        # inside a transaction
+        if not self._used:
+            return
+
+        conn.executemany(
+            'UPDATE entries SET used = ' + self._NEXT_USED +
+            ' WHERE key = ?', [(key,) for key in self._used])
+        self._used.clear()
+
+    @staticmethod
+    def _query_size(conn):
+        row = conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM '
+            '(SELECT MAX(size) AS size FROM entries GROUP BY digest)'
+        ).fetchone()
+        return row[0]
+
+    def _write_blob(self, conn, body):
+        # Must be called inside a transaction so other processes don't
+        # remove the blob before it's referenced
+        digest = hashlib.sha1(body).hexdigest()
+
+        row = conn.execute(
+            'SELECT size FROM entries WHERE digest = ? LIMIT 1',
+            (digest,)).fetchone()
+        path = self._blob_path(digest)
+        if row is not None and os.path.exists(path):
+            return digest, row[0]
+
+        data = zlib.compress(body)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first, blobs are never left half written
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+
+        return digest, len(data)
+
+    def _remove(self, conn, key, digest):
+        conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+        return self._remove_orphan_blob(conn, digest)
+
+    def _remove_orphan_blob(self, conn, digest):
+        # Blob is removed along with its last reference. Returns True if it
+        # was removed
+        row = conn.execute('SELECT 1 FROM entries WHERE digest = ? LIMIT 1',
+                           (digest,)).fetchone()
+        if row is not None:
+            return False
+
+        try:
+            os.unlink(self._blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+        return True
+
+    def _evict(self, conn, max_bytes):
+        evicted = 0
+        size = self._query_size(conn)
+        if size <= max_bytes:
+            return evicted
+
+        rows = conn.execute('SELECT key, digest, size FROM entries '
+                            'ORDER BY used').fetchall()
+        for (key, digest, blob_size) in rows:
+            if size <= max_bytes:
+                break
+
+            if self._remove(conn, key, digest):
+                size -= blob_size
+            evicted += 1
+
+        return evicted
+
+    def get(self, key):
+        conn = self._connect()
+
+        row = conn.execute(
+            'SELECT digest, etag, last_modified, timestamp FROM entries '
+            'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        digest, etag, last_modified, timestamp = row
+
+        try:
+            with open(self._blob_path(digest), 'rb') as fh:
+                body = zlib.decompress(fh.read())
+
+        except (FileNotFoundError, zlib.error):
+            with self._transaction() as conn:
+                conn.execute('DELETE FROM entries WHERE key = ? AND '
+                             'digest = ?', (key, digest))
+            return None
+
+        with self._lock:
+            self._used[key] = None
+            self._used.move_to_end(key)
+            pending = len(self._used)
+
+        if pending >= self.LRU_BATCH_SIZE:
+            self.flush()
+
+        return CacheEntry(body, etag=etag, last_modified=last_modified,
+                          timestamp=timestamp)
+
+    def set(self, key, body, etag=None, last_modified=None):
+        self._connect()
+
+        entry = CacheEntry(body, etag=etag, last_modified=last_modified)
+
+        with self._transaction() as conn:
+            digest, size = self._write_blob(conn, body)
+
+            row = conn.execute('SELECT digest FROM entries WHERE key = ?',
+                               (key,)).fetchone()
+            conn.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, '
+                + self._NEXT_USED + ')',
+                (key, digest, size, len(body), etag, last_modified,
+                 entry.timestamp))
+
+            if row is not None and row[0] != digest:
+                self._remove_orphan_blob(conn, row[0])
+
+            if self.max_bytes > 0:
+                self._evict(conn, self.max_bytes)
+
+        return entry
+
+    def flush(self):
+        """Store the order of entries used by get() in the index"""
+        self._connect()
+
+        with self._lock:
+            if not self._used:
+                return
+
+            with self._transaction():
+                # Pending entries are stored by _transaction
+                pass
+
+    def touch(self, key):
+        """Mark entry as revalidated"""
+        entry = self.get(key)
+        if entry is None:
+            return None
+
+        return self.set(key, entry.body,
+                        etag=entry.etag, last_modified=entry.last_modified)
+
+    def delete(self, key):
+        self._connect()
+
+        with self._transaction() as conn:
+            row = conn.execute('SELECT digest FROM entries WHERE key = ?',
+                               (key,)).fetchone()
+            if row is not None:
+                self._remove(conn, key, row[0])
+
+    def stats(self):
+        """Get cache statistics.
+
+        Return:
+          A dict with the number of entries, unique bodies, bytes used on
+          disk, uncompressed bytes and byte budget.
+        """
+        conn = self._connect()
+
+        entries, blobs, raw_bytes = conn.execute(
+            'SELECT COUNT(*), COUNT(DISTINCT digest), '
+            'COALESCE(SUM(raw_size), 0) FROM entries').fetchone()
+
+        return {
+            'entries': entries,
+            'blobs': blobs,
+            'bytes': self._query_size(conn),
+            'raw-bytes': raw_bytes,
+            'max-bytes': self.max_bytes,
+        }
+
+    def prune(self, max_bytes=None, expired=False):
+        """Remove entries from cache.
+
+        Entries over the budget are evicted and files not referenced by the
+        index (leftovers from crashes or older cache formats) are removed.
+
+        Arguments:
+          max_bytes - Byte budget, defaults to the cache budget. 0 removes
+                      all entries.
+          expired - Remove entries older than delta too.
+        Return:
+          Number of removed entries.
+        """
+        self._connect()
+
+        removed = 0
+
+        with self._transaction() as conn:
+            if expired and self.delta >= 0:
+                rows = conn.execute(
+                    'SELECT key, digest FROM entries WHERE timestamp <= ?',
+                    (time.time() - self.delta,)).fetchall()
+                for (key, digest) in rows:
+                    self._remove(conn, key, digest)
+                    removed += 1
+
+            if max_bytes is None:
+                max_bytes = self.max_bytes if self.max_bytes > 0 else None
+
+            if max_bytes is not None:
+                removed += self._evict(conn, max_bytes)
+
+            # Remove orphan files. Other processes only write blobs while
+            # holding the index lock, so none of them is half-written here
+            keep = set([self.index_path, self.index_path + '-journal'])
+            keep.update(self._blob_path(digest) for (digest,) in conn.execute(
+                'SELECT DISTINCT digest FROM entries'))
+
+            for (dirpath, dirnames, filenames) in os.walk(self.basedir):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    if path not in keep:
+                        os.unlink(path)
+
+        return removed
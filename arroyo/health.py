@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import time
+
+
+from appkit import loggertools
+
+
+class CircuitState:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    """Request skipped because its provider is failing"""
+    pass
+
+
+class HealthTracker:
+    """Per-provider health tracking.
+
+    For each provider the outcome of the last WINDOW requests and a
+    histogram of its latencies are kept in app.variables so they survive
+    between runs. Changes are written by HealthTracker.save, usually once at
+    the end of an import run.
+
+    Once the error rate reaches ERROR_THRESHOLD the circuit is opened and
+    requests to that provider are skipped. After a backoff period (doubled
+    each time the provider keeps failing, up to MAX_BACKOFF) a single probe
+    request is allowed: if it succeeds the circuit is closed again,
+    otherwise it's reopened. A dead provider costs one probe per backoff
+    period instead of a timeout for each request.
+
+    Timeouts adapt to the observed latencies, see HealthTracker.timeout_for.
+    """
+
+    VARIABLES_NS = 'importer.health'
+
+    WINDOW = 20
+    MIN_SAMPLES = 3
+    ERROR_THRESHOLD = 0.5
+
+    BACKOFF = 5 * 60
+    MAX_BACKOFF = 6 * 60 * 60
+
+    # Latency histogram buckets, upper bounds in seconds. Last bucket
+    # collects everything else
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+    MIN_LATENCY_SAMPLES = 10
+    MAX_LATENCY_SAMPLES = 500
+    TIMEOUT_FACTOR = 3
+    MIN_TIMEOUT = 2
+
+    def __init__(self, app, logger=None):
+        self.app = app
+        self.logger = logger or loggertools.getLogger('health')
+
+        # provider -> state
+        self._states = {}
+
+        # Providers with a probe request in flight
+        self._probing = set()
+
+        # Providers with changes not saved yet, see HealthTracker.save
+        self._dirty = set()
+
+    def _key(self, provider):
+        return '{ns}.{provider}'.format(ns=self.VARIABLES_NS,
+                                        provider=provider)
+
+    def get(self, provider):
+        """Get health state for provider.
+
+        Return:
+          A dict with keys: circuit, outcomes (True for success, False for
+          failure), latencies (histogram counts, see BUCKETS), backoff and
+          retry-at.
+        """
+        if provider not in self._states:
+            state = self.app.variables.get(self._key(provider), default=None)
+            if not state:
+                state = {}
+
+            state.setdefault('circuit', CircuitState.CLOSED)
+            state.setdefault('outcomes', [])
+            state.setdefault('latencies', [0] * (len(self.BUCKETS) + 1))
+            state.setdefault('backoff', 0)
+            state.setdefault('retry-at', 0)
+            self._states[provider] = state
+
+        return self._states[provider]
+
+    def _save(self, provider):
+        self._dirty.add(provider)
+
+    def save(self):
+        """Store changed states in app.variables."""
+        for provider in sorted(self._dirty):
+            self.app.variables.set(self._key(provider),
+                                   self._states[provider])
+
+        self._dirty.clear()
+
+    def reset(self, provider):
+        self._states.pop(provider, None)
+        self._probing.discard(provider)
+        self._dirty.discard(provider)
+        self.app.variables.reset(self._key(provider))
+
+    def error_rate(self, provider):
+        outcomes = self.get(provider)['outcomes']
+        if not outcomes:
+            return 0.0
+
+        return outcomes.count(False) / len(outcomes)
+
+    def percentile(self, provider, pct):
+        """Approximate latency percentile from the histogram.
+
+        Return:
+          Upper bound (in seconds) of the bucket containing the percentile
+          or None if there are not enough samples.
+        """
+        counts = self.get(provider)['latencies']
+        total = sum(counts)
+        if total < self.MIN_LATENCY_SAMPLES:
+            return None
+
+        threshold = total * pct / 100
+        acc = 0
+        for (bound, count) in zip(self.BUCKETS, counts):
+            acc += count
+            if acc >= threshold:
+                return bound
+
+        # Beyond the last bucket, no upper bound
+        return None
+
+    def timeout_for(self, provider, default):
+        """Timeout for requests to provider.
+
+        TIMEOUT_FACTOR times the observed p95 latency, bounded by
+        MIN_TIMEOUT and default. Providers without enough samples use
+        default.
+        """
+        p95 = self.percentile(provider, 95)
+        if p95 is None:
+            return default
+
+        timeout = max(self.MIN_TIMEOUT, p95 * self.TIMEOUT_FACTOR)
+        if default is not None and default > 0:
+            timeout = min(timeout, default)
+
+        return timeout
+
+    def allow(self, provider, now=None):
+        """Check if a request to provider can be made.
+
+        An open circuit allows one probe request once its backoff period
+        has expired, see HealthTracker.
+        """
+        state = self.get(provider)
+
+        if state['circuit'] == CircuitState.CLOSED:
+            return True
+
+        if provider in self._probing:
+            return False
+
+        if now is None:
+            now = time.time()
+
+        if now < state['retry-at']:
+            return False
+
+        msg = "Probing {provider}"
+        msg = msg.format(provider=provider)
+        self.logger.info(msg)
+
+        state['circuit'] = CircuitState.HALF_OPEN
+        self._probing.add(provider)
+        return True
+
+    def release(self, provider):
+        """Give up a probe without an outcome (ex. it was cancelled).
+
+        Circuit is left as is, next call to HealthTracker.allow can start a
+        new probe.
+        """
+        self._probing.discard(provider)
+
+    def _add_outcome(self, state, success):
+        state['outcomes'].append(success)
+        del state['outcomes'][:-self.WINDOW]
+
+    def record_latency(self, provider, latency):
+        """Add a latency sample (in seconds) to the histogram.
+
+        It's saved along with the outcome of the request, see
+        HealthTracker.record_success and HealthTracker.record_failure.
+        """
+        state = self.get(provider)
+        counts = state['latencies']
+
+        idx = len(self.BUCKETS)
+        for (i, bound) in enumerate(self.BUCKETS):
+            if latency <= bound:
+                idx = i
+                break
+        counts[idx] += 1
+
+        # Decay old samples so the histogram follows recent behaviour
+        if sum(counts) > self.MAX_LATENCY_SAMPLES:
+            state['latencies'] = [x // 2 for x in counts]
+
+    def record_success(self, provider):
+        state = self.get(provider)
+        self._add_outcome(state, True)
+
+        if state['circuit'] != CircuitState.CLOSED:
+            msg = "{provider} is healthy again, closing circuit"
+            msg = msg.format(provider=provider)
+            self.logger.info(msg)
+
+            state['circuit'] = CircuitState.CLOSED
+            state['backoff'] = 0
+            state['retry-at'] = 0
+            state['outcomes'] = [True]
+
+        self._probing.discard(provider)
+        self._save(provider)
+
+    def record_failure(self, provider, now=None):
+        state = self.get(provider)
+        self._add_outcome(state, False)
+
+        if now is None:
+            now = time.time()
+
+        if state['circuit'] == CircuitState.HALF_OPEN:
+            self._open(provider, state, now,
+                       min(self.MAX_BACKOFF, state['backoff'] * 2))
+
+        elif (state['circuit'] == CircuitState.CLOSED and
+              len(state['outcomes']) >= self.MIN_SAMPLES and
+              self.error_rate(provider) >= self.ERROR_THRESHOLD):
+            self._open(provider, state, now, self.BACKOFF)
+
+        self._probing.discard(provider)
+        self._save(provider)
+
+    def _open(self, provider, state, now, backoff):
+        state['circuit'] = CircuitState.OPEN
+        state['backoff'] = backoff
+        state['retry-at'] = now + backoff
+
+        msg = ("{provider} is failing (error rate: {rate:.0%}), skipping it "
+               "for {backoff} seconds")
+        msg = msg.format(provider=provider, rate=self.error_rate(provider),
+                         backoff=int(backoff))
+        self.logger.warning(msg)
@@ -21,14 +21,21 @@
 import abc
 import aiohttp
 import asyncio
+import collections
 import enum
+import os
+import random
 import re
+import sqlite3
 import sys
+import time
 import traceback
+from concurrent import futures
 from urllib import parse
 
 
 import bs4
+import sqlalchemy
 from appkit import (
     loggertools,
     uritools,
@@ -38,12 +45,30 @@ from appkit import (
 
 from arroyo import (
     bittorrentlib,
+    fetchcache,
+    health,
+    importstats,
     kit,
     models
 )
 
 
 class Provider(kit.Extension):
+    # Set to True if parse() can run in a separate process.
+    # Pool-safe providers only can access settings and its own logger from
+    # parse(), see Importer.parse_buffer
+    POOL_SAFE = False
+
+    # Default request limits for the hosts used by this provider, user
+    # settings under fetcher.hosts.<host> take precedence.
+    # Example: {'example.com': {'rate': 1, 'burst': 2, 'max-connections': 1}}
+    HOST_LIMITS = {}
+
+    # Base URIs (scheme and host) of interchangeable mirrors. Requests to any
+    # of them can be served by the others, see Importer.get_buffer_from_uri
+    # Example: ['https://example.com', 'https://example.org']
+    MIRRORS = []
+
     @abc.abstractmethod
     def compatible_uri(self, uri):
         attr_name = 'URI_PATTERNS'
@@ -69,6 +94,11 @@ class Provider(kit.Extension):
         super().__init__(app, *args, **kwargs)
         self.settings = app.settings
 
+        if app.fetcher is not None:
+            for (host, limits) in self.HOST_LIMITS.items():
+                app.fetcher.scheduler.set_limits(host, default=True,
+                                                 **limits)
+
     @abc.abstractmethod
     def paginate(self, uri):
         yield uri
@@ -100,7 +130,8 @@ class Provider(kit.Extension):
 
 class Origin:
     def __init__(self, provider, uri=None, iterations=1,
-                 overrides={}):
+                 overrides={}, incremental=False, interval=None, priority=0,
+                 jitter=0):
 
         if not isinstance(provider, Provider):
             msg = "Invalid provider: {provider}"
@@ -131,6 +162,23 @@ class Origin:
             msg = msg.format(name='iterations', value=iterations)
             raise TypeError(msg)
 
+        for (nme, var, nullable) in [('interval', interval, True),
+                                     ('priority', priority, False),
+                                     ('jitter', jitter, False)]:
+            if var is None and nullable:
+                continue
+
+            if not isinstance(var, int):
+                msg = "Invalid value '{value}' for '{name}'. It must be an int"
+                msg = msg.format(name=nme, value=var)
+                raise TypeError(msg)
+
+        # Check bools
+        if not isinstance(incremental, bool):
+            msg = "Invalid value '{value}' for '{name}'. It must be a bool"
+            msg = msg.format(name='incremental', value=incremental)
+            raise TypeError(msg)
+
         # Check overrides
         if not all([isinstance(k, str) and k != ''
                     for k in overrides]):
@@ -147,6 +195,10 @@ class Origin:
         self.provider = provider
         self.uri = uritools.normalize(uri)
         self.iterations = iterations
+        self.incremental = incremental
+        self.interval = interval
+        self.priority = priority
+        self.jitter = jitter
         self.overrides = overrides.copy()
         self.logger = loggertools.getLogger(
             '{}-origin'.format(provider.__extension_name__))
@@ -169,6 +221,30 @@ class Importer:
         self.app = app
         self.logger = loggertools.getLogger('importer')
 
+        self._parse_executor = None
+        self._parse_settings = None
+        self._bulk_upsert_dialect = None
+
+        # (provider, uri, overrides) -> (expiration, future), see
+        # Importer.get_data_from_uri
+        self._data_memo = {}
+
+        # Watermarks from incremental origins waiting for its data to be
+        # stored, see Importer.commit_watermarks
+        self._pending_watermarks = {}
+
+        # Timings and counters of the current run, see Importer.process
+        self.stats = importstats.ImportStats()
+
+        # Provider health, see Importer.get_buffer_from_uri
+        self.health = health.HealthTracker(app, logger=self.logger)
+
+        # hostname -> provider name for latency samples, see
+        # Importer._observe_latency
+        self._health_hosts = {}
+        if app.fetcher is not None:
+            app.fetcher.latency_observers.append(self._observe_latency)
+
         app.signals.register('source-added')
         app.signals.register('source-updated')
         app.signals.register('sources-added-batch')
@@ -181,9 +257,16 @@ class Importer:
         return value
 
     def origin_from_params(self, provider=None, uri=None, iterations=1,
-                           language=None, type=None):
+                           language=None, type=None, incremental=False,
+                           interval=None, priority=0, jitter=0):
         extension = None
 
+        # Intervals can be expressed as strings (ex. '3H')
+        if isinstance(interval, str):
+            interval = utils.parse_interval(interval)
+        if isinstance(jitter, str):
+            jitter = utils.parse_interval(jitter)
+
         if not provider and not uri:
             msg = "Neither provider or uri was provided"
             raise TypeError(msg)
@@ -228,7 +311,8 @@ class Importer:
             overrides['type'] = type
 
         return Origin(provider=extension, uri=uri, iterations=iterations,
-                      overrides=overrides)
+                      overrides=overrides, incremental=incremental,
+                      interval=interval, priority=priority, jitter=jitter)
 
     def origins_from_config(self):
         specs = self.app.settings.get('origin', default={})
@@ -237,7 +321,7 @@ class Importer:
         if not specs:
             msg = "No origins defined"
             self.logger.warning(msg)
-            return []
+            return None
 
         return [
             (name, self.origin_from_params(**params))
@@ -257,11 +341,40 @@ class Importer:
           - result is a bytes object with the content from uri or an Exception
             if something goes wrong
         """
+        use_health = self.app.settings.get('importer.circuit-breaker',
+                                           default=False)
+        provider = origin.provider.__extension_name__
+
+        if use_health:
+            if not self.health.allow(provider):
+                msg = "Skipping «{uri}»: {provider} is failing"
+                msg = msg.format(uri=uri, provider=provider)
+                self.logger.warning(msg)
+                return (origin, uri, health.CircuitOpenError(msg))
+
+            timeout = self.health.timeout_for(
+                provider,
+                default=self.app.settings.get('async-timeout', default=None))
+            for x in self.mirror_uris(origin.provider, uri):
+                host = parse.urlparse(x).hostname
+                self._health_hosts[host] = provider
+                self.app.fetcher.set_timeout(host, timeout)
+
+        self.stats.incr(importstats.Counter.REQUESTS, origin=origin)
+        start = time.perf_counter()
+        recorded = False
+
         try:
-            result = yield from origin.provider.fetch(self.app.fetcher, uri)
+            result = yield from self._fetch_from_mirrors(
+                origin, self.mirror_uris(origin.provider, uri))
 
-        except (asyncio.CancelledError,
-                asyncio.TimeoutError,
+        except asyncio.CancelledError as e:
+            msg = "Error fetching «{uri}»: {msg}"
+            msg = msg.format(uri=uri, msg=str(e) or 'no reason')
+            self.logger.error(msg)
+            result = e
+
+        except (asyncio.TimeoutError,
                 aiohttp.errors.ClientOSError,
                 aiohttp.errors.ClientResponseError,
                 aiohttp.errors.ServerDisconnectedError) as e:
@@ -272,6 +385,14 @@ class Importer:
             self.logger.error(msg)
             result = e
 
+            # Client errors (4xx) are answered by a working server
+            if use_health:
+                if 400 <= getattr(e, 'status', 0) < 500:
+                    self.health.record_success(provider)
+                else:
+                    self.health.record_failure(provider)
+                recorded = True
+
         except Exception as e:
             print(traceback.format_exc(), file=sys.stderr)
             msg = "Unhandled exception {type}: {e}"
@@ -279,6 +400,32 @@ class Importer:
             self.logger.critical(msg)
             result = e
 
+            if use_health:
+                self.health.record_failure(provider)
+                recorded = True
+
+        else:
+            if use_health:
+                self.health.record_success(provider)
+                recorded = True
+
+        finally:
+            # Cancelled requests (or anything else without an outcome) must
+            # not leave the provider stuck in a probe
+            if use_health and not recorded:
+                self.health.release(provider)
+
+        self.stats.add_time(importstats.Stage.FETCH,
+                            time.perf_counter() - start, origin=origin)
+
+        if isinstance(result, Exception):
+            self.stats.incr(importstats.Counter.ERRORS, origin=origin)
+        elif isinstance(result, fetchcache.NotModified):
+            self.stats.incr(importstats.Counter.NOT_MODIFIED, origin=origin)
+        elif result:
+            self.stats.incr(importstats.Counter.BYTES, len(result),
+                            origin=origin)
+
         if (not isinstance(result, Exception) and
                 (result is None or result == '')):
             msg = "Empty or None buffer for «{uri}»"
@@ -287,19 +434,187 @@ class Importer:
 
         return (origin, uri, result)
 
+    def _mirror_key(self, provider):
+        return 'importer.mirror.{provider}'.format(
+            provider=provider.__extension_name__)
+
+    def mirror_uris(self, provider, uri):
+        """ Get equivalent URIs for uri from provider's mirrors.
+
+        Return:
+          A list of URIs. The preferred mirror (the one which answered first
+          last time) comes first followed by uri and the remaining mirrors.
+          If uri doesn't belong to any mirror the list only contains uri.
+        """
+        if not provider.MIRRORS:
+            return [uri]
+
+        parsed = parse.urlparse(uri)
+        base = '{scheme}://{netloc}'.format(scheme=parsed.scheme,
+                                            netloc=parsed.netloc)
+        mirrors = [x.rstrip('/') for x in provider.MIRRORS]
+        if base not in mirrors:
+            return [uri]
+
+        preferred = self.app.variables.get(self._mirror_key(provider),
+                                           default=None)
+        mirrors.remove(base)
+        mirrors.insert(0, base)
+        if preferred in mirrors:
+            mirrors.remove(preferred)
+            mirrors.insert(0, preferred)
+
+        path = uri[len(base):]
+        return [x + path for x in mirrors]
+
     @asyncio.coroutine
-    def get_buffers_from_origin(self, origin):
-        """ Get all buffers from origin.
+    def _fetch_from_mirrors(self, origin, uris):
+        """ Fetch the first available URI from uris.
+
+        Requests are hedged: if the current request hasn't been answered
+        after the provider's p90 latency (see Importer.health) a backup
+        request to the next mirror is fired. Failed requests are retried
+        with the next mirror at once. First successful answer wins and the
+        remaining requests are cancelled.
+        """
+        provider = origin.provider
+        if len(uris) == 1:
+            return (yield from provider.fetch(self.app.fetcher, uris[0]))
+
+        delay = self.health.percentile(provider.__extension_name__, 90)
+        candidates = list(uris)
+        tasks = {}
+        pending = set()
+        exc = None
+
+        def _launch():
+            uri = candidates.pop(0)
+            task = asyncio.ensure_future(
+                provider.fetch(self.app.fetcher, uri))
+            tasks[task] = uri
+            pending.add(task)
+
+        _launch()
+        try:
+            while pending:
+                done, pending = yield from asyncio.wait(
+                    pending,
+                    timeout=delay if candidates else None,
+                    return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    msg = "No answer from «{uri}» in {delay}s, trying mirror"
+                    msg = msg.format(uri=uris[0], delay=delay)
+                    self.logger.debug(msg)
+                    _launch()
+                    continue
+
+                for task in done:
+                    if task.exception() is None:
+                        self._set_preferred_mirror(provider, tasks[task])
+                        return task.result()
+
+                    exc = task.exception()
+                    msg = "Mirror «{uri}» failed: {msg}"
+                    msg = msg.format(uri=tasks[task], msg=str(exc) or
+                                     exc.__class__.__name__)
+                    self.logger.debug(msg)
+
+                if candidates:
+                    _launch()
+
+            raise exc
+
+        finally:
+            for task in pending:
+                task.cancel()
 
-        An Origin can have several 'pages' or iterations.
-        This methods is responsable to generate all URIs needed from origin
-        and Importer.get_buffer_from_uri from each of them.
+    def _set_preferred_mirror(self, provider, uri):
+        parsed = parse.urlparse(uri)
+        base = '{scheme}://{netloc}'.format(scheme=parsed.scheme,
+                                            netloc=parsed.netloc)
+
+        key = self._mirror_key(provider)
+        if self.app.variables.get(key, default=None) != base:
+            self.app.variables.set(key, base)
+
+    def _observe_latency(self, uri, latency):
+        provider = self._health_hosts.get(parse.urlparse(uri).hostname)
+        if provider is not None:
+            self.health.record_latency(provider, latency)
+
+    @asyncio.coroutine
+    def get_data_from_uri(self, origin, uri):
+        """ Get normalized data from URI using origin.
+
+        Fetches the URI with Importer.get_buffer_from_uri and parses its
+        content with Importer.get_data_from_buffer.
+
+        Results are memorized for 'importer.memo-ttl' seconds, requests for
+        the same URI (and provider) in that period (ex. overlapping queries)
+        are served from memory.
+
+        Return:
+          A tuple (origin, uri, data) where data is a (maybe empty) list of
+          normalized psources.
+        """
+        ttl = self.app.settings.get('importer.memo-ttl', default=0)
+        if ttl <= 0:
+            data = yield from self._get_data_from_uri(origin, uri)
+            return (origin, uri, data or [])
+
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+
+        self._data_memo = {k: v for (k, v) in self._data_memo.items()
+                           if v[0] > now}
+
+        key = (origin.provider.__extension_name__,
+               uritools.normalize(uri),
+               tuple(sorted(origin.overrides.items())))
+
+        try:
+            expiration, fut = self._data_memo[key]
+            msg = "Using memorized data for «{uri}»"
+            msg = msg.format(uri=uri)
+            self.logger.debug(msg)
+            self.stats.incr(importstats.Counter.MEMO_HITS, origin=origin)
+
+        except KeyError:
+            fut = asyncio.ensure_future(self._get_data_from_uri(origin, uri))
+            self._data_memo[key] = (now + ttl, fut)
+
+        data = yield from asyncio.shield(fut)
+
+        # Failed fetches are not memorized
+        if data is None:
+            if self._data_memo.get(key, (None, None))[1] is fut:
+                del self._data_memo[key]
+            return (origin, uri, [])
+
+        # Data is modified by later stages, return copies
+        return (origin, uri, [dict(x) for x in data])
+
+    @asyncio.coroutine
+    def _get_data_from_uri(self, origin, uri):
+        # Returns None if fetch fails
+        origin, uri, buff = yield from self.get_buffer_from_uri(origin, uri)
+        if isinstance(buff, Exception):
+            return None
+
+        data = yield from self.get_data_from_buffer(origin, uri, buff)
+        return data
+
+    def iter_uris_from_origin(self, origin):
+        """ Generate all URIs needed from origin.
+
+        An Origin can have several 'pages' or iterations, its provider is
+        responsable of the pagination.
 
         Arguments:
           origin - The origin to process.
         Return:
-          A list of tuples for each URI, see Importer.get_buffer_from_uri for
-          information about those tuples.
+          A generator of (origin, uri) tuples
         """
         g = origin.provider.paginate(origin.uri)
         iterations = max(1, origin.iterations)
@@ -307,11 +622,9 @@ class Importer:
         # Generator can raise StopIteration before iterations is reached.
         # We use a for loop instead of a comprehension expression to catch
         # gracefully this situation.
-        tasks = []
         for i in range(iterations):
             try:
                 uri = next(g)
-                tasks.append(self.get_buffer_from_uri(origin, uri))
             except StopIteration:
                 msg = ("{provider} has stopped the pagination after "
                        "iteration #{index}")
@@ -319,78 +632,543 @@ class Importer:
                 self.logger.warning(msg)
                 break
 
+            yield (origin, uri)
+
+    def iter_uris_from_origins(self, *origins):
+        """ Generate all URIs needed from origins.
+
+        URIs from each origin are interleaved so a long origin doesn't delay
+        the first pages of the others.
+
+        Arguments:
+          origins - Origins to process.
+        Return:
+          A generator of (origin, uri) tuples
+        """
+        gens = [self.iter_uris_from_origin(origin) for origin in origins]
+
+        while gens:
+            for g in gens[:]:
+                try:
+                    yield next(g)
+                except StopIteration:
+                    gens.remove(g)
+
+    @asyncio.coroutine
+    def get_buffers_from_origin(self, origin):
+        """ Get all buffers from origin.
+
+        This methods calls Importer.get_buffer_from_uri for each URI
+        generated by Importer.iter_uris_from_origin
+
+        Arguments:
+          origin - The origin to process.
+        Return:
+          A list of tuples for each URI, see Importer.get_buffer_from_uri for
+          information about those tuples.
+        """
+        tasks = [self.get_buffer_from_uri(origin, uri)
+                 for (origin, uri) in self.iter_uris_from_origin(origin)]
+
         ret = yield from asyncio.gather(*tasks)
         return ret
 
-    def get_data_from_origin(self, *origins):
-        results = []
+    @asyncio.coroutine
+    def get_data_from_origin_incrementally(self, origin):
+        """ Get normalized data from origin stopping at already known data.
 
-        @asyncio.coroutine
-        def collect(origin):
-            res = yield from self.get_buffers_from_origin(origin)
-            results.extend(res)
+        Pages are fetched in order, one at a time. Pagination stops when all
+        sources from a page are already in the database or when the newest
+        source in a page is older than the origin's watermark (the newest
+        source seen in the previous run). This assumes that origin is sorted
+        from newest to oldest.
 
-        tasks = [collect(o) for o in origins]
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(asyncio.gather(*tasks))
+        Only sources with a 'created' value from the provider count for the
+        watermark. Providers without dates (sources get the import time, see
+        Importer._process_create_contexts) only stop at known sources.
 
-        data = []
-        for (origin, uri, res) in results:
-            if isinstance(res, Exception) or res is None or res == '':
-                continue
+        The new watermark is not stored until Importer.commit_watermarks is
+        called.
 
-            try:
-                res = origin.provider.parse(res)
+        Arguments:
+          origin - The origin to process.
+        Return:
+          A list of (origin, uri, data) tuples, see
+          Importer.get_data_from_uri
+        """
+        watermark = self.get_watermark(origin)
+        newest = watermark
+        ret = []
 
-            except Exception as e:
-                print(traceback.format_exc(), file=sys.stderr)
-                msg = "Unhandled exception {type}: {e}"
-                msg = msg.format(type=type(e), e=e)
-                self.logger.critical(msg)
-                continue
+        for (origin, uri) in self.iter_uris_from_origin(origin):
+            origin, uri, buff = yield from self.get_buffer_from_uri(origin,
+                                                                    uri)
+            if isinstance(buff, fetchcache.NotModified):
+                msg = "«{uri}» not modified since last fetch, stop pagination"
+                msg = msg.format(uri=uri)
+                self.logger.info(msg)
+                break
 
-            if res is None:
-                msg = ("Incorrect API usage in {origin}, return None is not "
-                       "allowed. Raise an Exception or return [] if no "
-                       "sources are found")
-                msg = msg.format(origin=origin)
-                self.logger.critical(msg)
-                continue
+            data = yield from self.get_data_from_buffer(origin, uri, buff)
+            ret.append((origin, uri, data))
 
-            if not isinstance(res, list):
-                msg = "Invalid data type for URI «{uri}»: '{type}'"
-                msg = msg.format(uri=uri, type=res.__class__.__name__)
-                self.logger.critical(msg)
+            if not data:
                 continue
 
-            if len(res) == 0:
-                msg = "No sources found in «{uri}»"
+            dates = [x['created'] for x in data if x['created'] is not None]
+            page_newest = max(dates) if dates else None
+            if page_newest is not None:
+                newest = max(newest or 0, page_newest)
+
+            discriminators = set(x['_discriminator'] for x in data)
+            known = self.get_known_discriminators(discriminators)
+
+            if known == discriminators:
+                msg = "All sources from «{uri}» are known, stop pagination"
                 msg = msg.format(uri=uri)
-                self.logger.warning(msg)
-                continue
+                self.logger.info(msg)
+                break
 
-            res = self._normalize_source_data(origin, *res)
-            data.extend(res)
+            if (watermark is not None and page_newest is not None and
+                    page_newest < watermark):
+                msg = ("Sources from «{uri}» are older than last scan, stop "
+                       "pagination")
+                msg = msg.format(uri=uri)
+                self.logger.info(msg)
+                break
+
+        if newest is not None and newest != watermark:
+            self._pending_watermarks[origin.uri] = newest
+
+        return ret
+
+    def get_known_discriminators(self, discriminators):
+        """ Get discriminators already present in the database.
+
+        Arguments:
+          discriminators - Iterable of discriminators.
+        Return:
+          A set with those discriminators found in the database.
+        """
+        query = self.app.db.session.query(models.Source._discriminator)
+        return set(x for (x,) in self._query_by_discriminator(
+            query, discriminators))
+
+    def _query_by_discriminator(self, query, discriminators):
+        """ Filter query for sources matching discriminators.
+
+        Source._discriminator is an expression (coalesce(urn, uri)) and
+        can't be served by any index. Instead, discriminators are looked up
+        in chunks against the indexed urn and uri columns: a source matches
+        a discriminator if its urn is equal to it or, for sources without
+        urn, if its uri is equal to it.
+
+        Arguments:
+          query - A query over models.Source or some of its columns.
+          discriminators - Iterable of discriminators.
+        Return:
+          A generator of results from query
+        """
+        discriminators = list(discriminators)
+
+        for idx in range(0, len(discriminators), _BULK_CHUNK_SIZE):
+            chunk = discriminators[idx:idx+_BULK_CHUNK_SIZE]
+
+            yield from query.filter(models.Source.urn.in_(chunk))
+            yield from query.filter(models.Source.urn.is_(None),
+                                    models.Source.uri.in_(chunk))
+
+    def get_watermark(self, origin):
+        """ Get newest 'created' value seen in the last incremental scan
+        of origin or None.
+        """
+        return self.app.variables.get(
+            'importer.watermark.{uri}'.format(uri=origin.uri),
+            default=None)
+
+    def commit_watermarks(self):
+        """ Store watermarks from incremental origins.
 
-            msg = "{n} sources found at {uri}"
-            msg = msg.format(n=len(res), uri=uri)
+        Must be called once its data has been written into database.
+        """
+        for (uri, value) in self._pending_watermarks.items():
+            self.app.variables.set(
+                'importer.watermark.{uri}'.format(uri=uri),
+                value)
+
+        self._pending_watermarks = {}
+
+    @property
+    def parse_executor(self):
+        """ Process pool used to parse buffers.
+
+        Its size is controlled by 'importer.parse-workers' setting: 0 disables
+        the pool (buffers are parsed in the main process) and a negative
+        value uses one worker for each CPU.
+        """
+        if self._parse_executor is None:
+            workers = self.app.settings.get('importer.parse-workers',
+                                            default=0)
+            if workers < 0:
+                workers = os.cpu_count() or 1
+
+            if workers > 0:
+                self._parse_executor = futures.ProcessPoolExecutor(
+                    max_workers=workers)
+                msg = "Using {n} process(es) for parsing"
+                msg = msg.format(n=workers)
+                self.logger.debug(msg)
+            else:
+                self._parse_executor = False
+
+        return self._parse_executor or None
+
+    @asyncio.coroutine
+    def parse_buffer(self, origin, buff):
+        """ Parse buff with origin's provider.
+
+        If the provider is pool-safe and a parse executor is available the
+        buffer is parsed in a worker process without blocking the event loop.
+
+        Return:
+          The result of origin.provider.parse
+        """
+        executor = self.parse_executor
+        provider = origin.provider
+
+        if executor is None or not provider.POOL_SAFE:
+            return provider.parse(buff)
+
+        if self._parse_settings is None:
+            self._parse_settings = {
+                k: self.app.settings.get(k)
+                for k in self.app.settings.all_keys()
+            }
+
+        loop = asyncio.get_event_loop()
+        ret = yield from loop.run_in_executor(
+            executor, _parse_in_worker,
+            provider.__class__, self._parse_settings, buff)
+        return ret
+
+    @asyncio.coroutine
+    def get_data_from_buffer(self, origin, uri, buff):
+        """ Parse and normalize a buffer fetched from uri.
+
+        Arguments:
+          origin - The origin used to fetch buff.
+          uri - The URI where buff comes from.
+          buff - Result from Importer.get_buffer_from_uri
+        Return:
+          A (maybe empty) list of normalized psources.
+        """
+        if isinstance(buff, Exception) or buff is None or buff == '':
+            return []
+
+        if isinstance(buff, fetchcache.NotModified):
+            msg = "«{uri}» not modified since last fetch, skipping"
+            msg = msg.format(uri=uri)
             self.logger.info(msg)
+            return []
+
+        try:
+            with self.stats.span(importstats.Stage.PARSE, origin=origin):
+                res = yield from self.parse_buffer(origin, buff)
+
+        except Exception as e:
+            print(traceback.format_exc(), file=sys.stderr)
+            msg = "Unhandled exception {type}: {e}"
+            msg = msg.format(type=type(e), e=e)
+            self.logger.critical(msg)
+            return []
+
+        if res is None:
+            msg = ("Incorrect API usage in {origin}, return None is not "
+                   "allowed. Raise an Exception or return [] if no "
+                   "sources are found")
+            msg = msg.format(origin=origin)
+            self.logger.critical(msg)
+            return []
+
+        if not isinstance(res, list):
+            msg = "Invalid data type for URI «{uri}»: '{type}'"
+            msg = msg.format(uri=uri, type=res.__class__.__name__)
+            self.logger.critical(msg)
+            return []
+
+        if len(res) == 0:
+            msg = "No sources found in «{uri}»"
+            msg = msg.format(uri=uri)
+            self.logger.warning(msg)
+            return []
+
+        with self.stats.span(importstats.Stage.NORMALIZE, origin=origin):
+            res = self._normalize_source_data(origin, *res)
+
+        self.stats.incr(importstats.Counter.PSOURCES, len(res),
+                        origin=origin)
+
+        msg = "{n} sources found at {uri}"
+        msg = msg.format(n=len(res), uri=uri)
+        self.logger.info(msg)
+
+        return res
+
+    def get_data_from_origin(self, *origins):
+        regular = [x for x in origins if not x.incremental]
+        incremental = [x for x in origins if x.incremental]
+
+        tasks = [
+            self.get_data_from_uri(origin, uri)
+            for (origin, uri) in self.iter_uris_from_origins(*regular)
+        ]
+        incremental_tasks = [
+            self.get_data_from_origin_incrementally(origin)
+            for origin in incremental
+        ]
+
+        loop = asyncio.get_event_loop()
+        results, incremental_results = loop.run_until_complete(
+            asyncio.gather(asyncio.gather(*tasks),
+                           asyncio.gather(*incremental_tasks)))
+
+        for x in incremental_results:
+            results.extend(x)
+
+        data = []
+        for (origin, uri, res) in results:
+            data.extend(res)
 
         return data
 
     def process(self, *origins):
-        data = self.get_data_from_origin(*origins)
-        return self.process_source_data(*data)
+        """ Import origins.
+
+        Return:
+          The ImportStats of the run. Sources themselves are not returned,
+          with 'importer.streaming' they are never kept all at once (see
+          Importer.process_streaming).
+        """
+        self.stats = importstats.ImportStats()
+        fetcher_counters = collections.Counter(
+            getattr(self.app.fetcher, 'counters', {}))
+
+        try:
+            if self.app.settings.get('importer.streaming', default=False):
+                self.process_streaming(*origins)
+
+            else:
+                data = self.get_data_from_origin(*origins)
+                self.process_source_data(*data)
+                self.commit_watermarks()
+
+        finally:
+            self.health.save()
+
+            # Watermarks from a failed run must not be stored later
+            self._pending_watermarks = {}
+
+        # Fresh cache hits don't reach the importer, take them from fetcher
+        delta = collections.Counter(
+            getattr(self.app.fetcher, 'counters', {}))
+        delta.subtract(fetcher_counters)
+        self.stats.incr(importstats.Counter.CACHE_HITS,
+                        delta[importstats.Counter.CACHE_HITS])
+
+        self.save_stats()
+        return self.stats
+
+    def save_stats(self):
+        """ Store stats from the current run in the database.
+
+        Only the last 'importer.stats-history' runs are kept, 0 disables
+        history.
+        """
+        self.stats.finish()
+
+        history = self.app.settings.get('importer.stats-history', default=0)
+        if history <= 0:
+            return
+
+        session = self.app.db.session
+
+        run = models.ImportRun(started=int(self.stats.started),
+                               duration=self.stats.duration)
+        run.stats = self.stats.asdict()
+        session.add(run)
+        session.flush()
+
+        old = session.query(models.ImportRun.id)
+        old = old.order_by(models.ImportRun.started.desc(),
+                           models.ImportRun.id.desc())
+        old = [x for (x,) in old.offset(history)]
+        if old:
+            query = session.query(models.ImportRun)
+            query = query.filter(models.ImportRun.id.in_(old))
+            query.delete(synchronize_session=False)
+
+        session.commit()
+
+    def process_streaming(self, *origins):
+        """ Import origins processing each page as soon as it's fetched.
+
+        Unlike Importer.process, data from each URI is parsed, normalized and
+        written into the database as soon as its fetch finishes. No more than
+        'importer.streaming-window' URIs are in flight at any time, so memory
+        usage is bounded by the window size and not by the whole crawl.
+
+        Fetched data is handed through a queue to a single consumer which
+        writes it into the database from a worker thread (with its own
+        session, see Db.session), so in-flight fetches keep running
+        meanwhile. Databases with a single connection (in-memory SQLite) are
+        written from the event loop instead.
+
+        Incremental origins are fetched page by page as a single job, its
+        data is processed once its pagination stops.
+
+        Arguments:
+          origins - Origins to process.
+        Return:
+          Number of sources processed. Sources themselves are not kept, a
+          large crawl would keep all of them in memory.
+        """
+        window = self.app.settings.get('importer.streaming-window',
+                                       default=10)
+        window = max(1, window)
+        uris = self.iter_uris_from_origins(
+            *[x for x in origins if not x.incremental])
+
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(maxsize=window)
+
+        if self.app.db.single_connection:
+            executor = None
+        else:
+            executor = futures.ThreadPoolExecutor(max_workers=1)
+
+        def _process(data):
+            try:
+                return len(self.process_source_data(*data))
+            finally:
+                # Return worker's connection to the pool
+                self.app.db.session.remove()
+
+        @asyncio.coroutine
+        def consume():
+            n = 0
+
+            while True:
+                data = yield from queue.get()
+                if data is None:
+                    return n
+
+                if executor is None:
+                    n += len(self.process_source_data(*data))
+                else:
+                    n += yield from loop.run_in_executor(
+                        executor, _process, data)
+
+        @asyncio.coroutine
+        def incremental(origin):
+            results = yield from self.get_data_from_origin_incrementally(
+                origin)
+            data = []
+            for (origin, uri, res) in results:
+                data.extend(res)
+
+            if data:
+                yield from queue.put(data)
+
+        @asyncio.coroutine
+        def stream():
+            pending = set()
+
+            while True:
+                for (origin, uri) in uris:
+                    pending.add(asyncio.ensure_future(
+                        self.get_data_from_uri(origin, uri)))
+                    if len(pending) >= window:
+                        break
+
+                if not pending:
+                    break
+
+                done, pending = yield from asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    origin, uri, data = task.result()
+                    if data:
+                        yield from queue.put(data)
+
+        @asyncio.coroutine
+        def produce():
+            jobs = [stream()]
+            jobs.extend([incremental(x) for x in origins if x.incremental])
+
+            try:
+                yield from asyncio.gather(*jobs)
+            finally:
+                yield from queue.put(None)
+
+        try:
+            n, dummy = loop.run_until_complete(
+                asyncio.gather(consume(), produce()))
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+        self.commit_watermarks()
+
+        return n
 
     def process_source_data(self, *data):
-        psources_data = self._process_remove_duplicates(data)
-        contexts = self._process_create_contexts(psources_data)
-        self._process_insert_existing_sources(contexts)
-        self._process_update_existing_sources(contexts)
-        self._process_insert_new_sources(contexts)
+        Stage = importstats.Stage
+
+        with self.stats.span(Stage.DB_CONTEXTS):
+            psources_data = self._process_remove_duplicates(data)
+
+        if self.app.settings.get('importer.bulk-upsert', default=False) and \
+           self.bulk_upsert_dialect:
+            return self._process_bulk_upsert(psources_data)
+
+        with self.stats.span(Stage.DB_CONTEXTS):
+            contexts = self._process_create_contexts(psources_data)
+        with self.stats.span(Stage.DB_EXISTING):
+            self._process_insert_existing_sources(contexts)
+        with self.stats.span(Stage.DB_UPDATE):
+            self._process_update_existing_sources(contexts)
+        with self.stats.span(Stage.DB_INSERT):
+            self._process_insert_new_sources(contexts)
 
         return self._process_finalize(contexts)
 
+    @property
+    def bulk_upsert_dialect(self):
+        """ Database dialect name if it supports 'INSERT ... ON CONFLICT DO
+        UPDATE' (SQLite 3.24+, PostgreSQL 9.5+) or None.
+        """
+        if self._bulk_upsert_dialect is None:
+            dialect = self.app.db.session.get_bind().dialect
+            version = getattr(dialect, 'server_version_info', None) or ()
+
+            if dialect.name == 'sqlite':
+                supported = sqlite3.sqlite_version_info >= (3, 24, 0)
+            elif dialect.name == 'postgresql':
+                supported = tuple(version) >= (9, 5)
+            else:
+                supported = False
+
+            if supported:
+                self._bulk_upsert_dialect = dialect.name
+            else:
+                msg = ("Bulk upsert is not supported by this database, using "
+                       "the regular code path")
+                self.logger.warning(msg)
+                self._bulk_upsert_dialect = False
+
+        return self._bulk_upsert_dialect or None
+
     def resolve_source(self, source):
         def _update_source(data):
             keys = 'language leechers seeds size type uri urn'.split()
@@ -402,6 +1180,7 @@ class Importer:
                                          uri=source.uri)
 
         data = self.get_data_from_origin(origin)
+        self.health.save()
         data = self._process_remove_duplicates(data)
         contexts = self._process_create_contexts(data)
         self._process_insert_existing_sources(contexts)
@@ -426,11 +1205,72 @@ class Importer:
         if not origins:
             msg = "No origins defined"
             self.logger.warning(msg)
-            return []
+            return None
 
         origins = (origin for (dummy, origin) in origins)
         return self.process(*origins)
 
+    def get_due_origins(self, now=None):
+        """ Get origins from config that should be processed now.
+
+        Each origin is scheduled independently based on its interval (or
+        'importer.default-interval'), its next run is stored in variables.
+
+        Return:
+          A list of (name, origin) tuples ordered by priority (higher first).
+        """
+        now = now or utils.now_timestamp()
+        ret = []
+
+        for (name, origin) in self.origins_from_config():
+            state = self.app.variables.get(
+                'importer.schedule.{name}'.format(name=name),
+                default={})
+
+            if state.get('next-run', 0) <= now:
+                ret.append((name, origin))
+
+        return sorted(ret, key=lambda x: x[1].priority, reverse=True)
+
+    def run_scheduled(self):
+        """ Process origins from config due for processing.
+
+        See Importer.get_due_origins
+
+        Return:
+          The ImportStats of the run (see Importer.process) or None if no
+          origin is due.
+        """
+        now = utils.now_timestamp()
+
+        due = self.get_due_origins(now=now)
+        if not due:
+            msg = "No origins scheduled for now"
+            self.logger.debug(msg)
+            return None
+
+        msg = "Scheduled origins: {names}"
+        msg = msg.format(names=', '.join([name for (name, origin) in due]))
+        self.logger.info(msg)
+
+        ret = self.process(*[origin for (name, origin) in due])
+
+        default_interval = utils.parse_interval(self.app.settings.get(
+            'importer.default-interval', default='3H'))
+
+        for (name, origin) in due:
+            interval = origin.interval
+            if interval is None:
+                interval = default_interval
+
+            # Jitter spreads origins with the same interval over time
+            next_run = now + interval + random.randint(0, origin.jitter)
+            self.app.variables.set(
+                'importer.schedule.{name}'.format(name=name),
+                {'last-run': now, 'next-run': next_run})
+
+        return ret
+
     def _normalize_source_data(self, origin, *psrcs):
         """ Normalize input data for given origin.
 
@@ -459,7 +1299,6 @@ class Importer:
         ]))
 
         ret = []
-        now = utils.now_timestamp()
 
         for psrc in psrcs:
             if not isinstance(psrc, dict):
@@ -547,8 +1386,9 @@ class Importer:
             except KeyError:
                 pass
 
-            # Fix created
-            psrc['created'] = psrc.get('created', None) or now
+            # Sources without created get the import time later, see
+            # Importer._process_create_contexts
+            psrc['created'] = psrc['created'] or None
 
             # Set discriminator
             psrc['_discriminator'] = psrc.get('urn') or psrc.get('uri')
@@ -563,7 +1403,8 @@ class Importer:
         """ Remove duplicated sources.
 
         Filter psource list to exclude duplicates.
-        The duplicated with the newest stamp (the 'created' key) is keeped.
+        The duplicated with the newest stamp (the 'created' key) is keeped,
+        sources without it are older than any other.
 
         Args:
           psource - List of dicts representing proto-sources.
@@ -577,7 +1418,8 @@ class Importer:
             assert key is not None
 
             # Keep the most recent if case of duplicated
-            if key not in ret or psrc['created'] > ret[key]['created']:
+            if key not in ret or \
+               (psrc['created'] or 0) > (ret[key]['created'] or 0):
                 ret[key] = psrc
 
         return list(ret.values())
@@ -619,17 +1461,10 @@ class Importer:
           contexts - List of contexts
         """
 
-        # Check there is any context because the in_ below
-        # warns about empty 'in' clauses
-        if not contexts:
-            return
-
         table = {ctx.discriminator: ctx for ctx in contexts}
-        existing = self.app.db.session.query(models.Source).filter(
-            models.Source._discriminator.in_(table.keys())
-        ).all()
+        query = self.app.db.session.query(models.Source)
 
-        for src in existing:
+        for src in self._query_by_discriminator(query, table.keys()):
             table[src._discriminator].source = src
 
     def _process_update_existing_sources(self, contexts):
@@ -691,6 +1526,144 @@ class Importer:
             ctx.source = models.Source(**ctx.data)
             ctx.tags.append(_ProcessingTag.ADDED)
 
+    def _process_bulk_upsert(self, psources):
+        """ Alternative to the _process_* stages using bulk statements.
+
+        Sources are written with 'INSERT ... ON CONFLICT DO UPDATE'
+        statements (one executemany for sources with URN and another one for
+        sources without it) following the same update rules as
+        _process_update_existing_sources. ORM objects are only loaded
+        afterwards for _process_finalize.
+
+        Args:
+          psources - List of data (or pseudo-sources) without duplicates.
+        Returns:
+          List of sources, see _process_finalize.
+        """
+        with self.stats.span(importstats.Stage.DB_CONTEXTS):
+            contexts = self._process_create_contexts(psources)
+        if not contexts:
+            return []
+
+        session = self.app.db.session
+        session.flush()
+
+        valid = []
+        for ctx in contexts:
+            try:
+                valid.append((ctx, self._bulk_upsert_row(ctx.data)))
+            except (TypeError, ValueError) as e:
+                msg = "Invalid data for «{name}»: {e}"
+                msg = msg.format(name=ctx.data.get('name'), e=e)
+                self.logger.error(msg)
+
+        # Rows without urn conflict on uri, also with sources having an urn
+        # (those are not found by its discriminator)
+        with self.stats.span(importstats.Stage.DB_EXISTING):
+            existing = self._get_existing_source_rows(
+                [ctx.discriminator for (ctx, row) in valid])
+            existing_by_uri = self._get_existing_source_rows(
+                [row['uri'] for (ctx, row) in valid
+                 if not row['urn'] and ctx.discriminator not in existing],
+                by_uri=True)
+
+        rows = {'urn': [], 'uri': []}
+
+        for (ctx, row) in valid:
+            old = existing.get(ctx.discriminator)
+            if old is None and not row['urn']:
+                old = existing_by_uri.get(row['uri'])
+
+            if old is None:
+                ctx.tags.append(_ProcessingTag.ADDED)
+
+            else:
+                if old['name'] != row['name']:
+                    ctx.tags.append(_ProcessingTag.NAME_UPDATED)
+
+                if _bulk_upsert_changes(old, row):
+                    ctx.tags.append(_ProcessingTag.UPDATED)
+
+            rows['urn' if row['urn'] else 'uri'].append(row)
+
+        valid = [ctx for (ctx, row) in valid]
+
+        with self.stats.span(importstats.Stage.DB_UPSERT):
+            for (target, target_rows) in rows.items():
+                if target_rows:
+                    stmt = _bulk_upsert_statement(self.bulk_upsert_dialect,
+                                                  target)
+                    session.execute(stmt, target_rows)
+
+        # Load ORM objects for the remaining stages. Objects already in the
+        # session are refreshed with the values written above.
+        # uri is used as key because it's unique, indexed and always
+        # written by the upsert
+        uris = [ctx.data['uri'] for ctx in valid]
+        sources = {}
+        with self.stats.span(importstats.Stage.DB_EXISTING):
+            for idx in range(0, len(uris), _BULK_CHUNK_SIZE):
+                chunk = uris[idx:idx+_BULK_CHUNK_SIZE]
+                query = session.query(models.Source).populate_existing()
+                query = query.filter(models.Source.uri.in_(chunk))
+                sources.update({src.uri: src for src in query})
+
+        for ctx in valid:
+            ctx.source = sources[ctx.data['uri']]
+
+        return self._process_finalize(valid)
+
+    def _get_existing_source_rows(self, discriminators, by_uri=False):
+        """ Get column values of existing sources.
+
+        Args:
+          discriminators - List of discriminators.
+          by_uri - Match discriminators against uri only, even for sources
+                   with urn.
+        Returns:
+          A dict discriminator (or uri) -> dict with source column values.
+        """
+        columns = [getattr(models.Source, x)
+                   for x in ['id'] + _BULK_UPSERT_COLUMNS]
+
+        if by_uri:
+            key = models.Source.uri
+        else:
+            key = models.Source._discriminator
+
+        query = self.app.db.session.query(key.label('_key'), *columns)
+
+        if by_uri:
+            results = (
+                row
+                for idx in range(0, len(discriminators), _BULK_CHUNK_SIZE)
+                for row in query.filter(models.Source.uri.in_(
+                    discriminators[idx:idx+_BULK_CHUNK_SIZE]))
+            )
+        else:
+            results = self._query_by_discriminator(query, discriminators)
+
+        ret = {}
+        for row in results:
+            row = row._asdict()
+            ret[row.pop('_key')] = row
+
+        return ret
+
+    def _bulk_upsert_row(self, data):
+        row = {k: data.get(k) for k in _BULK_UPSERT_COLUMNS}
+
+        # Same validation as models.Source
+        for k in ['name', 'provider', 'urn', 'uri', 'language', 'type']:
+            if row[k] is not None:
+                row[k] = models.Source.normalize(k, row[k])
+
+        for k in ['created', 'last_seen', 'size', 'seeds', 'leechers']:
+            if row[k] is not None:
+                row[k] = int(row[k])
+
+        return row
+
     def _process_finalize(self, contexts):
         """ Final stage of processing.
 
@@ -724,11 +1697,20 @@ class Importer:
         ]
 
         if sources_and_metas:
-            self.app.mediainfo.process(*sources_and_metas)
+            with self.stats.span(importstats.Stage.MEDIAINFO):
+                self.app.mediainfo.process(*sources_and_metas)
 
         # It's important to call commit here, Mediainfo.process doesn't do a
         # commit
-        self.app.db.session.commit()
+        with self.stats.span(importstats.Stage.DB_COMMIT):
+            self.app.db.session.commit()
+
+        self.stats.incr(importstats.Counter.ADDED, len(added))
+        self.stats.incr(importstats.Counter.UPDATED,
+                        len(set(updated + name_updated)))
+        self.stats.incr(importstats.Counter.SKIPPED,
+                        len(contexts) - len(set(added + updated +
+                                                name_updated)))
 
         self.app.signals.send(
             'sources-added-batch',
@@ -751,6 +1733,99 @@ class Importer:
         return ret
 
 
+# Max number of elements for 'IN' clauses, some databases (ex. sqlite) have
+# a limit for the number of variables in a statement
+_BULK_CHUNK_SIZE = 500
+
+_BULK_UPSERT_COLUMNS = [
+    'provider', 'name', 'created', 'last_seen', 'urn', 'uri', 'size',
+    'seeds', 'leechers', 'type', 'language'
+]
+
+
+def _bulk_upsert_changes(old, row):
+    """Check if row modifies old, see
+    Importer._process_update_existing_sources"""
+    for (key, new_value) in row.items():
+        if key == 'created' and \
+           old['created'] is not None and \
+           old['created'] < new_value:
+            continue
+
+        if new_value and new_value != old[key]:
+            return True
+
+    return False
+
+
+def _bulk_upsert_statement(dialect, target):
+    """Build 'INSERT ... ON CONFLICT DO UPDATE' statement for source table.
+
+    Existing values are only overridden by non-empty new values, 'created'
+    keeps the oldest value.
+
+    Arguments:
+      dialect - 'sqlite' or 'postgresql'
+      target - Unique column for conflicts: 'urn' or 'uri'
+    """
+    least = 'MIN' if dialect == 'sqlite' else 'LEAST'
+    strings = ['provider', 'name', 'urn', 'uri', 'type', 'language']
+
+    updates = []
+    for col in _BULK_UPSERT_COLUMNS:
+        if col == target:
+            continue
+
+        if col == 'created':
+            # MIN() in sqlite returns NULL if any argument is NULL
+            expr = ('COALESCE({least}(source.created, excluded.created), '
+                    'excluded.created, source.created)')
+            expr = expr.format(least=least)
+        else:
+            empty = "''" if col in strings else '0'
+            expr = 'COALESCE(NULLIF(excluded.{col}, {empty}), source.{col})'
+            expr = expr.format(col=col, empty=empty)
+
+        updates.append('{col} = {expr}'.format(col=col, expr=expr))
+
+    stmt = ("INSERT INTO source ({columns}) VALUES ({values}) "
+            "ON CONFLICT ({target}) DO UPDATE SET {updates}")
+    stmt = stmt.format(
+        columns=', '.join(_BULK_UPSERT_COLUMNS),
+        values=', '.join(':' + x for x in _BULK_UPSERT_COLUMNS),
+        target=target,
+        updates=', '.join(updates))
+
+    return sqlalchemy.text(stmt)
+
+
+class _ParseWorkerSettings(dict):
+    def get(self, key, default=None):
+        return super().get(key, default)
+
+
+class _ParseWorkerApp:
+    """Minimal application object for providers living in a parse worker"""
+    def __init__(self, settings):
+        self.settings = _ParseWorkerSettings(settings)
+        self.logger = loggertools.getLogger('arroyo')
+        self.fetcher = None
+
+
+# Provider instances for the current parse worker process
+_worker_providers = {}
+
+
+def _parse_in_worker(provider_cls, settings, buff):
+    try:
+        provider = _worker_providers[provider_cls]
+    except KeyError:
+        provider = provider_cls(_ParseWorkerApp(settings))
+        _worker_providers[provider_cls] = provider
+
+    return provider.parse(buff)
+
+
 class _ProcessingContext:
     def __init__(self, data=None, discriminator=None, meta=None, source=None,
                  tags=None):
@@ -783,7 +1858,9 @@ class _ProcessingTag(enum.Enum):
 
 class ImporterCronTask(kit.Task):
     __extension_name__ = 'importer'
-    INTERVAL = '3H'
+
+    # Origins have its own schedule, this is just the granularity
+    INTERVAL = '5M'
 
     def execute(self, app):
-        app.importer.run()
+        app.importer.run_scheduled()
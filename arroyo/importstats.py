@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import collections
+import contextlib
+import time
+
+
+# Key for stages and counters not related to a single origin (ex. database
+# stages, they process data from all origins at once)
+RUN = '*'
+
+
+class Stage:
+    FETCH = 'fetch'
+    PARSE = 'parse'
+    NORMALIZE = 'normalize'
+    DB_CONTEXTS = 'db-contexts'
+    DB_EXISTING = 'db-existing'
+    DB_UPDATE = 'db-update'
+    DB_INSERT = 'db-insert'
+    DB_UPSERT = 'db-upsert'
+    DB_COMMIT = 'db-commit'
+    MEDIAINFO = 'mediainfo'
+
+
+class Counter:
+    REQUESTS = 'requests'
+    ERRORS = 'errors'
+    BYTES = 'bytes'
+    CACHE_HITS = 'cache-hits'
+    NOT_MODIFIED = 'not-modified'
+    MEMO_HITS = 'memo-hits'
+    PSOURCES = 'psources'
+    ADDED = 'added'
+    UPDATED = 'updated'
+    SKIPPED = 'skipped'
+
+
+class ImportStats:
+    """Timings and counters of an import run.
+
+    Both are grouped by origin (its URI) or RUN for stages processing data
+    from all origins.
+
+    Timings are accumulated in seconds along with the number of calls, since
+    fetches run concurrently the sum of fetch timings can be longer than the
+    whole run.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._start_clock = time.perf_counter()
+        self.duration = None
+
+        # key -> stage -> [seconds, calls]
+        self.timings = collections.defaultdict(
+            lambda: collections.defaultdict(lambda: [0.0, 0]))
+
+        # key -> counter -> value
+        self.counters = collections.defaultdict(collections.Counter)
+
+    @staticmethod
+    def key_for(origin):
+        if origin is None:
+            return RUN
+
+        return origin.uri
+
+    @contextlib.contextmanager
+    def span(self, stage, origin=None):
+        """Time the enclosed block as stage of origin"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start, origin=origin)
+
+    def add_time(self, stage, seconds, origin=None):
+        timing = self.timings[self.key_for(origin)][stage]
+        timing[0] += seconds
+        timing[1] += 1
+
+    def incr(self, counter, n=1, origin=None):
+        self.counters[self.key_for(origin)][counter] += n
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start_clock
+
+    def asdict(self):
+        keys = set(self.timings) | set(self.counters)
+
+        return {
+            key: {
+                'timings': dict(self.timings.get(key, {})),
+                'counters': dict(self.counters.get(key, {}))
+            }
+            for key in keys
+        }
+
+
+def summarize(runs):
+    """Aggregate stats from several runs.
+
+    Arguments:
+      runs - List of dicts from ImportStats.asdict
+    Return:
+      A dict key -> {'timings': {stage: [seconds, calls]},
+      'counters': {counter: value}}
+    """
+    ret = {}
+
+    for run in runs:
+        for (key, data) in run.items():
+            agg = ret.setdefault(key, {'timings': {}, 'counters': {}})
+
+            for (stage, (seconds, calls)) in data['timings'].items():
+                timing = agg['timings'].setdefault(stage, [0.0, 0])
+                timing[0] += seconds
+                timing[1] += calls
+
+            for (counter, value) in data['counters'].items():
+                agg['counters'][counter] = \
+                    agg['counters'].get(counter, 0) + value
+
+    return ret
@@ -21,17 +21,30 @@
 from arroyo import models
 
 
+import collections
 import functools
+import hashlib
+import json
+import os
+import pickle
+import re
 import warnings
+from concurrent import futures
 
 
 import babelfish
 import guessit
+import sqlalchemy
 from appkit import loggertools
+from sqlalchemy.dialects import postgresql
 
 
 _SOURCE_TAGS_PREFIX = 'core.'
 
+# Bump this if parse() results change for the same input (not needed for
+# guessit upgrades or METADATA_RULES changes), see parser_version()
+PARSER_VERSION = 4
+
 
 class Tags:
     AUDIO_CHANNELS = _SOURCE_TAGS_PREFIX + 'audio.channels'
@@ -96,6 +109,19 @@ METADATA_RULES = [
     ('video_codec', Tags.VIDEO_CODEC),
 ]
 
+# Source columns with a copy of some tags so they can be filtered in SQL,
+# see arroyo.plugins.filters.mediainfo. Multi-valued tags (ex. containers in
+# 'foo.mkv[eztv].avi') only keep their first value, see media_columns()
+MEDIA_COLUMNS = [
+    (Tags.MEDIA_CONTAINER, 'container'),
+    (Tags.MIMETYPE, 'mimetype'),
+    (Tags.RELEASE_GROUP, 'release_group'),
+    (Tags.RELEASE_PROPER, 'release_proper'),
+    (Tags.VIDEO_CODEC, 'video_codec'),
+    (Tags.VIDEO_FORMAT, 'video_format'),
+    (Tags.VIDEO_SCREEN_SIZE, 'screen_size'),
+]
+
 KNOWN_DISTRIBUTORS = [
     'glodls',
     'ethd',
@@ -144,6 +170,31 @@ def extract_items(orig, rules):
     return ret
 
 
+def media_columns(tags):
+    """Values for source media columns from tags.
+
+    Strings are stored in lower case. For multiple values (ex. containers
+    in 'foo.mkv[eztv].avi') only the first one is stored.
+
+    Arguments:
+      tags - Dict with source tags or metadata from parse()
+    Return:
+      A dict column -> value for all columns in MEDIA_COLUMNS
+    """
+    ret = {}
+
+    for (tag, column) in MEDIA_COLUMNS:
+        value = tags.get(tag)
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if isinstance(value, str):
+            value = value.lower()
+
+        ret[column] = value
+
+    return ret
+
+
 def extract_entity_data_from_info(info):
     # EntitySupport
     table = {
@@ -206,6 +257,246 @@ def entity_data_is_confident(data):
     return entity_data_has_fields(data, fields_map)
 
 
+# Fast path for the most common scene release names, see _scene_parse
+_SCENE_EPISODE_RE = re.compile(r'^[Ss](\d{2})[Ee](\d{2,3})$')
+_SCENE_YEAR_RE = re.compile(r'^(19[3-9]\d|20[0-2]\d)$')
+_SCENE_TITLE_WORD_RE = re.compile(r'^[A-Z]?[a-z]+$')
+_SCENE_GROUP_RE = re.compile(r'^[A-Za-z][A-Za-z0-9]+$')
+
+# Tokens allowed after the episode or year marker (lower case) and their
+# value in guessit
+_SCENE_TOKENS = {
+    '480p': ('screen_size', '480p'),
+    '576p': ('screen_size', '576p'),
+    '720p': ('screen_size', '720p'),
+    '1080p': ('screen_size', '1080p'),
+    '2160p': ('screen_size', '4K'),  # guessit 2.x reports 4K
+    'hdtv': ('format', 'HDTV'),
+    'bluray': ('format', 'BluRay'),
+    'webrip': ('format', 'WEBRip'),
+    'x264': ('video_codec', 'h264'),
+    'h264': ('video_codec', 'h264'),
+    'x265': ('video_codec', 'h265'),
+    'h265': ('video_codec', 'h265'),
+    'hevc': ('video_codec', 'h265'),
+    'xvid': ('video_codec', 'XviD'),
+}
+
+# Two letter words are usually language or country codes, only these are
+# allowed in titles
+_SCENE_TITLE_SHORT_WORDS = set(['at', 'in', 'of', 'on', 'to'])
+
+
+@functools.lru_cache(maxsize=1)
+def _scene_guessit_patterns():
+    """Patterns guessit uses to tag words as something else than a title.
+
+    Taken from guessit properties: languages and countries (babelfish names,
+    codes and guessit synonyms), other, edition, format, episode details,
+    codecs, etc.
+
+    Return:
+      A tuple (strings, regexps, functions): lower case strings, compiled
+      regexps and functions like guessit's find_languages. None if guessit
+      internals are not the expected ones, the fast path is disabled then.
+    """
+    try:
+        from guessit.rules.properties import (
+            audio_codec, bonus, cds, container, country, crc, date,
+            edition, episodes, film, format as format_, language, other,
+            part, screen_size, streaming_service, video_codec, website
+        )
+        from rebulk import chain, loose, pattern
+
+        builders = [
+            audio_codec.audio_codec, bonus.bonus, cds.cds,
+            container.container, country.country, crc.crc, date.date,
+            edition.edition, episodes.episodes, film.film, format_.format_,
+            language.language, other.other, part.part,
+            screen_size.screen_size, streaming_service.streaming_service,
+            video_codec.video_codec, website.website
+        ]
+        rebulks = [builder() for builder in builders]
+
+    except (ImportError, AttributeError, TypeError):
+        return None
+
+    def _walk(patterns):
+        for x in patterns:
+            if isinstance(x, chain.Chain):
+                yield from _walk(y.pattern for y in x.parts)
+            else:
+                yield x
+
+    strings = set()
+    regexps = []
+    functions = []
+    for rebulk in rebulks:
+        for x in _walk(rebulk.effective_patterns()):
+            if isinstance(x, pattern.StringPattern):
+                strings.update(y.lower() for y in x.patterns)
+            elif isinstance(x, pattern.RePattern):
+                regexps.extend(x.patterns)
+            elif isinstance(x, pattern.FunctionalPattern):
+                # Called like rebulk does, with the arguments they accept
+                functions.extend(functools.partial(loose.call, y)
+                                 for y in x.patterns)
+
+    return strings, regexps, functions
+
+
+@functools.lru_cache(maxsize=10000)
+def _scene_is_reserved(word):
+    """Check if guessit may take word as something else than a title word.
+
+    Words matched (as a whole) by any of guessit patterns (see
+    _scene_guessit_patterns) can be tagged as language, country, edition,
+    etc. depending on context.
+    """
+    lword = word.lower()
+    if lword in _SCENE_TOKENS:
+        return True
+
+    patterns = _scene_guessit_patterns()
+    if patterns is None:
+        return True
+
+    strings, regexps, functions = patterns
+    if lword in strings:
+        return True
+
+    for regexp in regexps:
+        if regexp.fullmatch(word):
+            return True
+
+    for function in functions:
+        try:
+            if function(word, {}):
+                return True
+        except Exception:
+            return True
+
+    return False
+
+
+@functools.lru_cache(maxsize=10000)
+def _scene_is_joined(word, sep, marker):
+    """Check if guessit may take word and marker as a single property.
+
+    Ex. 'Series.2010' is season 2010 and 'Molof.1999' is an episode count
+    for guessit.
+    """
+    patterns = _scene_guessit_patterns()
+    if patterns is None:
+        return True
+
+    string = word + sep + marker
+    for regexp in patterns[1]:
+        for m in regexp.finditer(string):
+            if m.start() < len(word) and m.end() > len(word) + len(sep):
+                return True
+
+    return False
+
+
+def _scene_is_title_word(word):
+    if not _SCENE_TITLE_WORD_RE.match(word):
+        return False
+
+    if len(word) < 3 and word.lower() not in _SCENE_TITLE_SHORT_WORDS:
+        return False
+
+    return not _scene_is_reserved(word)
+
+
+def _scene_parse(name, type_hint=None):
+    """Parse well-formed scene release names without guessit.
+
+    Only names like 'Some.Title.S01E02.720p.HDTV.x264-GROUP' or
+    'Some.Title.2010.1080p.BluRay.x264-GROUP' are handled: plain alphabetic
+    title words, a single episode or year marker and known tokens after it.
+    Anything else is left to guessit.
+
+    Return:
+      A dict with the same data guessit would return for name or None if
+      name is not recognized.
+    """
+    if ' ' in name:
+        if '.' in name:
+            return None
+        sep = ' '
+    else:
+        sep = '.'
+
+    # Release group is only taken from the last token
+    words = name.split(sep)
+    release_group = None
+    if '-' in words[-1]:
+        last, release_group = words[-1].rsplit('-', 1)
+        if (not _SCENE_GROUP_RE.match(release_group) or
+                _scene_is_reserved(release_group)):
+            return None
+        words[-1] = last
+
+    # Title words up to the marker
+    title = []
+    for (idx, word) in enumerate(words):
+        if not _scene_is_title_word(word):
+            break
+        title.append(word)
+    else:
+        return None
+
+    if not title:
+        return None
+
+    info = {'title': ' '.join(title)}
+
+    marker = words[idx]
+    if _scene_is_joined(title[-1], sep, marker):
+        return None
+
+    m = _SCENE_EPISODE_RE.match(marker)
+    if m:
+        info['type'] = 'episode'
+        info['season'] = int(m.group(1))
+        info['episode'] = int(m.group(2))
+    else:
+        m = _SCENE_YEAR_RE.match(marker)
+        if not m:
+            return None
+        info['type'] = 'movie'
+        info['year'] = int(m.group(1))
+
+    if type_hint is not None and type_hint != info['type']:
+        return None
+
+    # Known tokens, at least one and no repeated properties
+    tokens = words[idx+1:]
+    if not tokens:
+        return None
+
+    # guessit takes 'YYYY.x264' as a '<width>x<height>' screen size
+    if info['type'] == 'movie' and re.match(r'^[Xx]\d', tokens[0]):
+        return None
+
+    for token in tokens:
+        try:
+            key, value = _SCENE_TOKENS[token.lower()]
+        except KeyError:
+            return None
+
+        if key in info:
+            return None
+
+        info[key] = value
+
+    if release_group is not None:
+        info['release_group'] = release_group
+
+    return info
+
+
 def _guessit_parse(name, tags=None, type_hint=None):
     """
     Parse "backend using guessit"
@@ -223,14 +514,17 @@ def _guessit_parse(name, tags=None, type_hint=None):
         name = (name[:idx] + name[idx+len(tag):]).strip()
         release_distributors.add(dist)
 
-    # Process via guessit (options.type is integrated into returned info by
-    # guessit.guessit, no need to manually add it
-    try:
-        info = guessit.guessit(name, options={'type': type_hint})
-    except guessit.api.GuessitException as e:
-        msg = "Internal error: {e}"
-        msg = msg.format(e=str(e))
-        raise ParseError(msg) from e
+    # Try the fast path first, fallback to guessit. options.type is
+    # integrated into returned info by guessit.guessit, no need to manually
+    # add it
+    info = _scene_parse(name, type_hint=type_hint)
+    if info is None:
+        try:
+            info = guessit.guessit(name, options={'type': type_hint})
+        except guessit.api.GuessitException as e:
+            msg = "Internal error: {e}"
+            msg = msg.format(e=str(e))
+            raise ParseError(msg) from e
 
     # Errors: 'part' is not supported
     if 'part' in info:
@@ -343,10 +637,355 @@ def parse(name, tags=None, type_hint=None):
     return entity_data, metadata
 
 
+@functools.lru_cache(maxsize=1)
+def parser_version():
+    """Identifier for the current parse() implementation.
+
+    It changes along with PARSER_VERSION, guessit version, METADATA_RULES or
+    KNOWN_DISTRIBUTORS.
+    """
+    rules = []
+    for rule in METADATA_RULES:
+        rule = list(rule)
+        if len(rule) == 3:
+            rule[2] = rule[2].__code__.co_code.hex()
+        rules.append(rule)
+
+    data = json.dumps([
+        PARSER_VERSION,
+        guessit.__version__,
+        rules,
+        KNOWN_DISTRIBUTORS
+    ])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class ParseCache:
+    """Cache for parse() results.
+
+    Release names never change, so its parse results are stored in the
+    database (see models.ParseCacheEntry) with a LRU in memory in front of
+    it. Results are keyed by name, type hint and parser_version() so
+    upgrading guessit or changing METADATA_RULES invalidates them.
+
+    tags are not part of the key, parse() doesn't use them.
+
+    Failures (ParseError or UnknownEntityTypeError) are cached too.
+    """
+
+    # Max number of elements for 'IN' clauses
+    CHUNK_SIZE = 500
+
+    def __init__(self, app, maxsize=10000):
+        self.app = app
+        self.maxsize = maxsize
+        self.version = parser_version()
+
+        # key -> pickled result
+        self._lru = collections.OrderedDict()
+
+        # Results not yet written into database
+        self._pending = {}
+
+        self._purged = False
+
+    @staticmethod
+    def key(name, type_hint=None):
+        return (name, type_hint or '')
+
+    def _remember(self, key, data):
+        self._lru[key] = data
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+
+    def _purge(self):
+        # Entries from other parser versions are useless
+        if self._purged:
+            return
+
+        query = self.app.db.session.query(models.ParseCacheEntry)
+        query = query.filter(models.ParseCacheEntry.version != self.version)
+        query.delete(synchronize_session=False)
+        self._purged = True
+
+    def prefetch(self, keys):
+        """Load entries for keys from database into memory"""
+        self._purge()
+
+        missing = {}
+        for key in keys:
+            if key not in self._lru and key not in self._pending:
+                missing.setdefault(key[0], set()).add(key)
+
+        names = list(missing)
+        for idx in range(0, len(names), self.CHUNK_SIZE):
+            chunk = names[idx:idx+self.CHUNK_SIZE]
+            query = self.app.db.session.query(
+                models.ParseCacheEntry.name,
+                models.ParseCacheEntry.type_hint,
+                models.ParseCacheEntry.data)
+            query = query.filter(
+                models.ParseCacheEntry.version == self.version)
+            query = query.filter(models.ParseCacheEntry.name.in_(chunk))
+
+            for (name, type_hint, data) in query:
+                key = (name, type_hint)
+                if key in missing.get(name, ()):
+                    self._remember(key, data)
+
+    def get(self, name, type_hint=None):
+        """Get cached result for name and type_hint.
+
+        Return:
+          A tuple (entity_data, metadata, error) or None if it's not in the
+          cache. error is an exception (instance) raised by parse(), in that
+          case entity_data and metadata are None.
+        """
+        key = self.key(name, type_hint)
+
+        try:
+            data = self._lru[key]
+            self._lru.move_to_end(key)
+        except KeyError:
+            data = self._pending.get(key)
+
+        if data is None:
+            return None
+
+        return pickle.loads(data)
+
+    def set(self, name, type_hint, entity_data, metadata, error=None):
+        key = self.key(name, type_hint)
+        data = pickle.dumps((entity_data, metadata, error))
+
+        self._pending[key] = data
+        self._remember(key, data)
+
+    def flush(self):
+        """Write pending results into database. Doesn't commit."""
+        if not self._pending:
+            return
+
+        session = self.app.db.session
+        table = models.ParseCacheEntry.__table__
+        dialect = session.get_bind().dialect.name
+
+        # Another process could have stored the same results
+        if dialect == 'sqlite':
+            stmt = table.insert().prefix_with('OR IGNORE')
+        elif dialect == 'postgresql':
+            stmt = postgresql.insert(table).on_conflict_do_nothing()
+        else:
+            stmt = table.insert()
+
+        rows = [
+            {'version': self.version, 'name': name, 'type_hint': type_hint,
+             'data': data}
+            for ((name, type_hint), data) in self._pending.items()
+        ]
+        session.execute(stmt, rows)
+        self._pending = {}
+
+
+# Fields identifying each entity model, see Mediainfo.entities_from_data
+_ENTITY_FIELDS = {
+    models.Episode: ('series', 'year', 'season', 'number'),
+    models.Movie: ('title', 'year')
+}
+
+
+def _entity_key(entity_data):
+    """Get model and identity key for entity_data.
+
+    Return:
+      A tuple (model_class, key) where key is a tuple with the normalized
+      values of the fields in _ENTITY_FIELDS (None for missing ones).
+    """
+    if entity_data['type'] == 'episode':
+        model_class = models.Episode
+
+    elif entity_data['type'] == 'movie':
+        model_class = models.Movie
+
+    else:
+        msg = "Unsupported entity type: '{type}'"
+        msg = msg.format(type=entity_data['type'])
+        raise UnknownEntityTypeError(entity_data['type'], msg)
+
+    if not entity_data_is_complete(entity_data):
+        raise IncompleteEntityDataError(model_class)
+
+    key = tuple(
+        model_class.normalize(x, entity_data.get(x, None))
+        for x in _ENTITY_FIELDS[model_class]
+    )
+
+    return model_class, key
+
+
+def _parse_in_worker(name, tags=None, type_hint=None):
+    """Wrapper around parse() usable from a process pool.
+
+    Return:
+      A tuple (entity_data, metadata, error), see ParseCache.get
+    """
+    try:
+        entity_data, metadata = parse(name, tags=tags, type_hint=type_hint)
+    except (ParseError, UnknownEntityTypeError) as e:
+        return None, None, e
+
+    return entity_data, metadata, None
+
+
 class Mediainfo:
+    # Minimum number of names to parse before using the process pool, IPC
+    # overhead isn't worth it for a few names
+    PARALLEL_THRESHOLD = 50
+
+    # Default number of sources for each batch, see Mediainfo.batches
+    BATCH_SIZE = 500
+
     def __init__(self, app):
         self.app = app
         self.logger = loggertools.getLogger('mediainfo')
+        self._parse_executor = None
+        self._parse_workers = 0
+        self._media_columns_checked = False
+
+        if app.settings.get('mediainfo.parse-cache', default=True):
+            self.parse_cache = ParseCache(
+                app,
+                maxsize=app.settings.get('mediainfo.parse-cache-size',
+                                         default=10000))
+        else:
+            self.parse_cache = None
+
+    @property
+    def parse_executor(self):
+        """ Process pool used to parse names.
+
+        Its size is controlled by 'mediainfo.parse-workers' setting: 0
+        disables the pool (names are parsed in the main process) and a
+        negative value uses one worker for each CPU.
+        """
+        if self._parse_executor is None:
+            workers = self.app.settings.get('mediainfo.parse-workers',
+                                            default=0)
+            if workers < 0:
+                workers = os.cpu_count() or 1
+
+            if workers > 0:
+                self._parse_executor = futures.ProcessPoolExecutor(
+                    max_workers=workers)
+                self._parse_workers = workers
+                msg = "Using {n} process(es) for parsing"
+                msg = msg.format(n=workers)
+                self.logger.debug(msg)
+            else:
+                self._parse_executor = False
+
+        return self._parse_executor or None
+
+    def parse(self, name, tags=None, type_hint=None):
+        """Cached version of mediainfo.parse, see ParseCache"""
+        entity_data, metadata, error = self.parse_all(
+            [(name, tags, type_hint)])[ParseCache.key(name, type_hint)]
+
+        if error is not None:
+            raise error
+
+        return entity_data, metadata
+
+    def parse_all(self, items):
+        """Parse several names at once.
+
+        Names are looked up in the parse cache first. The remaining ones are
+        parsed in the process pool (see Mediainfo.parse_executor) if there
+        are enough of them.
+
+        Arguments:
+          items - List of (name, tags, type_hint) tuples.
+        Return:
+          A dict mapping ParseCache.key(name, type_hint) to (entity_data,
+          metadata, error) tuples, see ParseCache.get
+        """
+        results = {}
+        missing = collections.OrderedDict()
+
+        if self.parse_cache is not None:
+            self.parse_cache.prefetch(
+                [ParseCache.key(name, type_hint)
+                 for (name, tags, type_hint) in items])
+
+        for (name, tags, type_hint) in items:
+            key = ParseCache.key(name, type_hint)
+            if key in results or key in missing:
+                continue
+
+            cached = None
+            if self.parse_cache is not None:
+                cached = self.parse_cache.get(name, type_hint)
+
+            if cached is None:
+                missing[key] = (name, tags, type_hint)
+            else:
+                results[key] = cached
+
+        if not missing:
+            return results
+
+        executor = None
+        if len(missing) >= self.PARALLEL_THRESHOLD:
+            executor = self.parse_executor
+
+        if executor:
+            names, tags, type_hints = zip(*missing.values())
+            chunksize = max(1, len(names) // (self._parse_workers * 4))
+            parsed = executor.map(_parse_in_worker, names, tags, type_hints,
+                                  chunksize=chunksize)
+        else:
+            parsed = (_parse_in_worker(*x) for x in missing.values())
+
+        for ((key, (name, tags, type_hint)), result) in zip(missing.items(),
+                                                            parsed):
+            results[key] = result
+            if self.parse_cache is not None:
+                self.parse_cache.set(name, type_hint, *result)
+
+        return results
+
+    def check_media_columns(self):
+        """Warn if source media columns are not filled yet.
+
+        Sources processed before MEDIA_COLUMNS were added get them from the
+        '04_fill-media-columns' migration ('db --upgrade'), filters on
+        these columns miss those sources until it runs. Checked once.
+        """
+        if self._media_columns_checked:
+            return
+
+        self._media_columns_checked = True
+
+        migration = 'core.db.migration.04_fill-media-columns'
+        if self.app.variables.get(migration, default=False):
+            return
+
+        # Sources with media tags but without any media column
+        keys = [tag for (tag, column) in MEDIA_COLUMNS]
+        qs = self.app.db.session.query(models.SourceTag.id).join(
+            models.Source, models.Source.id == models.SourceTag.source_id
+        ).filter(
+            models.SourceTag.key.in_(keys),
+            *[getattr(models.Source, column).is_(None)
+              for (tag, column) in MEDIA_COLUMNS]
+        )
+
+        if qs.first() is not None:
+            msg = ("Media columns are not filled for some sources, filters "
+                   "on codec, container, quality, release group or rip "
+                   "format will miss them. Run 'db --upgrade' to fill them")
+            self.logger.warning(msg)
 
     @functools.lru_cache(maxsize=16)
     def default_language_for_provider(self, provider):
@@ -354,43 +993,180 @@ class Mediainfo:
         return self.app.settings.get(k, default=None)
 
     def entity_from_data(self, entity_data):
-        # Create entity model
-        if entity_data['type'] == 'episode':
-            model_class = models.Episode
+        ret = self.entities_from_data(entity_data)[0]
+        if isinstance(ret, Exception):
+            raise ret
 
-        elif entity_data['type'] == 'movie':
-            model_class = models.Movie
+        return ret
 
-        else:
-            msg = "Unsupported entity type: '{type}'"
-            msg = msg.format(type=entity_data['type'])
-            raise UnknownEntityTypeError(entity_data['type'], msg)
-
-        if not entity_data_is_complete(entity_data):
-            raise IncompleteEntityDataError(model_class)
-
-        # Complete data with NULLs before quering the database
-        if model_class == models.Episode:
-            entity_data = {
-                k: entity_data.get(k, None)
-                for k in ['series', 'year', 'season', 'number']
-            }
-
-        elif model_class == models.Movie:
-            entity_data = {
-                k: entity_data.get(k, None)
-                for k in ['title', 'year']
-            }
-        else:
-            raise ValueError()
+    def entities_from_data(self, *entity_datas):
+        """Get (or create) entities for several entity_data at once.
+
+        Existing entities are fetched with one query per model, missing ones
+        are inserted with a single statement. Equal entity data in the batch
+        resolve to the same entity.
+
+        Return:
+          A list with an entity or an exception (UnknownEntityTypeError or
+          IncompleteEntityDataError) for each entity_data.
+        """
+        keys = []
+        wanted = collections.defaultdict(set)
+
+        for entity_data in entity_datas:
+            try:
+                model_class, key = _entity_key(entity_data)
+            except (UnknownEntityTypeError, IncompleteEntityDataError) as e:
+                keys.append(e)
+                continue
+
+            keys.append((model_class, key))
+            wanted[model_class].add(key)
+
+        # (model_class, key) -> entity
+        identity_map = {}
+
+        for (model_class, model_keys) in wanted.items():
+            identity_map.update(self._load_entities(model_class, model_keys))
 
-        model, dummy = self.app.db.get_or_create(model_class,
-                                                 **entity_data)
-        assert not isinstance(model, list)
+            missing = [key for key in model_keys
+                       if (model_class, key) not in identity_map]
+            if not missing:
+                continue
+
+            fields = _ENTITY_FIELDS[model_class]
+            self.app.db.session.execute(
+                model_class.__table__.insert(),
+                [dict(zip(fields, key)) for key in missing])
+            identity_map.update(self._load_entities(model_class, missing))
+
+        return [x if isinstance(x, Exception) else identity_map[x]
+                for x in keys]
+
+    def _load_entities(self, model_class, keys):
+        # Query by the first field (indexed) and check the remaining ones
+        # here, it's simpler than a long chain of ORs
+        fields = _ENTITY_FIELDS[model_class]
+        column = getattr(model_class, fields[0])
+        values = list(set(key[0] for key in keys))
+        keys = set(keys)
+        ret = {}
+
+        for idx in range(0, len(values), ParseCache.CHUNK_SIZE):
+            query = self.app.db.session.query(model_class)
+            query = query.filter(
+                column.in_(values[idx:idx+ParseCache.CHUNK_SIZE]))
+
+            for entity in query:
+                key = tuple(getattr(entity, x) for x in fields)
+                if key in keys:
+                    ret[(model_class, key)] = entity
+
+        return ret
+
+    def rewrite_tags(self, sources_and_tags):
+        """Replace core tags (see Tags) of several sources.
+
+        Current tags are loaded with one query, sources whose tags didn't
+        change are skipped, tags of the remaining ones are deleted with one
+        statement and new ones inserted with a single executemany.
+
+        Source media columns (see MEDIA_COLUMNS) are updated too.
+
+        Arguments:
+          sources_and_tags - Iterable of (source, dict) tuples.
+        """
+        session = self.app.db.session
+        table = models.SourceTag.__table__
+        core_keys = list(Tags.values())
+
+        # Sources need an ID
+        session.flush()
+
+        # Build rows from model instances, serialization of values is done by
+        # the model
+        columns = [
+            (prop.key, prop.columns[0].name)
+            for prop in sqlalchemy.inspect(models.SourceTag).column_attrs
+            if prop.columns[0].name not in ('id', 'source_id')
+        ]
+
+        new = collections.OrderedDict()
+        srcs = {}
+        for (src, tags) in sources_and_tags:
+            for (column, value) in media_columns(tags).items():
+                setattr(src, column, value)
+
+            if src.id is None:
+                # Not in the session, let the ORM handle it
+                for (k, v) in tags.items():
+                    src.tags.append(models.SourceTag(k, v))
+                continue
 
-        return model
+            rows = []
+            for (k, v) in tags.items():
+                tag = models.SourceTag(k, v)
+                row = {col: getattr(tag, attr) for (attr, col) in columns}
+                row['source_id'] = src.id
+                rows.append(row)
+
+            new[src.id] = rows
+            srcs[src.id] = src
+
+        if not new:
+            return
+
+        def _signature(rows):
+            return set(
+                tuple(row[col] for (attr, col) in columns)
+                for row in rows)
+
+        ids = list(new)
+        current = collections.defaultdict(list)
+        for idx in range(0, len(ids), ParseCache.CHUNK_SIZE):
+            chunk = ids[idx:idx+ParseCache.CHUNK_SIZE]
+            query = sqlalchemy.select(
+                [table.c.source_id] + [table.c[col] for (attr, col) in columns]
+            ).where(sqlalchemy.and_(
+                table.c.source_id.in_(chunk),
+                table.c.key.in_(core_keys)))
+
+            for row in session.execute(query):
+                current[row['source_id']].append(dict(row))
+
+        changed = [
+            id_ for id_ in ids
+            if _signature(new[id_]) != _signature(current[id_])
+        ]
+        if not changed:
+            return
+
+        for idx in range(0, len(changed), ParseCache.CHUNK_SIZE):
+            chunk = changed[idx:idx+ParseCache.CHUNK_SIZE]
+            session.execute(table.delete().where(sqlalchemy.and_(
+                table.c.source_id.in_(chunk),
+                table.c.key.in_(core_keys))))
+
+        rows = [row for id_ in changed for row in new[id_]]
+        if rows:
+            session.execute(table.insert(), rows)
+
+        # Tags were written behind the ORM's back
+        for id_ in changed:
+            session.expire(srcs[id_], ['tag_list'])
 
     def process(self, *sources_and_tags):
+        """Find entities and metadata for sources.
+
+        Processing is done in two phases: first all names are parsed (see
+        Mediainfo.parse_all), then results are applied into the database.
+        Doesn't commit.
+
+        Arguments:
+          sources_and_tags - Sources or (source, tags) tuples.
+        """
+        items = []
+
         for x in sources_and_tags:
             if isinstance(x, models.Source):
                 src, tags = x, None
@@ -405,49 +1181,56 @@ class Mediainfo:
                 self.logger.error(msg)
                 src.type = None
 
-            # Cleanup source
+            items.append((src, tags))
+
+        # Parse phase
+        results = self.parse_all([(src.name, tags, src.type)
+                                  for (src, tags) in items])
+
+        # Database phase
+        version = parser_version()
+        resolved = []
+        # id(source) -> (source, tags). Sources can't be used as keys,
+        # unsaved sources are all equal
+        new_tags = collections.OrderedDict()
+        for (src, tags) in items:
+            entity_data, metadata, error = \
+                results[ParseCache.key(src.name, src.type)]
+
+            # Cleanup source, core tags are rewritten later
             src.entity = None
+            src.mediainfo_version = version
+            new_tags[id(src)] = (src, {})
 
-            # Use delete bulk operation bypassing ORM. See URL below for more
-            # info. Warning: delete operation needs synchronize_session
-            # parameter. Possible values are 'fetch' or False, both work as
-            # expected but 'fetch' is slightly faster.
-            # http://docs.sqlalchemy.org/en/latest/orm/query.html#sqlalchemy.orm.query.Query.delete
-            src.tags.filter(
-                models.SourceTag.key.in_(Tags.values())
-            ).delete(synchronize_session='fetch')
-
-            # Another method of deleting tags is this.
-            # Theorically it's slower than bulk operation
-            # tags = src.tags.filter(models.SourceTag.key.in_(Tags.values()))
-            # for tag in tags:
-            #     self.app.db.session.delete(tag)
-
-            # Extract entity data
-            try:
-                entity_data, metadata = parse(
-                    src.name, tags=tags, type_hint=src.type)
-            except UnknownEntityTypeError as e:
+            # Check entity data
+            if isinstance(error, UnknownEntityTypeError):
                 # msg = "Unknow entity type in '{source}': {e}"
-                # msg = msg.format(source=src, e=str(e))
+                # msg = msg.format(source=src, e=str(error))
                 # self.logger.warning(msg)
                 continue
-            except ParseError as e:
+            elif isinstance(error, ParseError):
                 msg = "Unable to indentify entity in '{source}': {e}"
-                msg = msg.format(source=src, e=e.message)
+                msg = msg.format(source=src, e=error.message)
                 self.logger.warning(msg)
                 continue
 
-            # Create entity from data
-            try:
-                src.entity = self.entity_from_data(entity_data)
-                self.app.db.session.add(src.entity)
-            except IncompleteEntityDataError as e:
+            resolved.append((src, entity_data, metadata))
+
+        entities = self.entities_from_data(
+            *[entity_data for (src, entity_data, metadata) in resolved])
+
+        for ((src, entity_data, metadata), entity) in zip(resolved, entities):
+            if isinstance(entity, UnknownEntityTypeError):
+                continue
+
+            elif isinstance(entity, IncompleteEntityDataError):
                 msg = "Incomplete entity data for '{source}'"
                 msg = msg.format(source=src.name)
                 self.logger.warning(msg)
                 continue
 
+            src.entity = entity
+
             # Update source type
             src.type = entity_data['type']
 
@@ -455,6 +1238,73 @@ class Mediainfo:
             if not src.language:
                 src.language = self.default_language_for_provider(src.provider)
 
-            # Create new tags
-            for (k, v) in metadata.items():
-                src.tags.append(models.SourceTag(k, v))
+            new_tags[id(src)] = (src, metadata)
+
+        self.rewrite_tags(new_tags.values())
+
+        if self.parse_cache is not None:
+            self.parse_cache.flush()
+
+    def batches(self, query=None, batch_size=None, checkpoint=None,
+                stale=False):
+        """Iterate over sources in batches committing after each one.
+
+        Sources are fetched by id ranges (keyset pagination) instead of
+        holding a cursor open, so the session can be committed between
+        batches. Once a batch has been consumed (the generator is resumed)
+        the session is committed and, if checkpoint is used, the last id
+        is stored in app.variables. A following call with the same
+        checkpoint will resume from that point. The checkpoint is removed
+        when all sources have been processed.
+
+        Arguments:
+          query - Query for models.Source, all sources by default.
+          batch_size - Number of sources in each batch.
+          checkpoint - Variable name for the resume checkpoint.
+          stale - Only sources not processed with the current
+            parser_version().
+        Return:
+          A generator of lists of sources.
+        """
+        sess = self.app.db.session
+
+        if query is None:
+            query = sess.query(models.Source)
+
+        if batch_size is None:
+            batch_size = self.BATCH_SIZE
+
+        if stale:
+            query = query.filter(sqlalchemy.or_(
+                models.Source.mediainfo_version.is_(None),
+                models.Source.mediainfo_version != parser_version()))
+
+        last_id = 0
+        if checkpoint:
+            last_id = self.app.variables.get(checkpoint, default=0)
+            if last_id:
+                msg = "Resuming from source ID={id}"
+                msg = msg.format(id=last_id)
+                self.logger.info(msg)
+
+        while True:
+            batch = (
+                query.
+                filter(models.Source.id > last_id).
+                order_by(models.Source.id).
+                limit(batch_size).
+                all())
+
+            if not batch:
+                break
+
+            yield batch
+
+            last_id = batch[-1].id
+            if checkpoint:
+                self.app.variables.set(checkpoint, last_id)
+            sess.commit()
+
+        if checkpoint:
+            self.app.variables.reset(checkpoint)
+            sess.commit()
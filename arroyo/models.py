@@ -24,6 +24,7 @@
 
 
 import functools
+import json
 import re
 import sys
 
@@ -34,12 +35,18 @@ from appkit import (
 )
 from appkit.db import sqlalchemyutils as sautils
 from sqlalchemy import (
+    Boolean,
     Column,
+    Float,
     Integer,
+    LargeBinary,
     String,
+    Text,
     ForeignKey,
     and_,
+    event,
     func,
+    inspect,
     schema
 )
 from sqlalchemy.ext.hybrid import hybrid_property
@@ -228,6 +235,13 @@ class Source(EntityPropertyMixin, sautils.Base):
         )
 
     __tablename__ = 'source'
+    __table_args__ = (
+        # Selector queries: equality on these columns along with a range on
+        # created (age-min, age-max, since). See 'arroyo db --explain'
+        schema.Index('ix_source_language_created', 'language', 'created'),
+        schema.Index('ix_source_provider_created', 'provider', 'created'),
+        schema.Index('ix_source_type_created', 'type', 'created'),
+    )
 
     ENTITY_MAP = {  # EntityPropertyMixin
         'Episode': 'episode',
@@ -238,7 +252,7 @@ class Source(EntityPropertyMixin, sautils.Base):
     id = Column(Integer, primary_key=True)
     provider = Column(String, nullable=False)
     name = Column(String, nullable=False, index=True)
-    created = Column(Integer, nullable=False)
+    created = Column(Integer, nullable=False, index=True)
     last_seen = Column(Integer, nullable=False)
 
     # Real ID
@@ -253,17 +267,33 @@ class Source(EntityPropertyMixin, sautils.Base):
     type = Column(String, nullable=True)
     language = Column(String, nullable=True)
 
+    # Copy of some core tags for SQL-side filtering, see
+    # mediainfo.MEDIA_COLUMNS
+    container = Column(String, nullable=True, index=True)
+    mimetype = Column(String, nullable=True, index=True)
+    release_group = Column(String, nullable=True, index=True)
+    release_proper = Column(Boolean, nullable=True, index=True)
+    screen_size = Column(String, nullable=True, index=True)
+    video_codec = Column(String, nullable=True, index=True)
+    video_format = Column(String, nullable=True, index=True)
+
+    # mediainfo.parser_version() used to process this source, see
+    # Mediainfo.process
+    mediainfo_version = Column(String, nullable=True)
+
     # EntitySupport
     episode_id = Column(Integer,
                         ForeignKey('episode.id', ondelete="SET NULL"),
-                        nullable=True)
+                        nullable=True,
+                        index=True)
     episode = orm.relationship('Episode',
                                uselist=False,
                                backref=orm.backref("sources", lazy='dynamic'))
 
     movie_id = Column(Integer,
                       ForeignKey('movie.id', ondelete="SET NULL"),
-                      nullable=True)
+                      nullable=True,
+                      index=True)
     movie = orm.relationship('Movie',
                              uselist=False,
                              backref=orm.backref("sources", lazy='dynamic'))
@@ -276,6 +306,13 @@ class Source(EntityPropertyMixin, sautils.Base):
                             lazy='dynamic',
                             cascade="all, delete, delete-orphan")
 
+    # Same as tags but as a regular collection, dynamic relationships can't
+    # be eager-loaded. See Source.tag_dict
+    tag_list = orm.relationship("SourceTag",
+                                uselist=True,
+                                viewonly=True,
+                                lazy='select')
+
     def __init__(self, **kwargs):
         for x in ['provider', 'name', 'uri']:
             if x not in kwargs:
@@ -294,7 +331,18 @@ class Source(EntityPropertyMixin, sautils.Base):
 
     @property
     def tag_dict(self):
-        return {x.key: x.value for x in self.tags.all()}
+        """Tags as a dict.
+
+        For sources already in the database tags are read from tag_list:
+        they are loaded once (or eager-loaded, see selector.LoadingPlan) and
+        reused until the source is expired.
+        """
+        if inspect(self).persistent:
+            tags = self.tag_list
+        else:
+            tags = self.tags.all()
+
+        return {x.key: x.value for x in tags}
 
     @hybrid_property
     def _discriminator(self):
@@ -423,7 +471,7 @@ class Source(EntityPropertyMixin, sautils.Base):
         ret = {
             attr: getattr(self, attr)
             for attr in self
-            if attr != 'tags'
+            if attr not in ('tags', 'tag_list')
         }
         ret['tags'] = self.tag_dict
 
@@ -473,6 +521,15 @@ class Source(EntityPropertyMixin, sautils.Base):
         return self.format(self.Formats.DEFAULT)
 
 
+@event.listens_for(Source.tags, 'append')
+@event.listens_for(Source.tags, 'remove')
+def _expire_tag_list(target, value, initiator):
+    # Keep Source.tag_list in sync with changes made through Source.tags
+    state = inspect(target)
+    if state.persistent and 'tag_list' in state.dict:
+        state.session.expire(target, ['tag_list'])
+
+
 class Download(EntityPropertyMixin, sautils.Base):
     __tablename__ = 'download'
     __table_args__ = (
@@ -587,6 +644,10 @@ class Episode(sautils.Base):
     __tablename__ = 'episode'
     __table_args__ = (
         schema.UniqueConstraint('series', 'year', 'season', 'number'),
+        # Unique constraint can't be used for season and number lookups
+        # without year
+        schema.Index('ix_episode_series_season_number',
+                     'series', 'season', 'number'),
     )
 
     id = Column(Integer, primary_key=True)
@@ -738,3 +799,49 @@ class Movie(sautils.Base):
 
     def __unicode__(self):
         return self.format()
+
+
+class ImportRun(sautils.Base):
+    """Timings and counters of an import run, see importstats.ImportStats"""
+
+    __tablename__ = 'importrun'
+
+    id = Column(Integer, primary_key=True)
+    started = Column(Integer, nullable=False, index=True)
+    duration = Column(Float, nullable=False)
+    data = Column(Text, nullable=False)
+
+    @property
+    def stats(self):
+        return json.loads(self.data)
+
+    @stats.setter
+    def stats(self, value):
+        self.data = json.dumps(value)
+
+    def __repr__(self):
+        return "<ImportRun #{id} started={started}>".format(
+            id=self.id or '??',
+            started=self.started)
+
+
+class ParseCacheEntry(sautils.Base):
+    """Cached result of mediainfo.parse, see mediainfo.ParseCache"""
+
+    __tablename__ = 'parsecache'
+    __table_args__ = (
+        schema.UniqueConstraint('version', 'name', 'type_hint'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    version = Column(String, nullable=False)
+    name = Column(String, nullable=False)
+    # Empty string for no type hint, NULLs are not equal in unique
+    # constraints
+    type_hint = Column(String, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return "<ParseCacheEntry #{id} {name}>".format(
+            id=self.id or '??',
+            name=self.name)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+from arroyo import pluginlib
+
+
+from appkit import loggertools
+
+
+class CacheCommand(pluginlib.Command):
+    __extension_name__ = 'cache'
+
+    HELP = 'Manage network cache'
+
+    def setup_argparser(cls, cmdargparser):
+        cls.opparser = cmdargparser.add_subparsers(dest='operation')
+
+        cls.statsparser = cls.opparser.add_parser('stats')
+
+        cls.pruneparser = cls.opparser.add_parser('prune')
+        cls.pruneparser.add_argument(
+            '--max-bytes',
+            dest='max_bytes',
+            type=int,
+            default=None,
+            help=('Shrink cache to this size (default: '
+                  'fetcher.cache-max-bytes)'))
+        cls.pruneparser.add_argument(
+            '--expired',
+            dest='expired',
+            action='store_true',
+            default=False,
+            help='Remove entries older than fetcher.cache-delta')
+        cls.pruneparser.add_argument(
+            '--all',
+            dest='all',
+            action='store_true',
+            default=False,
+            help='Remove all entries')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.logger = loggertools.getLogger('cache')
+
+    def execute(self, app, arguments):
+        cache = app.fetcher.http_cache
+        if cache is None:
+            msg = "Cache is disabled"
+            self.logger.error(msg)
+            return
+
+        if arguments.operation == 'stats':
+            stats = cache.stats()
+            ratio = stats['bytes'] / stats['raw-bytes'] \
+                if stats['raw-bytes'] else 0
+
+            print("Path:        {}".format(cache.basedir))
+            print("Entries:     {}".format(stats['entries']))
+            print("Bodies:      {}".format(stats['blobs']))
+            print("Disk usage:  {} bytes ({:.1%} of {} bytes)".format(
+                stats['bytes'], ratio, stats['raw-bytes']))
+            print("Budget:      {} bytes".format(stats['max-bytes'] or '∞'))
+
+        elif arguments.operation == 'prune':
+            max_bytes = 0 if arguments.all else arguments.max_bytes
+            removed = cache.prune(max_bytes=max_bytes,
+                                  expired=arguments.expired)
+
+            msg = "{n} entries removed"
+            msg = msg.format(n=removed)
+            self.logger.info(msg)
+
+        else:
+            msg = "Incorrect usage"
+            raise pluginlib.exc.ArgumentsError(msg)
+
+
+__arroyo_extensions__ = [
+    CacheCommand
+]
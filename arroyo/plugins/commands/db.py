@@ -22,13 +22,19 @@
 # - Remove tqdm code and move to alembic
 
 
-from arroyo import pluginlib
+from arroyo import (
+    mediainfo,
+    pluginlib
+)
 
 
+import collections
 import contextlib
 import sys
+import time
 
 import tqdm
+from appkit import utils
 
 
 models = pluginlib.models
@@ -129,6 +135,30 @@ class Command(pluginlib.Command):
             dest='upgrade',
             action='store_true',
             help='Upgrade database content, *not* schema'
+        ),
+
+        pluginlib.cliargument(
+            '--explain',
+            dest='explain',
+            action='store_true',
+            help=('Run a search (keywords and -f/--filter as in search '
+                  'command) and show its SQL statements, timings and query '
+                  'plans (SQLite only)')
+        ),
+
+        pluginlib.cliargument(
+            '-f', '--filter',
+            dest='filters',
+            type=str,
+            default={},
+            action=utils.DictAction,
+            help='Filters for --explain'
+        ),
+
+        pluginlib.cliargument(
+            'keywords',
+            nargs='*',
+            help='Keywords for --explain'
         )
     )
 
@@ -142,6 +172,7 @@ class Command(pluginlib.Command):
         reset_states = arguments.reset_states
         reset_source_id = arguments.reset_source_id
         upgrade = arguments.upgrade
+        explain = arguments.explain
 
         all_ = [
             archive_all,
@@ -151,6 +182,7 @@ class Command(pluginlib.Command):
             reset_source_id,
             reset_states,
             upgrade,
+            explain,
         ]
         test = [1 for x in all_ if x]
 
@@ -162,6 +194,11 @@ class Command(pluginlib.Command):
             msg = "Just one option can be specified at one time"
             raise pluginlib.exc.ArgumentsError(msg)
 
+        if (arguments.keywords or arguments.filters) and not explain:
+            msg = ("Keywords and '-f/--filter' can only be used along with "
+                   "'--explain'")
+            raise pluginlib.exc.ArgumentsError(msg)
+
         if archive_all:
             update_all_states(self.app.db.session, models.State.ARCHIVED)
 
@@ -202,12 +239,55 @@ class Command(pluginlib.Command):
         elif arguments.upgrade:
             self.migrations()
 
+        elif explain:
+            keyword = ' '.join(x.strip() for x in arguments.keywords)
+            if not keyword and not arguments.filters:
+                msg = "--explain requires keywords or filters"
+                raise pluginlib.exc.ArgumentsError(msg)
+
+            query = self.app.selector.query_from_args(
+                keyword=keyword or None,
+                params=arguments.filters)
+            self.explain(query)
+
         else:
             # This code should never be reached but keeping it here we will
             # prevent future mistakes
             msg = "Incorrect usage"
             raise pluginlib.exc.ArgumentsError(msg)
 
+    def explain(self, query):
+        db = self.app.db
+
+        with db.record_queries() as recorder:
+            start = time.perf_counter()
+            srcs = self.app.selector.matches(query, auto_import=False)
+            elapsed = time.perf_counter() - start
+
+        print("Query:      {query}".format(query=repr(query)))
+        print("Matches:    {n} in {elapsed:.3f}s ({count} statements)".format(
+            n=len(srcs), elapsed=elapsed, count=len(recorder.statements)))
+
+        for (idx, (stmt, params, seconds)) in enumerate(recorder.statements):
+            print("")
+            print("[{idx}] {seconds:.3f}s".format(idx=idx + 1,
+                                                seconds=seconds))
+            print(stmt.strip())
+            if params:
+                print("Parameters: {params}".format(params=repr(params)))
+
+            try:
+                details, indexes = db.explain(stmt, params)
+            except NotImplementedError as e:
+                print(str(e))
+                continue
+
+            for detail in details:
+                print("  " + detail)
+
+            print("Indexes:    {indexes}".format(
+                indexes=', '.join(indexes) or 'none'))
+
     def migrations(self):
         migrations = [
             ('01_normalize-entities',
@@ -217,7 +297,10 @@ class Command(pluginlib.Command):
              self._migration_delete_entities_with_zero_sources),
 
             ('03_migration_delete_false_selections',
-             self._migration_delete_false_selections)
+             self._migration_delete_false_selections),
+
+            ('04_fill-media-columns',
+             self._migration_fill_media_columns)
         ]
 
         for (name, fn) in migrations:
@@ -228,33 +311,65 @@ class Command(pluginlib.Command):
 
     def _migration_normalize_entities(self):
         sess = self.app.db.session
+        mediainfo = self.app.mediainfo
+
+        # Sources are processed in batches, progress is kept in checkpoint
+        # so an interrupted migration continues where it stopped.
+        checkpoint = 'core.db.migration.01_normalize-entities.checkpoint'
+        last_id = self.app.variables.get(checkpoint, default=0)
 
-        qs = sess.query(models.Source)
-        count = qs.count()
+        count = sess.query(models.Source).filter(
+            models.Source.id > last_id).count()
 
         msg = "Rebuilding entities"
         pbar = _tqdm(total=count, desc=msg)
 
-        with _mute_logger(self.app.mediainfo.logger):
-            self.app.mediainfo.logger.setLevel(51)
+        with _mute_logger(mediainfo.logger):
+            for batch in mediainfo.batches(checkpoint=checkpoint):
+                prev = []
+                for src in batch:
+                    if src.entity:
+                        prev.append((src.entity, src.entity.selection))
+                    else:
+                        prev.append((None, None))
 
-            for (idx, src) in enumerate(qs):
-                if src.entity:
-                    prev_entity = src.entity
-                    prev_selection = src.entity.selection
-                else:
-                    prev_entity = None
-                    prev_selection = None
-
-                self.app.mediainfo.process(src)
+                mediainfo.process(*batch)
 
                 # Update previous selection if entity has changed
-                if prev_selection and prev_entity != src.entity:
-                    prev_selection.entity = src.entity
+                for (src, (prev_entity, prev_selection)) in zip(batch, prev):
+                    if prev_selection and prev_entity != src.entity:
+                        prev_selection.entity = src.entity
 
-                pbar.update()
+                pbar.update(len(batch))
+
+    def _migration_fill_media_columns(self):
+        sess = self.app.db.session
+
+        checkpoint = 'core.db.migration.04_fill-media-columns.checkpoint'
+        last_id = self.app.variables.get(checkpoint, default=0)
+
+        count = sess.query(models.Source).filter(
+            models.Source.id > last_id).count()
+
+        msg = "Filling media columns"
+        pbar = _tqdm(total=count, desc=msg)
 
-            sess.commit()
+        keys = [tag for (tag, column) in mediainfo.MEDIA_COLUMNS]
+        for batch in self.app.mediainfo.batches(checkpoint=checkpoint):
+            # Load tags for the whole batch at once
+            tags = collections.defaultdict(dict)
+            qs = sess.query(models.SourceTag).filter(
+                models.SourceTag.source_id.in_([x.id for x in batch]),
+                models.SourceTag.key.in_(keys))
+            for tag in qs:
+                tags[tag.source_id][tag.key] = tag.value
+
+            for src in batch:
+                values = mediainfo.media_columns(tags[src.id])
+                for (column, value) in values.items():
+                    setattr(src, column, value)
+
+            pbar.update(len(batch))
 
     def _migration_delete_entities_with_zero_sources(self):
         sess = self.app.db.session
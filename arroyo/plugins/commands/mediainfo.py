@@ -39,7 +39,22 @@ class MediainfoCommand(pluginlib.Command):
             action='store_true',
             dest='all',
             help=('Extract (and override) media info from all sources in the '
-                  'database')
+                  'database. Sources are processed in batches, an '
+                  'interrupted run is resumed on the next one')
+        ),
+        pluginlib.cliargument(
+            '--stale',
+            action='store_true',
+            dest='stale',
+            help=('With --all, only process sources extracted with an older '
+                  'parser')
+        ),
+        pluginlib.cliargument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=None,
+            help='Number of sources processed (and commited) at once'
         ),
     )
 
@@ -60,6 +75,19 @@ class MediainfoCommand(pluginlib.Command):
                    "specified. They are mutually exclusive.")
             raise pluginlib.exc.ArgumentsError(msg)
 
+        if arguments.stale and not all_:
+            msg = "'--stale' can only be used along with '--all'"
+            raise pluginlib.exc.ArgumentsError(msg)
+
+        if arguments.batch_size is not None:
+            if not all_:
+                msg = "'--batch-size' can only be used along with '--all'"
+                raise pluginlib.exc.ArgumentsError(msg)
+
+            if arguments.batch_size <= 0:
+                msg = "'--batch-size' must be greater than 0"
+                raise pluginlib.exc.ArgumentsError(msg)
+
         if item:
             src = db.get(models.Source, id=item)
             if not src:
@@ -67,13 +95,18 @@ class MediainfoCommand(pluginlib.Command):
                 msg = msg.format(id=item)
                 raise pluginlib.exc.ArgumentsError(msg)
 
-            srcs = [src]
+            mediainfo.process(src)
+            db.session.commit()
 
         elif all_:
-            srcs = db.session.query(models.Source)
-
-        mediainfo.process(*srcs)
-        self.app.db.session.commit()
+            checkpoint = 'mediainfo.checkpoint.{}'.format(
+                'stale' if arguments.stale else 'all')
+
+            batches = mediainfo.batches(batch_size=arguments.batch_size,
+                                        checkpoint=checkpoint,
+                                        stale=arguments.stale)
+            for batch in batches:
+                mediainfo.process(*batch)
 
 
 __arroyo_extensions__ = [
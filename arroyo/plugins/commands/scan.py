@@ -47,6 +47,13 @@ class ScanCommand(pluginlib.Command):
             default=1,
             help=('Iterations to run over base URI (Think about pages in a '
                   'website)')),
+        pluginlib.cliargument(
+            '--incremental',
+            dest='incremental',
+            action='store_true',
+            default=False,
+            help=('Stop iterating when only known or old sources are '
+                  'found')),
         pluginlib.cliargument(
             '-t', '--type',
             dest='type',
@@ -83,6 +90,7 @@ class ScanCommand(pluginlib.Command):
                 ('provider', str),
                 ('uri', str),
                 ('iterations', int),
+                ('incremental', bool),
                 ('type', str),
                 ('language', str)
             ]
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+from arroyo import (
+    importstats,
+    pluginlib
+)
+
+
+from appkit import loggertools
+
+
+models = pluginlib.models
+
+
+class StatsCommand(pluginlib.Command):
+    __extension_name__ = 'stats'
+
+    HELP = 'Show statistics'
+
+    def setup_argparser(cls, cmdargparser):
+        cls.opparser = cmdargparser.add_subparsers(dest='operation')
+
+        cls.importparser = cls.opparser.add_parser('import')
+        cls.importparser.add_argument(
+            '--runs',
+            dest='runs',
+            type=int,
+            default=10,
+            help='Number of runs to summarize (default: 10)')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.logger = loggertools.getLogger('stats')
+
+    def execute(self, app, arguments):
+        if arguments.operation == 'import':
+            self.show_import_stats(app, arguments.runs)
+
+        else:
+            msg = "Incorrect usage"
+            raise pluginlib.exc.ArgumentsError(msg)
+
+    def show_import_stats(self, app, n_runs):
+        query = app.db.session.query(models.ImportRun)
+        query = query.order_by(models.ImportRun.started.desc())
+        runs = query.limit(max(1, n_runs)).all()
+
+        if not runs:
+            msg = "No import runs recorded (see importer.stats-history)"
+            self.logger.warning(msg)
+            return
+
+        duration = sum(run.duration for run in runs)
+        print("Runs:      {n} (avg. {avg:.2f}s, last {last:.2f}s)".format(
+            n=len(runs), avg=duration / len(runs), last=runs[0].duration))
+
+        summary = importstats.summarize([run.stats for run in runs])
+
+        # Run-wide stages first, then origins sorted by time spent
+        def _total(key):
+            return sum(x[0] for x in summary[key]['timings'].values())
+
+        keys = sorted(summary, key=lambda k: (k != importstats.RUN,
+                                              -_total(k)))
+
+        for key in keys:
+            data = summary[key]
+
+            print("")
+            print("{key}".format(
+                key='All origins' if key == importstats.RUN else key))
+
+            timings = sorted(data['timings'].items(),
+                             key=lambda x: x[1][0], reverse=True)
+            for (stage, (seconds, calls)) in timings:
+                print("  {stage:<14} {seconds:>10.3f}s {calls:>7} calls "
+                      "{avg:>9.3f}s avg".format(
+                          stage=stage, seconds=seconds, calls=calls,
+                          avg=seconds / calls if calls else 0))
+
+            for (counter, value) in sorted(data['counters'].items()):
+                print("  {counter:<14} {value:>11}".format(
+                    counter=counter, value=value))
+
+
+__arroyo_extensions__ = [
+    StatsCommand
+]
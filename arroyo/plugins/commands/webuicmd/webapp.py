@@ -26,9 +26,10 @@ class WebApp(FlaskAPI):
         def before_request():
             g.app = app
 
-        # @server.after_request
-        # def shutdown_session(response):
-        #     g.app.db.remove()
-        #     return response
+        # Each request is handled from its own thread (and session, see
+        # Db.session), its connection must go back to the pool once done
+        @self.teardown_appcontext
+        def shutdown_session(exc=None):
+            app.db.session.remove()
 
         # self.wsgi_app = ProxyFix(self.wsgi_app)
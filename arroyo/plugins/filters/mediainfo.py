@@ -21,27 +21,44 @@
 # FIXME:
 # Keep in sync with method Selector._query_params_from_keyword
 
+# Filters work over Source media columns (see mediainfo.MEDIA_COLUMNS), values
+# are stored in lower case. For tags with multiple values (ex. release groups
+# or containers) only the first value is stored, so filters only match the
+# first one.
+# Columns of sources processed before they existed are filled by
+# 'db --upgrade', a warning is logged until then (see
+# Mediainfo.check_media_columns)
+
 import re
-from arroyo import (
-    mediainfo,
-    pluginlib
-)
+from arroyo import pluginlib
+
+
+import sqlalchemy
+
 
 models = pluginlib.models
 
 
-class CodecFilter(pluginlib.IterableFilter):
+def _listify(value):
+    if not isinstance(value, list):
+        value = [x.strip() for x in value.split(',')]
+
+    return [x.lower() for x in value]
+
+
+class CodecFilter(pluginlib.QuerySetFilter):
     __extension_name__ = 'codec'
 
     APPLIES_TO = models.Source
     HANDLES = ['codec']
 
-    def filter(self, key, value, item):
-        item_video_codec = item.tag_dict.get(mediainfo.Tags.VIDEO_CODEC, '')
-        return (value.lower() == item_video_codec.lower())
+    def alter(self, key, value, qs):
+        self.app.mediainfo.check_media_columns()
+
+        return qs.filter(models.Source.video_codec == value.lower())
 
 
-class Container(pluginlib.IterableFilter):
+class Container(pluginlib.QuerySetFilter):
     """
     Note: Container is the first extension found in item.name.
     Ex:
@@ -55,45 +72,34 @@ class Container(pluginlib.IterableFilter):
     APPLIES_TO = models.Source
     HANDLES = ['container', 'container-in', 'mimetype', 'mimetype-in']
 
-    def filter(self, key, value, item):
-        if key.endswith('-in'):
-            if not isinstance(value, list):
-                value = [x.strip() for x in value.split(',')]
+    def alter(self, key, value, qs):
+        self.app.mediainfo.check_media_columns()
 
+        if key.endswith('-in'):
+            value = _listify(value)
             key = key[:-3]  # Strip -in suffix
 
         else:
-            value = [value]
-
-        container = item.tag_dict.get(
-            mediainfo.Tags.MEDIA_CONTAINER, '').lower()
-        mimetype = item.tag_dict.get(
-            mediainfo.Tags.MIMETYPE, '').lower()
-
-        # Container can be a list for some broken sources like:
-        # Foo.S01.E01.720p.HDTV.X264-DIMENSION.mkv[eztv].avi
+            value = [value.lower()]
 
-        # For this reason we are going to convert container and mimetypes
-        # into lists in order to "simplify" codepaths
-        if not isinstance(container, list):
-            containers = [container]
-        containers = [x.lower() for x in containers]
-        mimetypes = [mimetype.lower()]
-
-        stack = containers if key == 'container' else mimetypes
-        needles = [x.lower() for x in value]
+        if key == 'container':
+            column = models.Source.container
+        else:
+            column = models.Source.mimetype
 
-        return any([x in stack for x in needles])
+        return qs.filter(column.in_(value))
 
 
-class QualityFilter(pluginlib.IterableFilter):
+class QualityFilter(pluginlib.QuerySetFilter):
     __extension_name__ = 'quality'
 
     APPLIES_TO = models.Source
     HANDLES = ['quality']
     _SUPPORTED = ['1080p', '720p', '480p', 'hdtv']
 
-    def filter(self, key, value, item):
+    def alter(self, key, value, qs):
+        self.app.mediainfo.check_media_columns()
+
         value = value.lower()
 
         if value not in self._SUPPORTED:
@@ -108,70 +114,56 @@ class QualityFilter(pluginlib.IterableFilter):
 
             raise ValueError(msg)
 
-        screen_size = item.tag_dict.get(
-            mediainfo.Tags.VIDEO_SCREEN_SIZE, '').lower()
-        fmt = item.tag_dict.get(
-            mediainfo.Tags.VIDEO_FORMAT, '').lower()
-
         # Check for plain HDTV (in fact it means no 720p or anything else)
         if value == 'hdtv':
-            is_match = not screen_size and fmt == 'hdtv'
+            return qs.filter(
+                models.Source.screen_size.is_(None),
+                models.Source.video_format == 'hdtv')
 
         else:
-            is_match = value == screen_size
-
-        return is_match
+            return qs.filter(models.Source.screen_size == value)
 
 
-class ReleaseGroupFilter(pluginlib.IterableFilter):
+class ReleaseGroupFilter(pluginlib.QuerySetFilter):
     __extension_name__ = 'release-group'
 
     APPLIES_TO = models.Source
     HANDLES = ['release-group', 'release-group-in']
 
-    def filter(self, key, value, item):
+    def alter(self, key, value, qs):
+        self.app.mediainfo.check_media_columns()
+
         if key == 'release-group':
             if not isinstance(value, str):
                 raise ValueError(value)
-            value = [value]
+            groups = [value.lower()]
 
-        if key == 'release-group-in':
-            if not isinstance(value, list):
-                value = [x.strip() for x in value.split(',')]
-
-        item_rg = item.tag_dict.get(mediainfo.Tags.RELEASE_GROUP, '').lower()
-        if not item_rg:
-            return False
+        else:
+            groups = _listify(value)
 
-        groups = [x.lower() for x in value]
         if not groups:
-            return False
+            return qs.filter(sqlalchemy.false())
 
-        return item_rg in groups
+        return qs.filter(models.Source.release_group.in_(groups))
 
 
-class RipFormatFilter(pluginlib.IterableFilter):
+class RipFormatFilter(pluginlib.QuerySetFilter):
     __extension_name__ = 'ripformat'
 
     APPLIES_TO = models.Source
     HANDLES = ['rip-format']
 
-    def filter(self, key, value, item):
+    def alter(self, key, value, qs):
+        self.app.mediainfo.check_media_columns()
+
         if not isinstance(value, str):
             raise TypeError(value)
 
         if not value or not re.match(r'^[0-9a-z\-]+$', value, re.IGNORECASE):
             raise ValueError(value)
 
-        itemformat = item.tag_dict.get(
-            mediainfo.Tags.VIDEO_FORMAT, '')
-
-        if not isinstance(itemformat, str):
-            msg = "Item {item} has multiple formats ({formats}). Not supported"
-            msg = msg.format(item=item, formats=repr(itemformat))
-            raise ValueError(msg)
+        return qs.filter(models.Source.video_format == value.lower())
 
-        return itemformat.lower() == value.lower()
 
 __arroyo_extensions__ = [
     Container,
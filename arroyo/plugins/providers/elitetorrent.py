@@ -35,6 +35,7 @@ from appkit import utils
 
 class EliteTorrent(pluginlib.Provider):
     __extension_name__ = 'elitetorrent'
+    POOL_SAFE = True
 
     DEFAULT_URI = 'http://www.elitetorrent.net/descargas/'
     SEARCH_URI = ('http://www.elitetorrent.net/resultados/{query}'
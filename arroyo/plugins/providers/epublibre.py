@@ -26,6 +26,7 @@ from urllib import parse
 
 class Epublibre(pluginlib.Provider):
     __extension_name__ = 'epublibre'
+    POOL_SAFE = True
 
     DEFAULT_URI = 'https://epublibre.org/catalogo/index/0/nuevo/novedades/sin/todos'  # nopep8
     URI_PATTERNS = [
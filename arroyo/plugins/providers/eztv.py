@@ -31,6 +31,7 @@ from appkit import utils
 
 class Eztv(pluginlib.Provider):
     __extension_name__ = 'eztv'
+    POOL_SAFE = True
 
     _BASE_DOMAIN = 'https://eztv.ag'
     DEFAULT_URI = _BASE_DOMAIN + '/page_0'
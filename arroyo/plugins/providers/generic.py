@@ -30,6 +30,7 @@ from appkit import loggertools
 
 class Provider(pluginlib.Provider):
     __extension_name__ = 'generic'
+    POOL_SAFE = True
 
     DEFAULT_URI = None
 
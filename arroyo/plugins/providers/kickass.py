@@ -36,6 +36,7 @@ from appkit import (
 
 class KickAss(pluginlib.Provider):
     __extension_name__ = 'kickass'
+    POOL_SAFE = True
 
     BASE_URI = 'https://kickass.cd'
     DEFAULT_URI = BASE_URI + '/new/'
@@ -43,6 +44,11 @@ class KickAss(pluginlib.Provider):
         r'^http(s)?://([^.]\.)?kickass.[^.]{2,3}/',
         r'^http(s)?://([^.]\.)?kat.[^.]{2,3}/',
     ]
+    MIRRORS = [
+        BASE_URI,
+        'https://kickass.cm',
+        'https://kat.cr'
+    ]
 
     _TYPES = {
         'audio': 'other',
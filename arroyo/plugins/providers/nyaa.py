@@ -33,6 +33,7 @@ from appkit import uritools
 
 class Nyaa(pluginlib.Provider):
     __extension_name__ = 'nyaa'
+    POOL_SAFE = True
 
     DEFAULT_URI = 'https://www.nyaa.se/?sort=0&order=1'
     URI_PATTERNS = [
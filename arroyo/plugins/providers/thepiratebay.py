@@ -40,6 +40,7 @@ class _CategoryUnknowError(Exception):
 
 class ThePirateBay(pluginlib.Provider):
     __extension_name__ = 'thepiratebay'
+    POOL_SAFE = True
 
     # URL structure:
     # https://thepiratebay.cr/search.php?q={q}&page={page}&orderby=99
@@ -59,6 +60,11 @@ class ThePirateBay(pluginlib.Provider):
     URI_PATTERNS = [
         r'^http(s)?://([^.]+.)?thepiratebay\.[^.]{2,3}/(?!rss/)'
     ]
+    MIRRORS = [
+        '{proto}://thepiratebay.{tld}'.format(proto=PROTO, tld=TLD),
+        'https://thepiratebay.se',
+        'https://thepiratebay.cr'
+    ]
 
     SEARCH_URL_PATTERN = (
         "{proto}://thepiratebay.{tld}".format(proto=PROTO, tld=TLD) +
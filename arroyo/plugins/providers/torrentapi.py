@@ -49,7 +49,6 @@ from appkit import uritools
 from urllib import parse
 
 
-import aiohttp
 import arrow
 
 
@@ -69,6 +68,11 @@ class TorrentAPI(pluginlib.Provider):
     TOKEN_URL = r'http://torrentapi.org/pubapi_v2.php?get_token=get_token&app_id=arroyo'
     SEARCH_URL = r'http://torrentapi.org/pubapi_v2.php?mode=search&app_id=arroyo'
 
+    # torrentapi allows one request each two seconds
+    HOST_LIMITS = {
+        'torrentapi.org': {'rate': 0.5, 'burst': 1, 'max-connections': 1}
+    }
+
     CATEGORY_MAP = {
         'episode': 'tv',
         'movie': 'movies'
@@ -80,12 +84,10 @@ class TorrentAPI(pluginlib.Provider):
         self.logger = self.app.logger.getChild('torrentapi')
         self.token = None
         self.token_ts = 0
-        self.token_last_use = 0
 
     @asyncio.coroutine
     def fetch(self, fetcher, uri):
-        yield from self.refresh_token()
-        yield from asyncio.sleep(0.5)
+        yield from self.refresh_token(fetcher)
         uri = uritools.alter_query_params(
             uri,
             dict(
@@ -97,30 +99,16 @@ class TorrentAPI(pluginlib.Provider):
         return (yield from super().fetch(fetcher, uri))
 
     @asyncio.coroutine
-    def refresh_token(self):
-        # Refresh token if it's older than 15M
-        if time.time() - self.token_ts >= 15*60:
-            conn = aiohttp.TCPConnector(verify_ssl=False)
-            client = aiohttp.ClientSession(connector=conn)
-            resp = yield from client.get(self.TOKEN_URL)
-            buff = yield from resp.content.read()
-            yield from resp.release()
-            yield from client.close()
-
-            self.token = json.loads(buff.decode('utf-8'))['token']
-            self.token_ts = time.time()
-            self.token_last_use = None
-            return
-
-        # No need to throttle
-        if self.token_last_use is None:
+    def refresh_token(self, fetcher):
+        # Refresh token if it's older than 15M.
+        # Requests are paced by the fetcher, see HOST_LIMITS
+        if time.time() - self.token_ts < 15*60:
             return
 
-        # throttle
-        now = time.time()
-        since_last_use = self.token_last_use - now
-        if since_last_use < 2:
-            yield from asyncio.sleep(2 - since_last_use)
+        resp, buff = yield from fetcher.fetch_full(self.TOKEN_URL,
+                                                   skip_cache=True)
+        self.token = json.loads(buff.decode('utf-8'))['token']
+        self.token_ts = time.time()
 
     def parse(self, buff):
         def convert_data(e):
@@ -30,6 +30,7 @@ from appkit import uritools
 
 class Yts(pluginlib.Provider):
     __extension_name__ = 'yts'
+    POOL_SAFE = True
 
     DEFAULT_URI = 'https://yts.ag/browse-movies'
     URI_PATTERNS = [
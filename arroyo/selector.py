@@ -26,6 +26,7 @@ import types
 
 
 from appkit import loggertools
+from sqlalchemy import orm
 
 
 import arroyo.exc
@@ -38,6 +39,54 @@ from arroyo import (
 )
 
 
+class LoadingPlan:
+    """Relationships of sources eager-loaded by Selector.matches.
+
+    Each one is loaded with one additional SELECT for all the matching
+    sources instead of a lazy load for each source. Later stages
+    (filters, sorters, grouping) use them.
+    """
+    TAGS = 'tags'  # Source.tag_list, see Source.tag_dict
+    ENTITY = 'entity'  # Episode or Movie and its selection
+    DOWNLOAD = 'download'
+
+    DEFAULT = (TAGS, ENTITY, DOWNLOAD)
+
+    @classmethod
+    def options(cls, plan):
+        """Query options for plan.
+
+        Arguments:
+          plan - Iterable of LoadingPlan values
+        Return:
+          A list of query options.
+        """
+        # Backrefs (Source.download, Episode.selection...) don't exist until
+        # mappers are configured
+        orm.configure_mappers()
+
+        ret = []
+        for x in plan:
+            if x == cls.TAGS:
+                ret.append(orm.subqueryload(models.Source.tag_list))
+
+            elif x == cls.ENTITY:
+                ret.extend([
+                    orm.subqueryload(models.Source.episode).
+                    subqueryload(models.Episode.selection),
+                    orm.subqueryload(models.Source.movie).
+                    subqueryload(models.Movie.selection)
+                ])
+
+            elif x == cls.DOWNLOAD:
+                ret.append(orm.subqueryload(models.Source.download))
+
+            else:
+                raise ValueError(x)
+
+        return ret
+
+
 class FilterNotFoundError(Exception):
     pass
 
@@ -177,7 +226,18 @@ class Selector:
 
         return registry
 
-    def matches(self, query, auto_import=None):
+    def matches(self, query, auto_import=None, loading_plan=None):
+        """Find sources matching query.
+
+        Arguments:
+          query - coretypes.BaseQuery
+          auto_import - Run the importer for query first, see
+            Selector.maybe_run_importer_process
+          loading_plan - Relationships to eager-load, LoadingPlan.DEFAULT
+            by default. Use an empty tuple to disable eager-loading.
+        Return:
+          A list of sources.
+        """
         def _count(x):
             try:
                 return len(x)
@@ -207,6 +267,10 @@ class Selector:
         else:
             raise ValueError(query)
 
+        if loading_plan is None:
+            loading_plan = LoadingPlan.DEFAULT
+        qs = qs.options(*LoadingPlan.options(loading_plan))
+
         # qs = query.get_query(self.app.db.session)
         qs_models = itertools.chain(qs._entities, qs._join_entities)
         qs_models = [x.mapper.class_ for x in qs_models]
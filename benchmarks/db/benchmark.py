@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+# SQLite storage profile benchmark.
+#
+# Compares SQLite defaults ('legacy') with the db.sqlite.* defaults from
+# arroyo.core ('tuned') on a database file:
+# - import: sources inserted in batches, one commit per batch (like the
+#   importer does)
+# - reads: reader threads querying sources while a writer keeps committing
+#   batches (like the webui while cron imports)
+#
+# Usage:
+#   python3 benchmarks/db/benchmark.py
+#   python3 benchmarks/db/benchmark.py --sources 100000 --readers 8
+
+
+import argparse
+import collections
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+
+D = os.path.dirname(os.path.realpath(__file__))
+ROOT = os.path.dirname(os.path.dirname(D))
+sys.path.insert(0, ROOT)
+
+
+from appkit.db import sqlalchemyutils as sautils  # noqa
+from sqlalchemy import (  # noqa
+    exc,
+    orm
+)
+from arroyo import (  # noqa
+    core,
+    db,
+    models
+)
+
+
+PROFILES = collections.OrderedDict([
+    ('legacy', {}),
+    ('tuned', {
+        key[len('db.sqlite.'):]: value
+        for (key, value) in core._defaults.items()
+        if key.startswith('db.sqlite.')
+    })
+])
+
+
+def build_sources(start, n):
+    now = int(time.time())
+    return [
+        {
+            'provider': 'benchmark',
+            'name': 'Series.S01E{:04d}.720p.HDTV.x264-GROUP'.format(idx),
+            'uri': 'magnet:?xt=urn:btih:{:040x}'.format(idx),
+            'urn': 'urn:btih:{:040x}'.format(idx),
+            'created': now,
+            'last_seen': now,
+            'seeds': idx % 100,
+        }
+        for idx in range(start, start + n)
+    ]
+
+
+def insert_batch(engine, start, n):
+    with engine.begin() as conn:
+        conn.execute(models.Source.__table__.insert(),
+                     build_sources(start, n))
+
+
+def bench_import(engine, args):
+    start = time.perf_counter()
+    for idx in range(0, args.sources, args.batch_size):
+        insert_batch(engine, idx, min(args.batch_size, args.sources - idx))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'seconds': elapsed,
+        'ops': args.sources,
+        'ops_per_sec': args.sources / elapsed,
+        'errors': 0
+    }
+
+
+def bench_reads(engine, args):
+    # Same session handling as arroyo.db.Db
+    session = orm.scoped_session(orm.sessionmaker(bind=engine))
+    stop = threading.Event()
+    counters = collections.Counter()
+    lock = threading.Lock()
+
+    def _writer():
+        idx = args.sources
+        while not stop.is_set():
+            try:
+                insert_batch(engine, idx, args.batch_size)
+            except exc.OperationalError:
+                with lock:
+                    counters['errors'] += 1
+            idx += args.batch_size
+
+    def _reader():
+        while not stop.is_set():
+            try:
+                session.query(models.Source).filter(
+                    models.Source.seeds > 50
+                ).order_by(models.Source.id.desc()).limit(50).all()
+                with lock:
+                    counters['reads'] += 1
+
+            except exc.OperationalError:
+                with lock:
+                    counters['errors'] += 1
+
+            finally:
+                # Return the connection to the pool between reads, like
+                # threads handling webui requests
+                session.remove()
+
+    threads = [threading.Thread(target=_writer)]
+    threads.extend(threading.Thread(target=_reader)
+                   for _ in range(args.readers))
+
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'seconds': elapsed,
+        'ops': counters['reads'],
+        'ops_per_sec': counters['reads'] / elapsed,
+        'errors': counters['errors']
+    }
+
+
+def run(args):
+    results = collections.OrderedDict()
+
+    for (profile, options) in PROFILES.items():
+        tmpdir = tempfile.mkdtemp()
+        try:
+            uri = 'sqlite:///' + os.path.join(tmpdir, 'arroyo.db')
+            engine = db.create_engine(uri, sqlite_options=options)
+            sautils.Base.metadata.create_all(engine)
+
+            results[profile + ' import'] = bench_import(engine, args)
+            results[profile + ' reads'] = bench_reads(engine, args)
+            engine.dispose()
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+    return results
+
+
+def print_results(results):
+    fmt = '{:<15} {:>9} {:>9} {:>11} {:>7}'
+    print(fmt.format('stage', 'seconds', 'ops', 'ops/s', 'errors'))
+
+    for (name, res) in results.items():
+        print(fmt.format(
+            name,
+            '{:.3f}'.format(res['seconds']),
+            res['ops'],
+            '{:.1f}'.format(res['ops_per_sec']),
+            res['errors']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite profile benchmark')
+    parser.add_argument(
+        '--sources', type=int, default=20000,
+        help='Number of sources to import')
+    parser.add_argument(
+        '--batch-size', type=int, default=100,
+        help='Sources inserted in each transaction')
+    parser.add_argument(
+        '--readers', type=int, default=4,
+        help='Number of reader threads')
+    parser.add_argument(
+        '--duration', type=float, default=5,
+        help='Seconds to run the concurrent reads test')
+    args = parser.parse_args()
+
+    print_results(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+# Importer benchmark.
+#
+# Runs the importer stages (fetch, parse, normalize, db, mediainfo) over the
+# recorded samples in tests/www-samples using a ReplayFetcher, so no network
+# access is needed. For each stage pages/s, psources/s and peak RSS are
+# reported. Results are appended to results.jsonl to compare runs over time.
+#
+# Usage:
+#   python3 benchmarks/importer/benchmark.py
+#   python3 benchmarks/importer/benchmark.py --synthetic 100000 --compare
+
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from urllib import parse
+
+
+D = os.path.dirname(os.path.realpath(__file__))
+ROOT = os.path.dirname(os.path.dirname(D))
+sys.path.insert(0, ROOT)
+
+
+from arroyo import core  # noqa
+
+
+SAMPLES_PATH = os.path.join(ROOT, 'tests', 'www-samples')
+RESULTS_PATH = os.path.join(D, 'results.jsonl')
+
+
+def build_app(args):
+    settings = {
+        'async-max-concurrency': 5,
+        'auto-cron': False,
+        'auto-import': False,
+        'db-uri': args.db_uri,
+        'downloader': 'mock',
+        'fetcher.enable-cache': False,
+        'fetcher.cache-delta': 0,
+        'fetcher.replay-path': args.samples,
+        'importer.bulk-upsert': args.bulk_upsert,
+        'importer.parse-workers': args.parse_workers,
+        'importer.parser': 'auto',
+        'log-level': 'ERROR',
+        'log-format': '%(message)s',
+    }
+    settings.update({
+        'plugins.{}.enabled'.format(x): True
+        for x in core._plugins
+    })
+
+    return core.Arroyo(core.ArroyoStore(settings))
+
+
+def peak_rss():
+    # KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=ROOT, stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Stages:
+    def __init__(self):
+        self.results = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        counters = {'pages': 0, 'psources': 0}
+        start = time.perf_counter()
+        yield counters
+        elapsed = time.perf_counter() - start
+
+        res = {
+            'seconds': elapsed,
+            'peak_rss_kib': peak_rss()
+        }
+        for (k, v) in counters.items():
+            res[k] = v
+            res[k + '_per_sec'] = v / elapsed if elapsed else None
+
+        self.results[name] = res
+
+
+def synthesize(parsed, n):
+    """Build n psources from parsed ones with unique URNs"""
+    ret = []
+
+    for idx in range(n):
+        origin, psrc = parsed[idx % len(parsed)]
+        psrc = dict(psrc)
+
+        urn = hashlib.sha1(
+            'arroyo-benchmark-{}'.format(idx).encode('ascii')).hexdigest()
+        psrc['uri'] = 'magnet:?xt=urn:btih:{urn}&dn={name}'.format(
+            urn=urn, name=parse.quote_plus(psrc['name']))
+        ret.append((origin, psrc))
+
+    return ret
+
+
+def run(args):
+    app = build_app(args)
+    importer = app.importer
+    loop = asyncio.get_event_loop()
+    stages = Stages()
+
+    # Build origins for each recorded URI, skip those without a provider
+    uris_and_origins = []
+    for uri in sorted(app.fetcher.index):
+        origin = importer.origin_from_params(uri=uri)
+        if origin.provider.__extension_name__ != 'generic':
+            uris_and_origins.append((uri, origin))
+
+    # Fetch
+    with stages.measure('fetch') as counters:
+        buffers = loop.run_until_complete(asyncio.gather(*[
+            app.fetcher.fetch(uri) for (uri, origin) in uris_and_origins
+        ]))
+        counters['pages'] = len(buffers)
+
+    # Parse
+    with stages.measure('parse') as counters:
+        results = loop.run_until_complete(asyncio.gather(*[
+            importer.parse_buffer(origin, buff)
+            for ((uri, origin), buff) in zip(uris_and_origins, buffers)
+        ]))
+
+        parsed = []
+        for ((uri, origin), psrcs) in zip(uris_and_origins, results):
+            parsed.extend([(origin, x) for x in psrcs])
+
+        counters['pages'] = len(buffers)
+        counters['psources'] = len(parsed)
+
+    if args.synthetic:
+        parsed = synthesize(parsed, args.synthetic)
+
+    # Normalize
+    with stages.measure('normalize') as counters:
+        data = []
+        for (origin, psrc) in parsed:
+            data.extend(importer._normalize_source_data(origin, dict(psrc)))
+
+        counters['psources'] = len(data)
+
+    # Database, mediainfo is measured on its own stage
+    mediainfo_process = app.mediainfo.process
+    app.mediainfo.process = lambda *args: None
+
+    with stages.measure('db') as counters:
+        sources = importer.process_source_data(*[dict(x) for x in data])
+        counters['psources'] = len(data)
+
+    if args.update:
+        with stages.measure('db-update') as counters:
+            importer.process_source_data(*[dict(x) for x in data])
+            counters['psources'] = len(data)
+
+    app.mediainfo.process = mediainfo_process
+
+    # Mediainfo
+    with stages.measure('mediainfo') as counters:
+        app.mediainfo.process(*[(src, {}) for src in sources])
+        app.db.session.commit()
+        counters['psources'] = len(sources)
+
+    return stages.results
+
+
+def load_results(path):
+    try:
+        with open(path, encoding='utf-8') as fh:
+            return [json.loads(line) for line in fh if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def same_params(a, b):
+    keys = ['synthetic', 'bulk_upsert', 'parse_workers', 'update']
+    return all(a['params'].get(k) == b['params'].get(k) for k in keys)
+
+
+def print_results(record, previous=None):
+    fmt = '{:<10} {:>9} {:>11} {:>13} {:>12} {:>10}'
+    print(fmt.format('stage', 'seconds', 'pages/s', 'psources/s',
+                     'peak rss', 'vs prev'))
+
+    for (name, res) in record['stages'].items():
+        cmp = ''
+        if previous and name in previous['stages']:
+            prev = previous['stages'][name]['seconds']
+            if prev:
+                cmp = '{:+.1%}'.format(res['seconds'] / prev - 1)
+
+        print(fmt.format(
+            name,
+            '{:.3f}'.format(res['seconds']),
+            '{:.1f}'.format(res['pages_per_sec'] or 0),
+            '{:.1f}'.format(res['psources_per_sec'] or 0),
+            '{} KiB'.format(res['peak_rss_kib']),
+            cmp))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Importer benchmark')
+    parser.add_argument(
+        '--samples', default=SAMPLES_PATH,
+        help='Directory with recorded responses and its index.json')
+    parser.add_argument(
+        '--db-uri', default='sqlite:///:memory:')
+    parser.add_argument(
+        '--synthetic', type=int, default=0,
+        help='Generate this number of psources from the parsed ones')
+    parser.add_argument(
+        '--bulk-upsert', action='store_true', default=False)
+    parser.add_argument(
+        '--parse-workers', type=int, default=0)
+    parser.add_argument(
+        '--update', action='store_true', default=False,
+        help='Import data a second time to measure the update path')
+    parser.add_argument(
+        '--results', default=RESULTS_PATH,
+        help='File to append results to')
+    parser.add_argument(
+        '--label', default=None,
+        help='Free text stored with results')
+    parser.add_argument(
+        '--compare', action='store_true', default=False,
+        help='Compare with the last stored run with the same parameters')
+    parser.add_argument(
+        '--no-save', dest='save', action='store_false', default=True)
+    args = parser.parse_args()
+
+    record = {
+        'timestamp': int(time.time()),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'label': args.label,
+        'params': {
+            'synthetic': args.synthetic,
+            'bulk_upsert': args.bulk_upsert,
+            'parse_workers': args.parse_workers,
+            'update': args.update,
+            'db_uri': args.db_uri,
+        },
+        'stages': run(args)
+    }
+
+    previous = None
+    if args.compare:
+        candidates = [x for x in load_results(args.results)
+                      if same_params(x, record)]
+        previous = candidates[-1] if candidates else None
+
+    print_results(record, previous)
+
+    if args.save:
+        with open(args.results, 'a', encoding='utf-8') as fh:
+            fh.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
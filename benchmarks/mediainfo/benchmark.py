@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+# Mediainfo parser benchmark.
+#
+# Parses the names from the recorded samples in tests/www-samples (or from a
+# file, one name per line) with the scene fast path, with guessit and with
+# mediainfo.parse() with and without the fast path. names/s and the number
+# of names handled by each path are reported.
+#
+# Usage:
+#   python3 benchmarks/mediainfo/benchmark.py
+#   python3 benchmarks/mediainfo/benchmark.py --names names.txt --repeat 5
+
+
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import time
+
+
+D = os.path.dirname(os.path.realpath(__file__))
+ROOT = os.path.dirname(os.path.dirname(D))
+sys.path.insert(0, ROOT)
+
+
+import guessit  # noqa
+from arroyo import (  # noqa
+    core,
+    mediainfo
+)
+
+
+SAMPLES_PATH = os.path.join(ROOT, 'tests', 'www-samples')
+
+
+def build_app(args):
+    settings = {
+        'auto-cron': False,
+        'auto-import': False,
+        'db-uri': 'sqlite:///:memory:',
+        'downloader': 'mock',
+        'fetcher.enable-cache': False,
+        'fetcher.cache-delta': 0,
+        'fetcher.replay-path': args.samples,
+        'log-level': 'ERROR',
+        'log-format': '%(message)s',
+    }
+    settings.update({
+        'plugins.{}.enabled'.format(x): True
+        for x in core._plugins
+    })
+
+    return core.Arroyo(core.ArroyoStore(settings))
+
+
+def sample_names(args):
+    app = build_app(args)
+    importer = app.importer
+    loop = asyncio.get_event_loop()
+
+    origins = []
+    for uri in sorted(app.fetcher.index):
+        origin = importer.origin_from_params(uri=uri)
+        if origin.provider.__extension_name__ != 'generic':
+            origins.append(origin)
+
+    buffers = loop.run_until_complete(asyncio.gather(*[
+        app.fetcher.fetch(origin.uri) for origin in origins
+    ]))
+    results = loop.run_until_complete(asyncio.gather(*[
+        importer.parse_buffer(origin, buff)
+        for (origin, buff) in zip(origins, buffers)
+    ]))
+
+    return [psrc['name'] for psrcs in results for psrc in psrcs]
+
+
+def _guessit(name):
+    try:
+        return guessit.guessit(name)
+    except guessit.api.GuessitException:
+        return None
+
+
+def _parse(name):
+    try:
+        return mediainfo.parse(name)
+    except mediainfo.ParseError:
+        return None
+
+
+def _parse_without_fast_path(name):
+    orig = mediainfo._scene_parse
+    mediainfo._scene_parse = lambda *args, **kwargs: None
+    try:
+        return _parse(name)
+    finally:
+        mediainfo._scene_parse = orig
+
+
+def measure(fn, names, repeat):
+    hits = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        hits = sum(1 for name in names if fn(name) is not None)
+    elapsed = time.perf_counter() - start
+
+    n = len(names) * repeat
+    return {
+        'seconds': elapsed,
+        'names': len(names),
+        'hits': hits,
+        'names_per_sec': n / elapsed if elapsed else None
+    }
+
+
+def run(args):
+    if args.names:
+        with open(args.names, encoding='utf-8') as fh:
+            names = [x.strip() for x in fh if x.strip()]
+    else:
+        names = sample_names(args)
+
+    results = collections.OrderedDict()
+    results['scene'] = measure(mediainfo._scene_parse, names, args.repeat)
+    results['guessit'] = measure(_guessit, names, args.repeat)
+    results['parse'] = measure(_parse, names, args.repeat)
+    results['parse-guessit'] = measure(_parse_without_fast_path, names,
+                                       args.repeat)
+
+    return results
+
+
+def print_results(results):
+    fmt = '{:<14} {:>9} {:>8} {:>8} {:>12}'
+    print(fmt.format('path', 'seconds', 'names', 'hits', 'names/s'))
+
+    for (name, res) in results.items():
+        print(fmt.format(
+            name,
+            '{:.3f}'.format(res['seconds']),
+            res['names'],
+            res['hits'],
+            '{:.1f}'.format(res['names_per_sec'] or 0)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mediainfo benchmark')
+    parser.add_argument(
+        '--samples', default=SAMPLES_PATH,
+        help='Directory with recorded responses and its index.json')
+    parser.add_argument(
+        '--names', default=None,
+        help='File with names to parse, one per line')
+    parser.add_argument(
+        '--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    print_results(run(args))
+
+
+if __name__ == '__main__':
+    main()
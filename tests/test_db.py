@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+
+from arroyo import (
+    db,
+    models,
+    pluginlib
+)
+import testapp
+
+
+class SQLiteOptionsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.uri = 'sqlite:///' + os.path.join(self.tmpdir, 'arroyo.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def pragma(self, engine, name):
+        with engine.connect() as conn:
+            return conn.execute('PRAGMA ' + name).scalar()
+
+    def test_pragmas(self):
+        engine = db.create_engine(self.uri, sqlite_options={
+            'wal': True,
+            'synchronous': 'normal',
+            'cache-size': 1024,
+            'mmap-size': 1024 * 1024,
+        })
+
+        self.assertEqual(self.pragma(engine, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(engine, 'synchronous'), 1)
+        self.assertEqual(self.pragma(engine, 'cache_size'), -1024)
+
+    def test_defaults(self):
+        engine = db.create_engine(self.uri)
+        self.assertEqual(self.pragma(engine, 'journal_mode'), 'delete')
+
+    def test_invalid_synchronous(self):
+        with self.assertRaises(ValueError):
+            db.create_engine(self.uri, sqlite_options={'synchronous': 'foo'})
+
+    def test_session_per_thread(self):
+        app = testapp.TestApp({'db-uri': self.uri})
+        app.insert_sources(testapp.mock_source('foo'))
+
+        sessions = []
+        counts = []
+
+        def _read():
+            try:
+                sessions.append(app.db.session())
+                counts.append(app.db.session.query(models.Source).count())
+            finally:
+                app.db.session.remove()
+
+        t = threading.Thread(target=_read)
+        t.start()
+        t.join()
+
+        self.assertEqual(counts, [1])
+        self.assertFalse(sessions[0] is app.db.session())
+
+        # Thread's connection is back in the pool
+        app.db.session.remove()
+        self.assertEqual(app.db.engine.pool.checkedout(), 0)
+
+
+class ExplainTest(unittest.TestCase):
+    def test_explain(self):
+        app = testapp.TestApp({
+            'plugins.filters.sourcefields.enabled': True,
+        })
+        app.insert_sources(
+            testapp.mock_source('foo', language='eng-us', created=0),
+            testapp.mock_source('bar', language='spa-es', created=0))
+
+        query = app.selector.query_from_args(params={
+            'language': 'eng-us',
+            'age-min': '1H'
+        })
+        with app.db.record_queries() as recorder:
+            srcs = app.selector.matches(query, auto_import=False,
+                                        loading_plan=())
+
+        self.assertEqual([x.name for x in srcs], ['foo'])
+        stmt, params, seconds = recorder.statements[0]
+        details, indexes = app.db.explain(stmt, params)
+        self.assertEqual(indexes, ['ix_source_language_created'])
+
+    def test_arguments_require_explain(self):
+        app = testapp.TestApp({
+            'plugins.commands.db.enabled': True,
+        })
+        cmd = app.get_extension(pluginlib.Command, 'db')
+
+        def _arguments(**kwargs):
+            d = {x: False for x in [
+                'archive_all', 'archive_source_id', 'shell', 'reset',
+                'reset_source_id', 'reset_states', 'upgrade', 'explain']}
+            d.update(keywords=[], filters={})
+            d.update(kwargs)
+            return argparse.Namespace(**d)
+
+        with self.assertRaises(pluginlib.exc.ArgumentsError):
+            cmd.execute(app, _arguments(reset=True, keywords=['foo']))
+
+        with self.assertRaises(pluginlib.exc.ArgumentsError):
+            cmd.execute(app, _arguments(reset_states=True,
+                                        filters={'language': 'eng-us'}))
+
+        with self.assertRaises(pluginlib.exc.ArgumentsError):
+            cmd.execute(app, _arguments(explain=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
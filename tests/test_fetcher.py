@@ -0,0 +1,600 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import asyncio
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+
+import aiohttp
+
+
+from arroyo import (
+    core,
+    fetchcache,
+    health
+)
+import testapp
+
+
+class RequestSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_requests(self, scheduler, uris):
+        @asyncio.coroutine
+        def _request(uri):
+            yield from scheduler.acquire(uri)
+            try:
+                yield from asyncio.sleep(0)
+            finally:
+                scheduler.release(uri)
+
+            return self.loop.time()
+
+        start = self.loop.time()
+        ts = self.loop.run_until_complete(
+            asyncio.gather(*[_request(x) for x in uris]))
+
+        return [x - start for x in ts]
+
+    def test_limits_from_settings(self):
+        # Store splits hostnames by dots
+        specs = {
+            'torrentapi': {'org': {'rate': 0.5, 'burst': 1}},
+            'www': {'foo': {'com': {'max-connections': 2}}},
+            'bar': {'rate': 1},
+        }
+
+        self.assertEqual(
+            core.RequestScheduler.limits_from_settings(specs),
+            {
+                'torrentapi.org': {'rate': 0.5, 'burst': 1},
+                'www.foo.com': {'max-connections': 2},
+                'bar': {'rate': 1}
+            })
+
+    def test_user_limits_override_defaults(self):
+        scheduler = core.RequestScheduler(
+            limits={'foo.com': {'rate': 10}})
+        scheduler.set_limits('foo.com', default=True, rate=1, burst=5)
+
+        self.assertEqual(
+            scheduler.limits_for('www.foo.com'),
+            ('foo.com', {'rate': 10, 'burst': 5}))
+        self.assertEqual(
+            scheduler.limits_for('bar.com'),
+            (None, {}))
+
+    def test_rate(self):
+        scheduler = core.RequestScheduler(
+            limits={'foo.com': {'rate': 20, 'burst': 2}})
+
+        ts = self.run_requests(scheduler, ['http://foo.com/'] * 4)
+        ts = sorted(ts)
+
+        # Burst goes unpaced, remaining ones are paced at 1/20s
+        self.assertTrue(ts[1] < 0.05)
+        self.assertTrue(ts[2] >= 0.045)
+        self.assertTrue(ts[3] >= 0.095)
+
+    def test_unlimited_host(self):
+        scheduler = core.RequestScheduler(
+            limits={'foo.com': {'rate': 1}})
+
+        ts = self.run_requests(scheduler, ['http://bar.com/'] * 10)
+        self.assertTrue(max(ts) < 0.5)
+
+    def test_invalid_limit(self):
+        scheduler = core.RequestScheduler()
+        with self.assertRaises(ValueError):
+            scheduler.set_limits('foo.com', foo=1)
+
+
+class HTTPCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_set_get(self):
+        cache = fetchcache.HTTPCache(self.basedir, delta=60)
+        self.assertEqual(cache.get('http://foo.com/'), None)
+
+        cache.set('http://foo.com/', b'foo', etag='"x"')
+        entry = cache.get('http://foo.com/')
+
+        self.assertEqual(entry.body, b'foo')
+        self.assertTrue(entry.is_fresh(cache.delta))
+        self.assertEqual(entry.conditional_headers(),
+                         {'If-None-Match': '"x"'})
+
+    def test_dedup(self):
+        cache = fetchcache.HTTPCache(self.basedir)
+        cache.set('http://foo.com/1', b'foo' * 100)
+        cache.set('http://foo.com/2', b'foo' * 100)
+
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['blobs'], 1)
+        self.assertTrue(stats['bytes'] < 300)
+
+        cache.delete('http://foo.com/1')
+        self.assertEqual(cache.get('http://foo.com/2').body, b'foo' * 100)
+
+    def test_lru_eviction(self):
+        cache = fetchcache.HTTPCache(self.basedir, max_bytes=2500)
+
+        # Random data is not compressible
+        bodies = [os.urandom(1000) for x in range(3)]
+        cache.set('http://foo.com/0', bodies[0])
+        cache.set('http://foo.com/1', bodies[1])
+        cache.get('http://foo.com/0')
+        cache.set('http://foo.com/2', bodies[2])
+
+        self.assertEqual(cache.get('http://foo.com/1'), None)
+        self.assertEqual(cache.get('http://foo.com/0').body, bodies[0])
+        self.assertTrue(cache.size <= 2500)
+
+        # Index is persistent
+        cache = fetchcache.HTTPCache(self.basedir, max_bytes=2500)
+        self.assertEqual(cache.get('http://foo.com/2').body, bodies[2])
+
+    def test_lru_order_is_persistent(self):
+        cache = fetchcache.HTTPCache(self.basedir, max_bytes=2500)
+
+        bodies = [os.urandom(1000) for x in range(3)]
+        cache.set('http://foo.com/0', bodies[0])
+        cache.set('http://foo.com/1', bodies[1])
+        cache.get('http://foo.com/0')
+        cache.flush()
+
+        cache = fetchcache.HTTPCache(self.basedir, max_bytes=2500)
+        cache.set('http://foo.com/2', bodies[2])
+        self.assertEqual(cache.get('http://foo.com/1'), None)
+        self.assertEqual(cache.get('http://foo.com/0').body, bodies[0])
+
+    def test_get_does_not_lock(self):
+        cache = fetchcache.HTTPCache(self.basedir)
+        cache.LRU_BATCH_SIZE = 2
+        cache.set('http://foo.com/0', b'foo')
+        cache.set('http://foo.com/1', b'bar')
+
+        # Reads don't wait for other processes holding the index lock
+        other = sqlite3.connect(cache.index_path, isolation_level=None)
+        other.execute('BEGIN IMMEDIATE')
+        try:
+            self.assertEqual(cache.get('http://foo.com/1').body, b'bar')
+        finally:
+            other.execute('ROLLBACK')
+            other.close()
+
+        # Order is stored once LRU_BATCH_SIZE entries are used
+        cache.get('http://foo.com/0')
+        rows = cache._connect().execute(
+            'SELECT key FROM entries ORDER BY used').fetchall()
+        self.assertEqual(rows, [('http://foo.com/1',), ('http://foo.com/0',)])
+
+    def test_shared_basedir(self):
+        # Ex. cron and webui processes
+        a = fetchcache.HTTPCache(self.basedir)
+        b = fetchcache.HTTPCache(self.basedir)
+
+        a.set('http://foo.com/1', b'foo')
+        b.set('http://foo.com/2', b'foo')
+        self.assertEqual(a.stats()['entries'], 2)
+
+        # Body is still referenced by b's entry
+        a.delete('http://foo.com/1')
+        self.assertEqual(b.get('http://foo.com/2').body, b'foo')
+
+        b.prune(max_bytes=0)
+        self.assertEqual(a.get('http://foo.com/2'), None)
+        self.assertEqual(a.stats()['entries'], 0)
+
+    def test_prune(self):
+        cache = fetchcache.HTTPCache(self.basedir)
+        cache.set('http://foo.com/', b'foo')
+
+        self.assertEqual(cache.prune(max_bytes=0), 1)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_freshness(self):
+        entry = fetchcache.CacheEntry(
+            b'foo', last_modified='Sat, 01 Jan 2000 00:00:00 GMT',
+            timestamp=time.time() - 100)
+
+        self.assertFalse(entry.is_fresh(10))
+        self.assertTrue(entry.is_fresh(-1))
+        self.assertEqual(
+            entry.conditional_headers(),
+            {'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+
+    def test_not_modified(self):
+        buff = fetchcache.NotModified(b'foo')
+        self.assertEqual(buff, b'foo')
+        self.assertTrue(isinstance(buff, bytes))
+
+
+class ReplayFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        samples = testapp.www_sample_path('')
+        self.fetcher = core.ReplayFetcher(replay_path=samples)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_replay(self):
+        content = self.loop.run_until_complete(
+            self.fetcher.fetch('https://eztv.ag/page_0'))
+
+        with open(testapp.www_sample_path('eztv-page-0.html'), 'rb') as fh:
+            self.assertEqual(content, fh.read())
+
+    def test_single_flight(self):
+        calls = []
+        replay = self.fetcher._fetch_full
+
+        @asyncio.coroutine
+        def _fetch_full(uri, **kwargs):
+            calls.append(uri)
+            yield from asyncio.sleep(0.01)
+            return (yield from replay(uri, **kwargs))
+
+        self.fetcher._fetch_full = _fetch_full
+
+        uris = ['https://eztv.ag/page_0'] * 3 + ['https://kickass.cd/new/']
+        contents = self.loop.run_until_complete(asyncio.gather(
+            *[self.fetcher.fetch(x) for x in uris]))
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(contents[0], contents[2])
+
+    def test_missing(self):
+        with self.assertRaises(aiohttp.errors.ClientResponseError):
+            self.loop.run_until_complete(
+                self.fetcher.fetch('https://eztv.ag/page_1'))
+
+
+class FakeResponse:
+    def __init__(self, status=200, headers=None, reason='OK'):
+        self.status = status
+        self.headers = headers or {}
+        self.reason = reason
+
+
+class ArroyoAsyncFetcherTest(unittest.TestCase):
+    URI = 'http://foo.com/'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.fetcher = core.ArroyoAsyncFetcher()
+        self.fetcher._request = self._request
+
+        # Network requests: (uri, headers)
+        self.requests = []
+        self.cancelled = []
+
+        # uri -> (status, headers, content)
+        self.responses = {}
+
+    def tearDown(self):
+        self.loop.close()
+
+    @asyncio.coroutine
+    def _request(self, uri, headers=None, **kwargs):
+        self.requests.append((uri, headers))
+
+        try:
+            yield from asyncio.sleep(0.01)
+        except asyncio.CancelledError:
+            self.cancelled.append(uri)
+            raise
+
+        status, resp_headers, content = self.responses.get(
+            uri, (200, {}, b'foo'))
+        return FakeResponse(status, resp_headers), content
+
+    @asyncio.coroutine
+    def wait_for_request(self):
+        while not self.requests:
+            yield from asyncio.sleep(0)
+
+    def test_single_flight(self):
+        contents = self.loop.run_until_complete(asyncio.gather(
+            *[self.fetcher.fetch(self.URI) for x in range(3)]))
+
+        self.assertEqual(contents, [b'foo'] * 3)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.fetcher._inflight, {})
+
+    def test_custom_requests_are_not_shared(self):
+        self.loop.run_until_complete(asyncio.gather(
+            self.fetcher.fetch(self.URI),
+            self.fetcher.fetch(self.URI, headers={'X-Foo': 'bar'})))
+
+        self.assertEqual(len(self.requests), 2)
+
+    def test_cancel_one_caller(self):
+        @asyncio.coroutine
+        def _test():
+            a = asyncio.ensure_future(self.fetcher.fetch(self.URI))
+            b = asyncio.ensure_future(self.fetcher.fetch(self.URI))
+            yield from self.wait_for_request()
+
+            a.cancel()
+            return (yield from b)
+
+        # Shared request goes on for the other caller
+        self.assertEqual(self.loop.run_until_complete(_test()), b'foo')
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.cancelled, [])
+
+    def test_cancel_last_caller(self):
+        @asyncio.coroutine
+        def _test():
+            a = asyncio.ensure_future(self.fetcher.fetch(self.URI))
+            yield from self.wait_for_request()
+
+            a.cancel()
+            yield from asyncio.sleep(0.001)
+
+        self.loop.run_until_complete(_test())
+        self.assertEqual(self.cancelled, [self.URI])
+        self.assertEqual(self.fetcher._inflight, {})
+
+    def test_not_modified(self):
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+
+        self.fetcher.http_cache = fetchcache.HTTPCache(basedir, delta=0)
+        self.fetcher.http_cache.set(self.URI, b'cached', etag='"abc"')
+        self.responses[self.URI] = (304, {}, b'')
+
+        content = self.loop.run_until_complete(
+            self.fetcher.fetch(self.URI))
+
+        # Expired entry is revalidated with its validators
+        self.assertEqual(self.requests[0][1]['If-None-Match'], '"abc"')
+        self.assertTrue(isinstance(content, fetchcache.NotModified))
+        self.assertEqual(content, b'cached')
+        self.assertEqual(self.fetcher.counters['not-modified'], 1)
+
+        # Validated entry is refreshed and keeps its validators
+        entry = self.fetcher.http_cache.get(self.URI)
+        self.assertEqual(entry.body, b'cached')
+        self.assertEqual(entry.etag, '"abc"')
+
+    def test_error_status(self):
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+
+        self.fetcher.http_cache = fetchcache.HTTPCache(basedir)
+        self.responses[self.URI] = (503, {}, b'error page')
+
+        with self.assertRaises(aiohttp.errors.ClientResponseError) as cm:
+            self.loop.run_until_complete(self.fetcher.fetch(self.URI))
+
+        # Error pages are not cached
+        self.assertEqual(cm.exception.status, 503)
+        self.assertEqual(self.fetcher.http_cache.get(self.URI), None)
+
+
+class FakeSession:
+    def __init__(self, delay):
+        self.delay = delay
+
+    @asyncio.coroutine
+    def get(self, uri, **kwargs):
+        yield from asyncio.sleep(self.delay)
+        return self
+
+    @asyncio.coroutine
+    def read(self):
+        yield from asyncio.sleep(self.delay)
+        return b'foo'
+
+    @asyncio.coroutine
+    def release(self):
+        pass
+
+
+class ArroyoAsyncFetcherTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.fetcher = core.ArroyoAsyncFetcher(timeout=0.1)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def request(self, delay):
+        self.fetcher.connection_pool._session = FakeSession(delay)
+        self.fetcher.connection_pool._loop = self.loop
+
+        return self.loop.run_until_complete(
+            self.fetcher._request('http://foo.com/'))
+
+    def test_in_time(self):
+        resp, content = self.request(0.01)
+        self.assertEqual(content, b'foo')
+
+    def test_timeout_applies_to_the_whole_request(self):
+        # Headers and body arrive in time on their own but not together
+        with self.assertRaises(asyncio.TimeoutError):
+            self.request(0.06)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.pool = core.ConnectionPool(limit=10)
+
+    def tearDown(self):
+        self.pool.close()
+        self.loop.close()
+
+    def get_session(self, pool=None, loop=None):
+        # Sessions are requested from coroutines (see
+        # ArroyoAsyncFetcher._request)
+        @asyncio.coroutine
+        def _get():
+            return (pool or self.pool).session
+
+        return (loop or self.loop).run_until_complete(_get())
+
+    def test_session_is_reused(self):
+        session = self.get_session()
+
+        self.assertTrue(self.get_session() is session)
+        self.assertTrue(self.get_session().connector is session.connector)
+        self.assertEqual(session.connector.limit, 10)
+
+    def test_new_loop(self):
+        session = self.get_session()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+
+        # Sessions are bound to their loop, the old one is closed
+        self.assertFalse(self.get_session(loop=loop) is session)
+        self.assertTrue(session.closed)
+
+    def test_close(self):
+        session = self.get_session()
+        connector = session.connector
+        self.pool.close()
+
+        self.assertTrue(session.closed)
+        self.assertTrue(connector.closed)
+
+        # Closing twice is harmless and a new session is created on demand
+        self.pool.close()
+        self.assertFalse(self.get_session() is session)
+
+    def test_shared_with_app(self):
+        app = testapp.TestApp()
+        self.assertTrue(app.fetcher.connection_pool is app.connection_pool)
+
+    def test_closed_after_execute(self):
+        app = testapp.TestApp()
+        session = self.get_session(pool=app.connection_pool)
+
+        with app.hijack(app.commands, 'execute', lambda *args: 'foo'):
+            self.assertEqual(app.execute('foo'), 'foo')
+
+        self.assertTrue(session.closed)
+        self.assertEqual(app.connection_pool._session, None)
+
+
+class HealthTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.app = testapp.TestApp()
+        self.health = health.HealthTracker(self.app)
+
+    def test_circuit_opens(self):
+        for x in range(health.HealthTracker.MIN_SAMPLES):
+            self.assertTrue(self.health.allow('foo'))
+            self.health.record_failure('foo', now=0)
+
+        self.assertEqual(self.health.get('foo')['circuit'],
+                         health.CircuitState.OPEN)
+        self.assertFalse(self.health.allow('foo', now=1))
+
+    def test_single_probe(self):
+        for x in range(health.HealthTracker.MIN_SAMPLES):
+            self.health.record_failure('foo', now=0)
+
+        retry_at = self.health.get('foo')['retry-at']
+        self.assertTrue(self.health.allow('foo', now=retry_at))
+        self.assertFalse(self.health.allow('foo', now=retry_at))
+
+        # Failed probe doubles backoff
+        self.health.record_failure('foo', now=retry_at)
+        self.assertEqual(self.health.get('foo')['backoff'],
+                         health.HealthTracker.BACKOFF * 2)
+
+        retry_at = self.health.get('foo')['retry-at']
+        self.assertTrue(self.health.allow('foo', now=retry_at))
+        self.health.record_success('foo')
+        self.assertEqual(self.health.get('foo')['circuit'],
+                         health.CircuitState.CLOSED)
+        self.assertTrue(self.health.allow('foo'))
+
+    def test_persistence(self):
+        for x in range(health.HealthTracker.MIN_SAMPLES):
+            self.health.record_failure('foo', now=0)
+
+        # States are only written on save
+        other = health.HealthTracker(self.app)
+        self.assertTrue(other.allow('foo', now=1))
+
+        self.health.save()
+        other = health.HealthTracker(self.app)
+        self.assertFalse(other.allow('foo', now=1))
+
+    def test_release_probe(self):
+        for x in range(health.HealthTracker.MIN_SAMPLES):
+            self.health.record_failure('foo', now=0)
+
+        retry_at = self.health.get('foo')['retry-at']
+        self.assertTrue(self.health.allow('foo', now=retry_at))
+        self.assertFalse(self.health.allow('foo', now=retry_at))
+
+        self.health.release('foo')
+        self.assertTrue(self.health.allow('foo', now=retry_at))
+
+    def test_adaptive_timeout(self):
+        self.assertEqual(self.health.timeout_for('foo', default=10), 10)
+
+        for x in range(health.HealthTracker.MIN_LATENCY_SAMPLES):
+            self.health.record_latency('foo', 0.4)
+        self.health.record_success('foo')
+
+        self.assertEqual(self.health.percentile('foo', 95), 0.5)
+        self.assertEqual(self.health.timeout_for('foo', default=10),
+                         health.HealthTracker.MIN_TIMEOUT)
+
+        for x in range(100):
+            self.health.record_latency('foo', 20)
+
+        self.assertEqual(self.health.timeout_for('foo', default=10), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
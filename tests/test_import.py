@@ -0,0 +1,764 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+# Importer tests. Network requests are served from the recorded responses
+# in tests/www-samples, see ImporterTestCase
+
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from urllib import parse
+
+
+import aiohttp
+
+
+from arroyo import (
+    health,
+    importer,
+    importstats,
+    models,
+    pluginlib
+)
+import testapp
+
+
+class ImporterTestCase(unittest.TestCase):
+    PROVIDERS = ['eztv', 'kickass']
+    SETTINGS = {}
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.app = self.build_app()
+        self.importer = self.app.importer
+
+    def build_app(self, settings=None):
+        d = {
+            'fetcher.replay-path': testapp.www_sample_path(''),
+        }
+        d.update({
+            'plugins.providers.{}.enabled'.format(x): True
+            for x in self.PROVIDERS
+        })
+        d.update(self.SETTINGS)
+        d.update(settings or {})
+
+        return testapp.TestApp(d)
+
+    def tearDown(self):
+        self.loop.close()
+
+
+class CircuitBreakerTest(ImporterTestCase):
+    SETTINGS = {
+        'importer.circuit-breaker': True
+    }
+
+    def open_circuit(self, provider):
+        for x in range(health.HealthTracker.MIN_SAMPLES):
+            self.importer.health.record_failure(provider, now=0)
+
+    def test_cancelled_probe_is_released(self):
+        origin = self.importer.origin_from_params(provider='eztv')
+        self.open_circuit('eztv')
+
+        @asyncio.coroutine
+        def _cancelled(origin, uris):
+            raise asyncio.CancelledError()
+
+        with self.app.hijack(self.importer, '_fetch_from_mirrors',
+                             _cancelled):
+            self.loop.run_until_complete(
+                self.importer.get_buffer_from_uri(origin, origin.uri))
+
+        self.assertTrue(self.importer.health.allow('eztv'))
+
+    def test_unhandled_error_fails_probe(self):
+        origin = self.importer.origin_from_params(provider='eztv')
+        self.open_circuit('eztv')
+
+        @asyncio.coroutine
+        def _broken(origin, uris):
+            raise ValueError()
+
+        with self.app.hijack(self.importer, '_fetch_from_mirrors', _broken):
+            self.loop.run_until_complete(
+                self.importer.get_buffer_from_uri(origin, origin.uri))
+
+        state = self.importer.health.get('eztv')
+        self.assertEqual(state['circuit'], health.CircuitState.OPEN)
+        self.assertEqual(state['backoff'],
+                         health.HealthTracker.BACKOFF * 2)
+
+    def test_saved_after_run(self):
+        origin = self.importer.origin_from_params(provider='eztv')
+        key = 'importer.health.eztv'
+
+        self.loop.run_until_complete(
+            self.importer.get_buffer_from_uri(origin, origin.uri))
+        self.assertEqual(self.app.variables.get(key, default=None), None)
+
+        self.importer.process(origin)
+        self.assertEqual(
+            self.app.variables.get(key)['outcomes'], [True, True])
+
+
+class MirrorsTest(ImporterTestCase):
+    PRIMARY = 'kickass.cd'
+    MIRROR = 'kickass.cm'
+
+    def setUp(self):
+        super().setUp()
+        self.origin = self.importer.origin_from_params(provider='kickass')
+        self.uris = self.importer.mirror_uris(self.origin.provider,
+                                              self.origin.uri)
+        self.calls = []
+        self.cancelled = []
+
+        with open(testapp.www_sample_path('kat-new.html'), 'rb') as fh:
+            self.expected = fh.read()
+
+    def hijack_fetch(self, behaviours):
+        """Serve responses from every mirror with the recorded ones for
+        the primary.
+
+        behaviours maps hostnames to a delay (in seconds) before answering
+        or to an exception to raise.
+        """
+        replay = self.app.fetcher._fetch_full
+
+        @asyncio.coroutine
+        def _fetch_full(uri, **kwargs):
+            parsed = parse.urlparse(uri)
+            self.calls.append(parsed.hostname)
+
+            behaviour = behaviours.get(parsed.hostname, 0)
+            if isinstance(behaviour, Exception):
+                raise behaviour
+
+            try:
+                yield from asyncio.sleep(behaviour)
+            except asyncio.CancelledError:
+                self.cancelled.append(parsed.hostname)
+                raise
+
+            uri = parsed._replace(netloc=self.PRIMARY).geturl()
+            return (yield from replay(uri, **kwargs))
+
+        return self.app.hijack(self.app.fetcher, '_fetch_full', _fetch_full)
+
+    def set_latency(self, latency):
+        for x in range(health.HealthTracker.MIN_LATENCY_SAMPLES):
+            self.importer.health.record_latency('kickass', latency)
+
+    def fetch(self):
+        try:
+            return self.loop.run_until_complete(
+                self.importer._fetch_from_mirrors(self.origin, self.uris))
+        finally:
+            # Let cancelled requests finish
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def test_slow_primary(self):
+        self.set_latency(0.05)
+
+        with self.hijack_fetch({self.PRIMARY: 10}):
+            self.assertEqual(self.fetch(), self.expected)
+
+        # Backup request was fired after p90 and the loser was cancelled
+        self.assertEqual(self.calls, [self.PRIMARY, self.MIRROR])
+        self.assertEqual(self.cancelled, [self.PRIMARY])
+        self.assertEqual(self.app.fetcher._inflight, {})
+        self.assertEqual(
+            self.app.variables.get('importer.mirror.kickass'),
+            'https://' + self.MIRROR)
+
+        # Winner is tried first from now on
+        self.assertEqual(
+            self.importer.mirror_uris(self.origin.provider,
+                                      self.origin.uri)[0],
+            'https://' + self.MIRROR + '/new/')
+
+    def test_fast_primary(self):
+        self.set_latency(0.05)
+
+        with self.hijack_fetch({}):
+            self.assertEqual(self.fetch(), self.expected)
+
+        self.assertEqual(self.calls, [self.PRIMARY])
+        self.assertEqual(self.cancelled, [])
+
+    def test_failing_primary(self):
+        # Without latency samples there is no hedging, failures fall back
+        # to the next mirror at once
+        error = aiohttp.errors.ClientOSError('Connection refused')
+        with self.hijack_fetch({self.PRIMARY: error}):
+            self.assertEqual(self.fetch(), self.expected)
+
+        self.assertEqual(self.calls, [self.PRIMARY, self.MIRROR])
+
+    def test_all_failing(self):
+        error = aiohttp.errors.ClientOSError('Connection refused')
+        with self.hijack_fetch({x: error for x in
+                                ['kickass.cd', 'kickass.cm', 'kat.cr']}):
+            with self.assertRaises(aiohttp.errors.ClientOSError):
+                self.fetch()
+
+        self.assertEqual(self.calls, ['kickass.cd', 'kickass.cm', 'kat.cr'])
+
+
+class SchedulerTest(ImporterTestCase):
+    SETTINGS = {
+        'importer.default-interval': '2H',
+        'origin.eztv.provider': 'eztv',
+        'origin.eztv.interval': '1H',
+        'origin.kat.provider': 'kickass',
+        'origin.kat.interval': 60,
+        'origin.kat.priority': 10,
+        'origin.kat-tv.provider': 'kickass',
+        'origin.kat-tv.uri': 'https://kickass.cd/tv/',
+        'origin.kat-tv.jitter': 100,
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.processed = []
+
+    def names(self, origins):
+        return [name for (name, origin) in origins]
+
+    def run_scheduled(self, now):
+        def _process(*origins):
+            self.processed.append(sorted(x.uri for x in origins))
+            return importstats.ImportStats()
+
+        with self.app.hijack(importer.utils, 'now_timestamp', lambda: now):
+            with self.app.hijack(self.importer, 'process', _process):
+                return self.importer.run_scheduled()
+
+    def schedule(self, name):
+        return self.app.variables.get('importer.schedule.' + name,
+                                      default=None)
+
+    def test_due_origins(self):
+        # Never run origins are due, higher priority first
+        due = self.names(self.importer.get_due_origins(now=1000))
+        self.assertEqual(due[0], 'kat')
+        self.assertEqual(sorted(due), ['eztv', 'kat', 'kat-tv'])
+
+        self.run_scheduled(1000)
+        self.assertEqual(self.importer.get_due_origins(now=1030), [])
+        self.assertEqual(
+            self.names(self.importer.get_due_origins(now=1060)), ['kat'])
+        self.assertEqual(
+            sorted(self.names(self.importer.get_due_origins(now=4600))),
+            ['eztv', 'kat'])
+
+    def test_run_scheduled(self):
+        self.run_scheduled(1000)
+        self.assertEqual(len(self.processed), 1)
+        self.assertEqual(len(self.processed[0]), 3)
+
+        # Last and next run are persisted
+        self.assertEqual(self.schedule('eztv'),
+                         {'last-run': 1000, 'next-run': 1000 + 3600})
+        self.assertEqual(self.schedule('kat'),
+                         {'last-run': 1000, 'next-run': 1000 + 60})
+
+        # Default interval plus jitter
+        kat_tv = self.schedule('kat-tv')
+        self.assertEqual(kat_tv['last-run'], 1000)
+        self.assertTrue(1000 + 7200 <= kat_tv['next-run'] <= 1000 + 7300)
+
+        # Only due origins are processed and rescheduled
+        self.run_scheduled(1060)
+        self.assertEqual(self.processed[-1], ['https://kickass.cd/new/'])
+        self.assertEqual(self.schedule('kat')['last-run'], 1060)
+        self.assertEqual(self.schedule('eztv')['last-run'], 1000)
+
+    def test_nothing_due(self):
+        self.run_scheduled(1000)
+        del self.processed[:]
+
+        self.assertIsNone(self.run_scheduled(1001))
+        self.assertEqual(self.processed, [])
+
+
+class MemoTest(ImporterTestCase):
+    SETTINGS = {
+        'importer.memo-ttl': 1
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.fetches = []
+        self.data = [{'name': 'foo'}]
+
+    @asyncio.coroutine
+    def _get_data_from_uri(self, origin, uri):
+        self.fetches.append(uri)
+        yield from asyncio.sleep(0.01)
+        return self.data
+
+    def run_fetches(self, *coros):
+        with self.app.hijack(self.importer, '_get_data_from_uri',
+                             self._get_data_from_uri):
+            return self.loop.run_until_complete(asyncio.gather(*coros))
+
+    def get_data(self, origin, uri=None):
+        coro = self.importer.get_data_from_uri(origin, uri or origin.uri)
+        return self.run_fetches(coro)[0]
+
+    def memo_hits(self, origin):
+        return self.importer.stats.counters[origin.uri][
+            importstats.Counter.MEMO_HITS]
+
+    def test_memorized(self):
+        origin = self.importer.origin_from_params(provider='eztv')
+
+        self.assertEqual(self.get_data(origin)[2], [{'name': 'foo'}])
+        self.assertEqual(self.get_data(origin)[2], [{'name': 'foo'}])
+        self.assertEqual(len(self.fetches), 1)
+        self.assertEqual(self.memo_hits(origin), 1)
+
+    def test_concurrent_requests(self):
+        origin = self.importer.origin_from_params(provider='eztv')
+
+        res = self.run_fetches(
+            self.importer.get_data_from_uri(origin, origin.uri),
+            self.importer.get_data_from_uri(origin, origin.uri))
+
+        self.assertEqual([x[2] for x in res], [self.data, self.data])
+        self.assertEqual(len(self.fetches), 1)
+
+    def test_copies_are_returned(self):
+        origin = self.importer.origin_from_params(provider='eztv')
+
+        self.get_data(origin)[2][0]['name'] = 'bar'
+        self.assertEqual(self.get_data(origin)[2], [{'name': 'foo'}])
+        self.assertEqual(self.data, [{'name': 'foo'}])
+
+    def test_expiration(self):
+        origin = self.importer.origin_from_params(provider='eztv')
+
+        self.get_data(origin)
+        self.loop.run_until_complete(asyncio.sleep(1.1))
+        self.get_data(origin)
+        self.assertEqual(len(self.fetches), 2)
+        self.assertEqual(self.memo_hits(origin), 0)
+
+    def test_failures_are_not_memorized(self):
+        origin = self.importer.origin_from_params(provider='eztv')
+
+        self.data = None
+        self.assertEqual(self.get_data(origin)[2], [])
+        self.data = [{'name': 'foo'}]
+        self.assertEqual(self.get_data(origin)[2], [{'name': 'foo'}])
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_overrides_are_part_of_the_key(self):
+        a = self.importer.origin_from_params(provider='eztv')
+        b = self.importer.origin_from_params(provider='eztv',
+                                             language='eng-us')
+
+        self.get_data(a)
+        self.get_data(b, uri=a.uri)
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_disabled(self):
+        self.app.settings.set('importer.memo-ttl', 0)
+        origin = self.importer.origin_from_params(provider='eztv')
+
+        self.get_data(origin)
+        self.get_data(origin)
+        self.assertEqual(len(self.fetches), 2)
+
+
+class ImportRunTest(ImporterTestCase):
+    SETTINGS = {
+        'importer.stats-history': 2,
+        'plugins.commands.stats.enabled': True
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.origin = self.importer.origin_from_params(provider='eztv')
+
+    def runs(self):
+        query = self.app.db.session.query(models.ImportRun)
+        return query.order_by(models.ImportRun.id).all()
+
+    def test_run_is_saved(self):
+        self.importer.process(self.origin)
+
+        runs = self.runs()
+        self.assertEqual(len(runs), 1)
+        self.assertTrue(runs[0].duration > 0)
+
+        stats = runs[0].stats
+        origin_stats = stats[self.origin.uri]
+        self.assertEqual(
+            origin_stats['counters'][importstats.Counter.REQUESTS], 1)
+        self.assertTrue(importstats.Stage.FETCH in origin_stats['timings'])
+        self.assertTrue(
+            stats[importstats.RUN]['counters'][importstats.Counter.ADDED] > 0)
+
+    def test_history_is_trimmed(self):
+        ids = []
+        for x in range(3):
+            self.importer.process(self.origin)
+            ids.append(self.runs()[-1].id)
+
+        self.assertEqual([run.id for run in self.runs()], ids[1:])
+
+    def test_history_disabled(self):
+        app = self.build_app({'importer.stats-history': 0})
+        app.importer.process(app.importer.origin_from_params(
+            provider='eztv'))
+
+        self.assertEqual(
+            app.db.session.query(models.ImportRun).count(), 0)
+
+    def test_stats_command(self):
+        self.importer.process(self.origin)
+        self.importer.process(self.origin)
+
+        cmd = self.app.get_extension(pluginlib.Command, 'stats')
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            cmd.execute(self.app,
+                        argparse.Namespace(operation='import', runs=10))
+
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Runs:      2 '))
+
+        # Run-wide stages first, then origins
+        self.assertTrue(lines.index('All origins') <
+                        lines.index(self.origin.uri))
+
+        # Counters are summed over runs
+        requests = '  {:<14} {:>11}'.format(importstats.Counter.REQUESTS, 2)
+        self.assertTrue(requests in lines[lines.index(self.origin.uri):])
+
+
+class IncrementalTest(ImporterTestCase):
+    def setUp(self):
+        super().setUp()
+        self.origin = self.importer.origin_from_params(
+            provider='eztv', incremental=True, iterations=3)
+        self.uris = [uri for (origin, uri) in
+                     self.importer.iter_uris_from_origin(self.origin)]
+        self.fetched = []
+
+    def src(self, n, created):
+        return psource('Lost.S01E{:02d}.720p.HDTV.x264-FOO'.format(n),
+                       created=created)
+
+    def pages(self, *pages):
+        """Serve pages (lists of psources) for the origin URIs"""
+        table = dict(zip(self.uris, pages))
+
+        @asyncio.coroutine
+        def _get_buffer_from_uri(origin, uri):
+            self.fetched.append(uri)
+            return (origin, uri, b'')
+
+        @asyncio.coroutine
+        def _get_data_from_buffer(origin, uri, buff):
+            return [dict(x) for x in table[uri]]
+
+        # Both hijacks are undone on exit
+        stack = contextlib.ExitStack()
+        stack.enter_context(self.app.hijack(
+            self.importer, 'get_buffer_from_uri', _get_buffer_from_uri))
+        stack.enter_context(self.app.hijack(
+            self.importer, 'get_data_from_buffer', _get_data_from_buffer))
+        return stack
+
+    def scan(self, *pages):
+        del self.fetched[:]
+        with self.pages(*pages):
+            results = self.loop.run_until_complete(
+                self.importer.get_data_from_origin_incrementally(
+                    self.origin))
+
+        return [x for (origin, uri, data) in results for x in data]
+
+    def test_stop_at_known_sources(self):
+        pages = [
+            [self.src(1, created=300), self.src(2, created=290)],
+            [self.src(3, created=200), self.src(4, created=190)],
+            [self.src(5, created=100)]
+        ]
+
+        data = self.scan(*pages)
+        self.assertEqual(self.fetched, self.uris)
+        self.importer.process_source_data(*data)
+
+        self.scan(*pages)
+        self.assertEqual(self.fetched, self.uris[:1])
+
+    def test_stop_at_watermark(self):
+        self.scan(
+            [self.src(1, created=300)],
+            [self.src(2, created=200)],
+            [self.src(3, created=100)])
+
+        # Watermark is not stored until its data is written
+        self.assertEqual(self.importer.get_watermark(self.origin), None)
+        self.importer.commit_watermarks()
+        self.assertEqual(self.importer.get_watermark(self.origin), 300)
+
+        # Page 2 has unknown sources but it's older than the last scan
+        self.scan(
+            [self.src(4, created=400)],
+            [self.src(5, created=250)],
+            [self.src(6, created=240)])
+        self.assertEqual(self.fetched, self.uris[:2])
+
+        self.importer.commit_watermarks()
+        self.assertEqual(self.importer.get_watermark(self.origin), 400)
+
+    def test_sources_without_dates(self):
+        self.app.variables.set(
+            'importer.watermark.{}'.format(self.origin.uri), 300)
+
+        self.scan(
+            [self.src(1, created=None)],
+            [self.src(2, created=None)],
+            [self.src(3, created=None)])
+
+        # Import time is not a date from the provider, it doesn't stop
+        # pagination or move the watermark
+        self.assertEqual(self.fetched, self.uris)
+        self.importer.commit_watermarks()
+        self.assertEqual(self.importer.get_watermark(self.origin), 300)
+
+    def test_watermark_saved_by_process(self):
+        with self.pages([self.src(1, created=300)], [], []):
+            self.importer.process(self.origin)
+
+        self.assertEqual(self.importer.get_watermark(self.origin), 300)
+
+    def test_watermark_not_saved_on_failure(self):
+        def _process_source_data(*data):
+            raise ValueError()
+
+        with self.pages([self.src(1, created=300)], [], []):
+            with self.app.hijack(self.importer, 'process_source_data',
+                                 _process_source_data):
+                with self.assertRaises(ValueError):
+                    self.importer.process(self.origin)
+
+        # Not even by the next run
+        self.importer.commit_watermarks()
+        self.assertEqual(self.importer.get_watermark(self.origin), None)
+
+
+class StreamingTest(ImporterTestCase):
+    URIS = [
+        'https://eztv.ag/page_0',
+        'https://kickass.cd/new/',
+        'https://kickass.cd/tv/'
+    ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.SETTINGS = {
+            'db-uri': 'sqlite:///' + os.path.join(self.tmpdir, 'arroyo.db'),
+            'importer.streaming': True,
+            'importer.streaming-window': 1
+        }
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def source_names(self, app):
+        return set(name for (name,) in
+                   app.db.session.query(models.Source.name))
+
+    def test_multiple_origins(self):
+        threads = set()
+        process_source_data = self.importer.process_source_data
+
+        def _process_source_data(*data):
+            threads.add(threading.current_thread())
+            return process_source_data(*data)
+
+        origins = [self.importer.origin_from_params(uri=x)
+                   for x in self.URIS]
+        with self.app.hijack(self.importer, 'process_source_data',
+                             _process_source_data):
+            stats = self.importer.process(*origins)
+
+        # Batches are written from a single worker thread
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads.pop(), threading.current_thread())
+
+        # Same sources as the regular path
+        names = self.source_names(self.app)
+        counters = stats.counters[importstats.RUN]
+        n = (counters[importstats.Counter.ADDED] +
+             counters[importstats.Counter.UPDATED])
+        self.assertTrue(n >= len(names) > 0)
+
+        app = self.build_app({
+            'db-uri': 'sqlite:///:memory:',
+            'importer.streaming': False
+        })
+        app.importer.process(*[app.importer.origin_from_params(uri=x)
+                               for x in self.URIS])
+        self.assertEqual(names, self.source_names(app))
+
+
+def psource(name, created, seeds=None, urn=True, uri=None):
+    if urn:
+        urn = 'urn:btih:' + hashlib.sha1(name.encode('utf-8')).hexdigest()
+    else:
+        urn = None
+
+    uri = uri or 'http://example.com/' + name
+
+    return {
+        '_discriminator': urn or uri,
+        'provider': 'mock',
+        'name': name,
+        'urn': urn,
+        'uri': uri,
+        'created': created,
+        'last_seen': 1000,
+        'seeds': seeds
+    }
+
+
+@unittest.skipUnless(sqlite3.sqlite_version_info >= (3, 24, 0),
+                     "Bulk upsert needs SQLite 3.24+")
+class BulkUpsertTest(unittest.TestCase):
+    def build_app(self, bulk):
+        app = testapp.TestApp({'importer.bulk-upsert': bulk})
+        if bulk:
+            self.assertEqual(app.importer.bulk_upsert_dialect, 'sqlite')
+
+        return app
+
+    def process(self, app, *psrcs):
+        res = {}
+
+        def _added(sender, sources):
+            res['added'] = sorted(x.name for x in sources)
+
+        def _updated(sender, sources):
+            res['updated'] = sorted(set(x.name for x in sources))
+
+        app.signals.connect('sources-added-batch', _added, weak=False)
+        app.signals.connect('sources-updated-batch', _updated, weak=False)
+        try:
+            app.importer.process_source_data(*psrcs)
+        finally:
+            app.signals.disconnect('sources-added-batch', _added)
+            app.signals.disconnect('sources-updated-batch', _updated)
+
+        return res
+
+    def run_scenario(self, bulk):
+        app = self.build_app(bulk)
+
+        first = self.process(
+            app,
+            psource('Lost.S01E01.720p.HDTV.x264-FOO', created=100, seeds=5),
+            psource('Lost.S01E02.720p.HDTV.x264-FOO', created=200, seeds=10),
+            psource('Lost.S01E03.720p.HDTV.x264-FOO', created=300, seeds=1,
+                    urn=False))
+
+        # Older created, empty seeds / newer created, more seeds / same
+        # data / new source
+        second = self.process(
+            app,
+            psource('Lost.S01E01.720p.HDTV.x264-FOO', created=50, seeds=0),
+            psource('Lost.S01E02.720p.HDTV.x264-FOO', created=300, seeds=20),
+            psource('Lost.S01E03.720p.HDTV.x264-FOO', created=300, seeds=1,
+                    urn=False),
+            psource('Lost.S01E04.720p.HDTV.x264-FOO', created=400))
+
+        app.db.session.expire_all()
+        rows = sorted(
+            (src.name, src.created, src.seeds)
+            for src in app.db.session.query(models.Source))
+
+        return first, second, rows
+
+    def test_same_results_as_orm(self):
+        orm_results = self.run_scenario(bulk=False)
+        bulk_results = self.run_scenario(bulk=True)
+
+        self.assertEqual(bulk_results, orm_results)
+
+        first, second, rows = bulk_results
+        self.assertEqual(len(first['added']), 3)
+        self.assertEqual(first['updated'], [])
+        self.assertEqual(second['added'],
+                         ['Lost.S01E04.720p.HDTV.x264-FOO'])
+        self.assertEqual(second['updated'],
+                         ['Lost.S01E01.720p.HDTV.x264-FOO',
+                          'Lost.S01E02.720p.HDTV.x264-FOO'])
+        self.assertEqual(rows, [
+            ('Lost.S01E01.720p.HDTV.x264-FOO', 50, 5),
+            ('Lost.S01E02.720p.HDTV.x264-FOO', 200, 20),
+            ('Lost.S01E03.720p.HDTV.x264-FOO', 300, 1),
+            ('Lost.S01E04.720p.HDTV.x264-FOO', 400, None),
+        ])
+
+    def test_uri_conflict_without_urn(self):
+        app = self.build_app(bulk=True)
+        self.process(
+            app,
+            psource('Lost.S01E01.720p.HDTV.x264-FOO', created=100,
+                    uri='http://example.com/lost'))
+
+        # Same uri, no urn: existing source is updated
+        res = self.process(
+            app,
+            psource('Lost.S01E01.720p.HDTV.x264-BAR', created=100,
+                    uri='http://example.com/lost', urn=False))
+
+        self.assertEqual(res['added'], [])
+        self.assertEqual(res['updated'], ['Lost.S01E01.720p.HDTV.x264-BAR'])
+
+        srcs = app.db.session.query(models.Source).all()
+        self.assertEqual(len(srcs), 1)
+        self.assertEqual(srcs[0].name, 'Lost.S01E01.720p.HDTV.x264-BAR')
+        self.assertTrue(srcs[0].urn.startswith('urn:btih:'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2017 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import argparse
+import itertools
+import unittest
+
+
+import babelfish
+import guessit
+
+
+from arroyo import (
+    mediainfo,
+    models,
+    pluginlib
+)
+import testapp
+
+
+class ParseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.app = testapp.TestApp({
+            'mediainfo.parse-cache': True
+        })
+
+    def test_cached_result(self):
+        name = 'Lost.S01E01.720p.HDTV.x264-DIMENSION'
+        expected = mediainfo.parse(name)
+
+        with self.app.hijack(mediainfo, 'parse', None):
+            self.app.mediainfo.parse_cache.set(name, None, *expected)
+            self.assertEqual(self.app.mediainfo.parse(name), expected)
+
+    def test_persistence(self):
+        name = 'Lost.S01E01.720p.HDTV.x264-DIMENSION'
+        expected = self.app.mediainfo.parse(name)
+        self.app.mediainfo.parse_cache.flush()
+
+        cache = mediainfo.ParseCache(self.app)
+        self.assertIsNone(cache.get(name))
+        cache.prefetch([cache.key(name)])
+        self.assertEqual(cache.get(name), expected + (None, ))
+
+    def test_errors_are_cached(self):
+        name = 'foo'
+
+        with self.assertRaises(mediainfo.ParseError):
+            self.app.mediainfo.parse(name)
+
+        entity_data, metadata, error = \
+            self.app.mediainfo.parse_cache.get(name)
+        self.assertTrue(isinstance(error, mediainfo.ParseError))
+
+    def test_version_change(self):
+        name = 'Lost.S01E01.720p.HDTV.x264-DIMENSION'
+        self.app.mediainfo.parse(name)
+        self.app.mediainfo.parse_cache.flush()
+
+        cache = mediainfo.ParseCache(self.app)
+        cache.version = 'other'
+        cache.prefetch([cache.key(name)])
+        self.assertIsNone(cache.get(name))
+        self.assertEqual(
+            self.app.db.session.query(models.ParseCacheEntry).count(),
+            0)
+
+
+class ParallelParseTest(unittest.TestCase):
+    def test_parse_all_in_workers(self):
+        app = testapp.TestApp({
+            'mediainfo.parse-cache': False,
+            'mediainfo.parse-workers': 2
+        })
+        names = [
+            'Lost.S01E{:02d}.720p.HDTV.x264-DIMENSION'.format(x)
+            for x in range(1, mediainfo.Mediainfo.PARALLEL_THRESHOLD + 2)
+        ]
+        names.append('foo')
+
+        results = app.mediainfo.parse_all([(x, None, None) for x in names])
+        self.assertIsNotNone(app.mediainfo.parse_executor)
+
+        for name in names[:-1]:
+            self.assertEqual(results[mediainfo.ParseCache.key(name)],
+                             mediainfo._parse_in_worker(name))
+
+        entity_data, metadata, error = \
+            results[mediainfo.ParseCache.key('foo')]
+        self.assertTrue(isinstance(error, mediainfo.ParseError))
+
+
+class EntitiesFromDataTest(unittest.TestCase):
+    def setUp(self):
+        self.app = testapp.TestApp()
+
+    def test_identity_map(self):
+        ep = {'type': 'episode', 'series': 'lost', 'season': 1, 'number': 1}
+        movie = {'type': 'movie', 'title': 'foo', 'year': 2000}
+
+        entities = self.app.mediainfo.entities_from_data(
+            ep, dict(ep), movie, dict(ep, number=2))
+
+        self.assertTrue(entities[0] is entities[1])
+        self.assertTrue(isinstance(entities[2], models.Movie))
+        self.assertNotEqual(entities[0], entities[3])
+        self.assertEqual(
+            self.app.db.session.query(models.Episode).count(),
+            2)
+
+        # Existing entities are reused
+        again = self.app.mediainfo.entities_from_data(ep, movie)
+        self.assertTrue(again[0] is entities[0])
+        self.assertTrue(again[1] is entities[2])
+        self.assertEqual(
+            self.app.db.session.query(models.Episode).count(),
+            2)
+
+    def test_incomplete_data(self):
+        entities = self.app.mediainfo.entities_from_data(
+            {'type': 'episode', 'series': 'lost', 'season': 1})
+        self.assertTrue(isinstance(entities[0],
+                                   mediainfo.IncompleteEntityDataError))
+
+
+class RewriteTagsTest(unittest.TestCase):
+    def setUp(self):
+        self.app = testapp.TestApp()
+
+    def test_rewrite(self):
+        a = testapp.mock_source('a')
+        b = testapp.mock_source('b')
+        self.app.insert_sources(a, b)
+
+        self.app.mediainfo.rewrite_tags([
+            (a, {mediainfo.Tags.RELEASE_GROUP: 'foo',
+                 mediainfo.Tags.VIDEO_CODEC: 'h264'}),
+            (b, {mediainfo.Tags.RELEASE_GROUP: 'bar'})
+        ])
+        self.assertEqual(a.tag_dict, {
+            mediainfo.Tags.RELEASE_GROUP: 'foo',
+            mediainfo.Tags.VIDEO_CODEC: 'h264'
+        })
+        self.assertEqual(b.tag_dict, {mediainfo.Tags.RELEASE_GROUP: 'bar'})
+
+        self.app.mediainfo.rewrite_tags([
+            (a, {mediainfo.Tags.RELEASE_GROUP: 'foo',
+                 mediainfo.Tags.VIDEO_CODEC: 'h264'}),
+            (b, {})
+        ])
+        self.assertEqual(a.tag_dict, {
+            mediainfo.Tags.RELEASE_GROUP: 'foo',
+            mediainfo.Tags.VIDEO_CODEC: 'h264'
+        })
+        self.assertEqual(b.tag_dict, {})
+
+    def test_other_tags_are_kept(self):
+        a = testapp.mock_source('a')
+        self.app.insert_sources(a)
+        a.tags.append(models.SourceTag('custom.foo', 'bar'))
+
+        self.app.mediainfo.rewrite_tags([
+            (a, {mediainfo.Tags.RELEASE_GROUP: 'foo'})
+        ])
+        self.assertEqual(a.tag_dict, {
+            'custom.foo': 'bar',
+            mediainfo.Tags.RELEASE_GROUP: 'foo'
+        })
+
+
+class MediaColumnsTest(unittest.TestCase):
+    def test_process(self):
+        app = testapp.TestApp()
+        src = testapp.mock_source('Lost.S01E01.720p.HDTV.x264-DIMENSION.mkv')
+        app.insert_sources(src)
+        app.mediainfo.process(src)
+
+        self.assertEqual(src.video_codec, 'h264')
+        self.assertEqual(src.screen_size, '720p')
+        self.assertEqual(src.video_format, 'hdtv')
+        self.assertEqual(src.container, 'mkv')
+        self.assertEqual(src.release_group, 'dimension')
+        self.assertEqual(src.release_proper, None)
+
+        app.mediainfo.rewrite_tags([(src, {})])
+        self.assertEqual(src.video_codec, None)
+        self.assertEqual(src.release_group, None)
+
+    def test_multiple_values(self):
+        values = mediainfo.media_columns({
+            mediainfo.Tags.MEDIA_CONTAINER: ['MKV', 'avi']
+        })
+        self.assertEqual(values['container'], 'mkv')
+        self.assertEqual(values['video_codec'], None)
+
+    def test_unfilled_columns_warning(self):
+        app = testapp.TestApp()
+        src = testapp.mock_source('Lost.S01E01.720p.HDTV.x264-DIMENSION.mkv')
+        app.insert_sources(src)
+        app.mediainfo.process(src)
+
+        def _check():
+            warnings = []
+            app.mediainfo._media_columns_checked = False
+            with app.hijack(app.mediainfo.logger, 'warning',
+                            warnings.append):
+                app.mediainfo.check_media_columns()
+                app.mediainfo.check_media_columns()
+
+            return len(warnings)
+
+        self.assertEqual(_check(), 0)
+
+        # Source processed before media columns were added
+        for (tag, column) in mediainfo.MEDIA_COLUMNS:
+            setattr(src, column, None)
+        app.db.session.commit()
+        self.assertEqual(_check(), 1)
+
+        app.variables.set('core.db.migration.04_fill-media-columns', True)
+        self.assertEqual(_check(), 0)
+
+
+class BatchesTest(unittest.TestCase):
+    def setUp(self):
+        self.app = testapp.TestApp()
+        self.app.insert_sources(*[
+            testapp.mock_source('Lost.S01E{:02d}.720p.HDTV.x264-LOL'.format(x))
+            for x in range(1, 6)
+        ])
+
+    def test_resume(self):
+        mediainfo = self.app.mediainfo
+
+        batches = mediainfo.batches(batch_size=2, checkpoint='test')
+        first = next(batches)
+        mediainfo.process(*first)
+        self.assertEqual([x.name for x in next(batches)],
+                         ['Lost.S01E03.720p.HDTV.x264-LOL',
+                          'Lost.S01E04.720p.HDTV.x264-LOL'])
+        batches.close()
+
+        self.assertEqual(self.app.variables.get('test'), first[-1].id)
+
+        collected = []
+        for batch in mediainfo.batches(batch_size=2, checkpoint='test'):
+            mediainfo.process(*batch)
+            collected.extend(batch)
+
+        self.assertEqual(len(collected), 3)
+        self.assertEqual(self.app.variables.get('test', default=None), None)
+        self.assertEqual(
+            self.app.db.session.query(models.Episode).count(),
+            5)
+
+    def test_stale(self):
+        mediainfo = self.app.mediainfo
+
+        for batch in mediainfo.batches():
+            mediainfo.process(*batch)
+
+        self.assertEqual(list(mediainfo.batches(stale=True)), [])
+
+        src = self.app.db.session.query(models.Source).first()
+        src.mediainfo_version = 'old'
+        self.app.db.session.commit()
+
+        self.assertEqual(list(mediainfo.batches(stale=True)), [[src]])
+
+    def test_command_batch_size(self):
+        app = testapp.TestApp({
+            'plugins.commands.mediainfo.enabled': True,
+        })
+        cmd = app.get_extension(pluginlib.Command, 'mediainfo')
+
+        def _arguments(**kwargs):
+            d = dict(item=None, all=False, stale=False, batch_size=None)
+            d.update(kwargs)
+            return argparse.Namespace(**d)
+
+        with self.assertRaises(pluginlib.exc.ArgumentsError):
+            cmd.execute(app, _arguments(item=1, batch_size=10))
+
+        for batch_size in (0, -1):
+            with self.assertRaises(pluginlib.exc.ArgumentsError):
+                cmd.execute(app, _arguments(all=True, batch_size=batch_size))
+
+
+class SceneParseTest(unittest.TestCase):
+    # Provider samples used as name corpus
+    SAMPLES = [
+        ('eztv', 'eztv-page-0.html'),
+        ('eztv', 'eztv-bsg.html'),
+        ('kickass', 'kat-full.html'),
+        ('kickass', 'kat-new.html'),
+        ('kickass', 'kat-tv.html'),
+        ('torrentapi', 'torrentapi-listing.json'),
+        ('yts', 'yts-listing.html'),
+    ]
+
+    NAMES = [
+        'Lost.S01E01.720p.HDTV.x264-DIMENSION',
+        'Lost.S01E01.HDTV.XviD-LOL',
+        'lost.s01e01.hdtv.xvid-lol',
+        'The.Big.Bang.Theory.S10E05.1080p.HDTV.x265-KILLERS',
+        'The.Walking.Dead.S07E01.720p.WEBRip.h264-FOO',
+        'Game of Thrones S06E10 720p HDTV x264-AVS',
+        'Westworld.S01E10.HEVC-FOO',
+        'Inception.2010.1080p.BluRay.x264-SPARKS',
+        'The.Lord.of.the.Rings.2001.720p.BluRay.x264',
+        'Arrival.2016.2160p.BluRay.HEVC-TERMiNAL',
+    ]
+
+    # Not handled by the fast path
+    FALLBACK_NAMES = [
+        'Lost.S01E01.Pilot.720p.HDTV.x264-DIMENSION',
+        'Lost.S01E01.PROPER.720p.HDTV.x264-DIMENSION',
+        'Lost.S01E01.720p.HDTV.x264-DIMENSION.mkv',
+        'Lost.S01E01.720p.HDTV.x264-DIMENSION[eztv]',
+        'Lost.S01.720p.HDTV.x264-DIMENSION',
+        'Lost.S01E01E02.720p.HDTV.x264-DIMENSION',
+        'Doctor.Who.2005.S10E01.720p.HDTV.x264-FOO',
+        'Its.Always.Sunny.in.Philadelphia.S12E01.720p.WEB-DL.x264-FOO',
+        'Lost.US.S01E01.720p.HDTV.x264-DIMENSION',
+        'Mr.Robot.S02E01.HEVC-FOO',
+        'Lost S01E01 720p HDTV.x264-DIMENSION',
+        'Inception (2010) 1080p BluRay x264',
+        'Blade.Runner.2049.2017.1080p.BluRay.x264-FOO',
+        'Arrival.2016.x265.1080p-FOO',
+        'Russian.Doll.S01E01.720p.WEBRip.x264-LOL',
+        'Spain.2010.1080p.BluRay.x264-FOO',
+        'Lost.Series.2010.1080p.BluRay.x264-FOO',
+        'Futurama.2035.1080p.BluRay.x264-FOO',
+        'foo',
+    ]
+
+    # Combinatorial corpus: title words (plain words, languages, countries
+    # and words guessit tags as other, edition, etc.) combined with
+    # markers, tokens and release groups
+    TITLE_WORDS = [
+        'Lost', 'Doll', 'Mirror', 'Black', 'Stranger', 'Things', 'Good',
+        'Place', 'Man', 'Girl', 'Office', 'The', 'Russian', 'French',
+        'English', 'Spain', 'Molof', 'Sur',
+    ]
+    OTHER_WORDS = [
+        'Pilot', 'Episode', 'Series', 'Season', 'Part', 'Extra', 'Extras',
+        'Bonus', 'Remux', 'Proper', 'Real', 'Fix', 'Complete', 'Limited',
+        'Final', 'Special', 'Edition', 'Director', 'Cut', 'Unrated',
+        'Uncut', 'Extended', 'Remastered', 'Classic', 'Line', 'Screener',
+        'Retail', 'Sub', 'Subs', 'Dubbed', 'Web', 'Cam', 'Deluxe',
+        'Criterion', 'Collector', 'Unaired', 'Netflix', 'Dual', 'Audio',
+        'Wide', 'Screen', 'Dolby', 'Video', 'Film', 'True', 'Air',
+    ]
+    TITLE_SHAPES = [
+        lambda x: [x],
+        lambda x: [x, 'Lost'],
+        lambda x: ['Big', x],
+        lambda x: ['The', x, 'Man'],
+    ]
+    MARKERS = ['S01E01', 'S10E05', '2010', '1999', '2035']
+    TOKENS = ['720p.HDTV.x264', '1080p.BluRay.x264', '2160p.WEBRip.x265',
+              'HDTV.XviD', '720p.WEBRip.HEVC']
+    GROUPS = ['-LOL', '-KILLERS', '']
+
+    def corpus(self):
+        names = self.NAMES + self.FALLBACK_NAMES
+
+        app = testapp.TestApp({
+            'plugins.providers.' + provider + '.enabled': True
+            for (provider, sample) in self.SAMPLES
+        })
+        for (provider, sample) in self.SAMPLES:
+            provider = app.get_extension(pluginlib.Provider, provider)
+            with open(testapp.www_sample_path(sample), 'rb') as fh:
+                names.extend(x['name'] for x in provider.parse(fh.read()))
+
+        return names + list(self.combinatorial_corpus())
+
+    def combinatorial_corpus(self):
+        languages = sorted(
+            x for x in babelfish.language_converters['name'].codes
+            if x.isalpha())
+        countries = sorted(
+            x.title() for x in babelfish.country_converters['name'].codes
+            if x.isalpha())
+        words = (self.TITLE_WORDS + self.OTHER_WORDS + languages[::50] +
+                 countries[::4])
+
+        # Each title gets a different combination of marker, tokens and
+        # group, all of them are used several times
+        suffixes = list(itertools.product(self.MARKERS, self.TOKENS,
+                                          self.GROUPS))
+        titles = itertools.product(words, self.TITLE_SHAPES)
+        for (idx, (word, shape)) in enumerate(titles):
+            marker, tokens, group = suffixes[idx % len(suffixes)]
+            yield '.'.join(shape(word) + [marker, tokens]) + group
+
+    def test_matches_guessit(self):
+        n_parsed = 0
+
+        for name in self.corpus():
+            for type_hint in (None, 'episode', 'movie'):
+                info = mediainfo._scene_parse(name, type_hint=type_hint)
+                if info is None:
+                    continue
+
+                n_parsed += 1
+                expected = dict(guessit.guessit(
+                    name, options={'type': type_hint}))
+                self.assertEqual(
+                    info, expected,
+                    msg='Missmatch for {} ({})'.format(name, type_hint))
+
+        self.assertTrue(n_parsed > 0)
+
+    def test_fallback(self):
+        for name in self.NAMES:
+            self.assertIsNotNone(mediainfo._scene_parse(name), msg=name)
+
+        for name in self.FALLBACK_NAMES:
+            self.assertIsNone(mediainfo._scene_parse(name), msg=name)
+
+        self.assertIsNone(mediainfo._scene_parse(self.NAMES[0],
+                                                 type_hint='movie'))
+
+    def test_parse_without_guessit(self):
+        app = testapp.TestApp()
+
+        with app.hijack(guessit, 'guessit', None):
+            entity_data, metadata = mediainfo.parse(self.NAMES[0])
+
+        self.assertEqual(entity_data, {
+            'type': 'episode',
+            'series': 'lost',
+            'season': 1,
+            'number': 1
+        })
+        self.assertEqual(metadata, {
+            mediainfo.Tags.RELEASE_GROUP: 'DIMENSION',
+            mediainfo.Tags.VIDEO_CODEC: 'h264',
+            mediainfo.Tags.VIDEO_FORMAT: 'HDTV',
+            mediainfo.Tags.VIDEO_SCREEN_SIZE: '720p'
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,7 +21,10 @@
 import unittest
 import warnings
 
-from arroyo import pluginlib
+from arroyo import (
+    importer,
+    pluginlib
+)
 import testapp
 
 
@@ -86,6 +89,43 @@ class TestProvider:
                 msg="Parse missmatch for {}".format(sample)
             )
 
+    def test_parse_in_worker(self):
+        provider = self.app.get_extension(
+            pluginlib.Provider,
+            self.PROVIDER_NAME)
+
+        if not provider.POOL_SAFE:
+            return
+
+        settings = {
+            'importer.parser': self.app.settings.get('importer.parser')
+        }
+
+        for (sample, n_expected) in self.PARSE_TESTS:
+            with open(testapp.www_sample_path(sample), 'rb') as fh:
+                results = importer._parse_in_worker(
+                    provider.__class__, settings, fh.read())
+
+            self.assertEqual(
+                n_expected, len(results),
+                msg="Worker parse missmatch for {}".format(sample)
+            )
+
+    def test_mirrors(self):
+        provider = self.app.get_extension(
+            pluginlib.Provider,
+            self.PROVIDER_NAME)
+
+        for mirror in provider.MIRRORS:
+            self.assertTrue(
+                provider.compatible_uri(mirror + '/'),
+                msg='Mirror {} not compatible'.format(mirror))
+
+            uri = mirror + '/foo/'
+            uris = self.app.importer.mirror_uris(provider, uri)
+            self.assertEqual(uris[0], uri)
+            self.assertEqual(len(uris), len(provider.MIRRORS))
+
     def test_query_uri(self):
         provider = self.app.get_extension(
             pluginlib.Provider, self.PROVIDER_NAME
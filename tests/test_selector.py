@@ -22,7 +22,13 @@ import unittest
 import testapp
 
 
-from arroyo import models
+import sqlalchemy
+
+
+from arroyo import (
+    mediainfo,
+    models
+)
 
 
 class QueryBuilderTest(unittest.TestCase):
@@ -478,5 +484,70 @@ class EpisodeSelectorTest(SelectorTestCase):
         self.assertEqual(len(groups), 3)
 
 
+class LoadingPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.app = testapp.TestApp({
+            'plugins.filters.sourcefields.enabled': True,
+        })
+        self.app.insert_sources(*[
+            testapp.mock_source(
+                'Lost.S01E{:02d}.720p.HDTV.x264-LOL'.format(x),
+                type='episode')
+            for x in range(1, 11)
+        ])
+        self.query = self.app.selector.query_from_args(
+            params={'name_glob': '*lost*'})
+
+    def count_queries(self, fn):
+        statements = []
+
+        def _listener(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = self.app.db.session.get_bind()
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', _listener)
+        try:
+            fn()
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute',
+                                    _listener)
+
+        return len(statements)
+
+    def touch(self, srcs):
+        for src in srcs:
+            src.tag_dict
+            src.download
+            if src.entity:
+                src.entity.selection
+
+    def test_eager_loading(self):
+        srcs = self.app.selector.matches(self.query, auto_import=False)
+        self.assertEqual(len(srcs), 10)
+        self.assertEqual(srcs[0].tag_dict[mediainfo.Tags.RELEASE_GROUP],
+                         'LOL')
+
+        self.assertEqual(self.count_queries(lambda: self.touch(srcs)), 0)
+
+    def test_without_plan(self):
+        srcs = self.app.selector.matches(self.query, auto_import=False,
+                                         loading_plan=())
+
+        self.assertTrue(self.count_queries(lambda: self.touch(srcs)) > 0)
+
+        # tag_dict is loaded only once
+        self.assertEqual(self.count_queries(lambda: self.touch(srcs)), 0)
+
+    def test_tag_dict_follows_changes(self):
+        src = self.app.selector.matches(self.query, auto_import=False)[0]
+        src.tag_dict
+
+        src.tags.append(models.SourceTag('custom.foo', 'bar'))
+        self.assertEqual(src.tag_dict['custom.foo'], 'bar')
+
+        self.app.mediainfo.rewrite_tags([(src, {})])
+        self.assertEqual(src.tag_dict, {'custom.foo': 'bar'})
+
+
 if __name__ == '__main__':
     unittest.main()
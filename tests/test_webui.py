@@ -18,14 +18,17 @@
 # USA.
 
 
-import unittest
-
-
 import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
 
 
+from arroyo import models
+from arroyo.plugins.commands.webuicmd import webapp
 import testapp
-from arroyo.plugins.webui import webapp
 
 
 def parse(response):
@@ -54,5 +57,54 @@ class WebUITest(unittest.TestCase):
             self.assertEqual(len(resp), 1)
 
 
+class SessionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_connection_is_reused(self):
+        # File databases have a connection pool
+        app = testapp.TestApp({
+            'db-uri': 'sqlite:///' + os.path.join(self.tmpdir, 'arroyo.db')
+        })
+        app.insert_sources(testapp.mock_source('foo'))
+        app.db.session.remove()
+
+        webui = webapp.WebApp(app)
+        connections = []
+
+        @webui.route('/test/count')
+        def count():
+            session = app.db.session
+            connections.append(session.connection().connection.connection)
+            return {'count': session.query(models.Source).count()}
+
+        done = threading.Event()
+        responses = []
+
+        def _request(wait):
+            responses.append(parse(webui.test_client().get('/test/count')))
+            # First thread is still alive while the second request runs
+            if wait:
+                done.wait(5)
+
+        first = threading.Thread(target=_request, args=(True,))
+        first.start()
+        while not responses:
+            first.join(0.01)
+
+        second = threading.Thread(target=_request, args=(False,))
+        second.start()
+        second.join()
+        done.set()
+        first.join()
+
+        self.assertEqual(responses, [({'count': 1}, 200)] * 2)
+        self.assertTrue(connections[0] is connections[1])
+        self.assertEqual(app.db.engine.pool.checkedout(), 0)
+
+
 if __name__ == '__main__':
     unittest.main()